@@ -1,11 +1,100 @@
+import time
+_module_import_started = time.perf_counter()
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from collections import OrderedDict
 import os
-import requests
+import sys
+import importlib
+import io
+import hashlib
+import threading
+import sqlite3
+import re
+import json
+import csv
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import random
+import logging
+import uuid
+import difflib
+from collections import deque
+from contextlib import contextmanager
+
+# --- LAZY IMPORTS ---
+# Tab-specific dependencies (Google client stack, openpyxl, xlsxwriter, anthropic) load on first use
+# so the login page and the Add Inventory tab don't pay for them. Loaded modules stay for the process.
+lazy_tab_modules = ("googleapiclient", "google.oauth2", "google.auth.credentials", "requests", "openpyxl", "xlsxwriter", "anthropic")
+_lazy_modules = {}
+
+def lazy_import(name):
+    module = _lazy_modules.get(name)
+    if module is None:
+        module = _lazy_modules[name] = importlib.import_module(name)
+    return module
+
+# --- PERF INSTRUMENTATION ---
+# Phase timings for the current rerun. main() files them into the session's history when the rerun
+# ends, and every phase is also logged as one JSON line on the "inventory_portal.perf" logger.
+perf_history_reruns = 20
+perf_panel_enabled = os.environ.get("PERF_PANEL", "0") == "1"
+perf_log = logging.getLogger("inventory_portal.perf")
+if not perf_log.handlers:
+    _perf_handler = logging.StreamHandler()
+    _perf_handler.setFormatter(logging.Formatter("%(message)s"))
+    perf_log.addHandler(_perf_handler)
+    perf_log.setLevel(os.environ.get("PERF_LOG_LEVEL", "INFO"))
+    perf_log.propagate = False
+_perf_local = threading.local()
+
+def log_perf(event, **fields):
+    perf_log.info(json.dumps({"ts": datetime.now().isoformat(timespec="milliseconds"), "event": event, **fields}, default=str))
+
+def begin_rerun_timings(session, rerun):
+    _perf_local.rerun = {"session": session, "rerun": rerun, "tab": None, "phases": [], "started": time.perf_counter()}
+    return _perf_local.rerun
+
+def end_rerun_timings():
+    rerun = getattr(_perf_local, "rerun", None)
+    _perf_local.rerun = None
+    if rerun is None:
+        return None
+    rerun["seconds"] = round(time.perf_counter() - rerun.pop("started"), 6)
+    log_perf("rerun", session=rerun["session"], rerun=rerun["rerun"], tab=rerun["tab"], seconds=rerun["seconds"], phases=len(rerun["phases"]))
+    return rerun
+
+@contextmanager
+def timed_phase(name, **fields):
+    # The block may add row counts and byte sizes to the yielded record
+    record = dict(fields)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - started, 6)
+        rerun = getattr(_perf_local, "rerun", None)
+        if rerun is not None:
+            rerun["phases"].append({"phase": name, **record})
+            log_perf("phase", session=rerun["session"], rerun=rerun["rerun"], tab=rerun["tab"], phase=name, **record)
+        else:
+            log_perf("phase", phase=name, **record)
+
+def perf_panel(history):
+    # Admin view: one row per recent rerun, one column per phase (seconds, summed when repeated)
+    with st.sidebar.expander("⏱️ Rerun timings", expanded=False):
+        if not history:
+            st.caption("No completed reruns yet.")
+            return
+        rows = []
+        for rerun in reversed(history):
+            row = {"rerun": rerun["rerun"], "tab": rerun["tab"], "total": rerun["seconds"]}
+            for phase in rerun["phases"]:
+                row[phase["phase"]] = row.get(phase["phase"], 0.0) + phase["seconds"]
+            rows.append(row)
+        st.dataframe(pd.DataFrame(rows).set_index("rerun").round(4))
 
 # --- FIELD DEFINITIONS (GLOBAL) ---
 manual_entry_fields = [
@@ -22,6 +111,1953 @@ manual_entry_fields = [
     ("Total Cost", "Total Cost", None)
 ]
 
+# Amazon Business export columns -> manual entry fields
+amazon_csv_to_manual = {
+    "Department": "Department Name",
+    "Vendor": "Brand",
+    "Item": "Title",
+    "Location": None,
+    "Unit": "Brand",
+    "Qty": "Item Quantity",
+    "Par Level": None,
+    "Value": "Item Price",
+    "Frequency": None,
+    "Date Ordered": "Order Date",
+    "Total Cost": "Order Subtotal"
+}
+
+# --- UPLOAD PARSE CACHE ---
+# Parsed uploads keyed by (content hash, reader, sheet, header row) so reruns don't re-parse the same file.
+def parse_report_bytes(data, reader, sheet_name=0, header=0, engine=None):
+    if reader == "csv" and isinstance(header, int) and header > 0:
+        # Title lines above the header may have fewer fields, so skip them instead of tokenizing them
+        return pd.read_csv(io.BytesIO(data), skiprows=header, header=0)
+    if reader == "csv":
+        return pd.read_csv(io.BytesIO(data), header=header)
+    return pd.read_excel(io.BytesIO(data), sheet_name=sheet_name, header=header, engine=engine)
+
+class UploadParseCache:
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_parse(self, data, reader, sheet_name=0, header=0, engine=None):
+        key = (hashlib.sha256(data).hexdigest(), reader, sheet_name, header, engine)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key].copy(deep=False)
+            self.misses += 1
+        df = parse_report_bytes(data, reader, sheet_name, header, engine)
+        with self._lock:
+            self._entries[key] = df
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return df.copy(deep=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._entries)}
+
+@st.cache_resource
+def get_parse_cache():
+    # One cache per server process, shared by every session
+    return UploadParseCache()
+
+def upload_key(uploaded_file):
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+def read_report(uploaded_file, reader="excel", sheet_name=0, header=0, engine=None):
+    return get_parse_cache().get_or_parse(uploaded_file.getvalue(), reader, sheet_name=sheet_name, header=header, engine=engine)
+
+# --- UPLOAD NORMALIZATION ---
+# Whole-column equivalents of the old per-cell int()/float()/pd.to_datetime() conversions.
+def _has_text(raw):
+    # True when the column holds strings the .str accessor can work on
+    if raw.dtype == object:
+        return pd.api.types.infer_dtype(raw, skipna=True) in ("string", "mixed", "mixed-integer")
+    return pd.api.types.is_string_dtype(raw.dtype)
+
+def _strip_strings(raw):
+    if _has_text(raw):
+        stripped = raw.str.strip()
+        return stripped.where(stripped.notna(), raw)
+    return raw
+
+def _coerce_int_column(raw):
+    raw = _strip_strings(raw)
+    num = pd.to_numeric(raw, errors='coerce').astype(float)
+    if _has_text(raw):
+        # int("3.0") fails, so only whole-number strings survive
+        num = num.mask(raw.str.fullmatch(r"[+-]?\d+").eq(False))
+    num = num.where(np.isfinite(num))
+    failed = raw.notna() & num.isna()
+    return np.trunc(num).astype("Int64"), failed
+
+def _coerce_float_column(raw):
+    raw = _strip_strings(raw)
+    num = pd.to_numeric(raw, errors='coerce').astype(float)
+    failed = raw.notna() & num.isna()
+    return num.mask(failed, 0.0), failed
+
+def _coerce_date_column(raw, today):
+    raw = _strip_strings(raw)
+    blank = raw.isna() | raw.eq("") | raw.eq(0)
+    candidates = raw.mask(blank)
+    parsed = pd.to_datetime(candidates, errors='coerce')
+    retry = parsed.isna() & ~blank
+    if retry.any():
+        # Column format inference failed for some cells; fall back to per-value parsing for those only
+        parsed = parsed.astype(object)
+        parsed[retry] = pd.to_datetime(candidates[retry], errors='coerce', format='mixed')
+        parsed = pd.to_datetime(parsed, errors='coerce')
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_localize(None)
+    failed = parsed.isna() & ~blank
+    return parsed.dt.normalize().fillna(today), failed
+
+def normalize_upload(df_upload, col_map, missing=None):
+    # Map source columns onto manual_entry_fields. Returns a typed DataFrame plus per-field error
+    # flags for mapped values that could not be parsed and were defaulted (errors.any(axis=1) per row).
+    index = df_upload.index
+    today = pd.Timestamp(datetime.today().date())
+    out = {}
+    errors = {}
+    for field, label, options in manual_entry_fields:
+        src = col_map.get(field)
+        mapped = bool(src) and src in df_upload.columns
+        # A list, not a scalar: pandas turns a broadcast None into NaN, which the review shows as "nan"
+        raw = df_upload[src] if mapped else pd.Series([missing] * len(index), index=index, dtype=object)
+        failed = None
+        if field == "Qty":
+            out[field], failed = _coerce_int_column(raw)
+        elif field == "Value" or field == "Total Cost":
+            if mapped:
+                out[field], failed = _coerce_float_column(raw)
+            else:
+                out[field] = pd.Series(0.0, index=index)
+        elif field == "Par Level":
+            # 0 means "not set": the reorder list then derives a par level from usage
+            if mapped:
+                par, failed = _coerce_int_column(raw)
+                out[field] = par.fillna(0).clip(lower=0).astype("int64")
+            else:
+                out[field] = pd.Series(0, index=index, dtype="int64")
+        elif field == "Date Ordered":
+            out[field], failed = _coerce_date_column(raw, today)
+        else:
+            out[field] = raw
+        if failed is not None:
+            errors[field] = failed if mapped else pd.Series(False, index=index)
+    # Total Cost falls back to Qty x Value (or Value alone when Qty is missing)
+    qty = out["Qty"].astype(float)
+    fallback = (qty * out["Value"]).where(qty.notna(), out["Value"])
+    out["Total Cost"] = out["Total Cost"].mask(out["Total Cost"] == 0.0, fallback)
+    normalized = pd.DataFrame(out, index=index).reset_index(drop=True)
+    return normalized, pd.DataFrame(errors, index=index).reset_index(drop=True)
+
+def normalized_row_to_entry(normalized, idx):
+    # Convert one normalized row back to the plain Python values the review widgets expect
+    row = normalized.iloc[idx]
+    entry = {}
+    for field, label, options in manual_entry_fields:
+        val = row[field]
+        if field == "Qty":
+            val = None if pd.isna(val) else int(val)
+        elif field == "Par Level":
+            val = int(val)
+        elif field == "Value" or field == "Total Cost":
+            val = float(val)
+        elif field == "Date Ordered":
+            val = val.date()
+        entry[field] = val
+    return entry
+
+# --- UPLOAD VALIDATION ---
+# Rules a normalized upload row must pass to be auto-accepted in batch review
+upload_validation_rules = {
+    "known_department": "Department is one of " + ", ".join(manual_entry_fields[0][2]),
+    "positive_qty": "Qty > 0",
+    "price_band": "Unit price within the historical band",
+    "parseable_date": "Order date could be parsed",
+}
+
+def validate_upload_rows(normalized, field_errors, rules, history=None, price_band=3.0):
+    # One boolean column per enabled rule; True means the row failed that rule
+    flags = {}
+    if rules.get("known_department"):
+        flags["Unknown department"] = ~normalized["Department"].isin(manual_entry_fields[0][2])
+    if rules.get("positive_qty"):
+        flags["Qty not > 0"] = ~(normalized["Qty"].fillna(0) > 0)
+    if rules.get("parseable_date") and "Date Ordered" in field_errors.columns:
+        flags["Unparseable date"] = field_errors["Date Ordered"]
+    if rules.get("price_band") and history is not None:
+        # Compare against the item's median historical price, or the overall median for new items
+        hist = history.loc[history["Value"] > 0, ["Item", "Value"]]
+        if len(hist):
+            reference = normalized["Item"].map(hist.groupby("Item", observed=True)["Value"].median())
+            ratio = normalized["Value"] / reference.fillna(hist["Value"].median())
+            flags["Price outside historical band"] = (ratio > price_band) | (ratio < 1 / price_band)
+    return pd.DataFrame(flags, index=normalized.index, dtype=bool)
+
+def describe_rule_failures(flags):
+    issues = pd.Series("", index=flags.index)
+    for name in flags.columns:
+        issues = issues + np.where(flags[name], name + "; ", "")
+    return issues.str.rstrip("; ")
+
+# --- REPORT SCHEMA SNIFFING ---
+# Only the first rows of an uploaded report are read to find the header row, infer column types and
+# suggest a column mapping; the full parse waits until the mapping is confirmed.
+sniff_rows = 30
+sniff_header_candidates = 10
+column_synonyms = {
+    "Department": ["department", "dept", "department name", "clinic", "site"],
+    "Vendor": ["vendor", "supplier", "brand", "manufacturer", "seller"],
+    "Item": ["item", "item name", "title", "description", "product", "product name"],
+    "Location": ["location", "storage location", "room"],
+    "Unit": ["unit", "uom", "unit of measure", "pack size"],
+    "Qty": ["qty", "quantity", "item quantity", "count", "on hand"],
+    "Par Level": ["par level", "par", "reorder point", "min qty"],
+    "Value": ["value", "price", "unit price", "item price", "unit cost", "value per unit"],
+    "Frequency": ["frequency", "order frequency"],
+    "Date Ordered": ["date ordered", "order date", "date", "ordered on"],
+    "Total Cost": ["total cost", "total", "amount", "extended cost", "subtotal", "order subtotal"],
+}
+# Column kinds each field accepts when suggesting a mapping
+field_kinds = {"Qty": {"number"}, "Par Level": {"number"}, "Value": {"number"}, "Total Cost": {"number"},
+               "Date Ordered": {"date", "text"}}
+column_match_threshold = 0.75
+
+def clean_columns(columns):
+    return [str(c).strip() for c in columns]
+
+def _normalize_name(name):
+    return re.sub(r"[^0-9a-z]+", " ", str(name).lower()).strip()
+
+def _name_score(field, column):
+    # Similarity to the closest synonym; a synonym appearing as whole words ("Product Description") also scores
+    name = _normalize_name(column)
+    best = 0.0
+    for synonym in column_synonyms[field] + [field.lower()]:
+        score = difflib.SequenceMatcher(None, name, synonym).ratio()
+        if name and re.search(rf"\b{re.escape(synonym)}\b", name):
+            score = max(score, 0.8 + 0.2 * len(synonym) / len(name))
+        best = max(best, score)
+    return best
+
+def _read_head(data, name, header, nrows):
+    if name.endswith('.csv'):
+        if header is None:
+            # Raw lines may be ragged (title rows above the header), so split them with the csv module
+            text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", errors="replace", newline="")
+            return pd.DataFrame(list(itertools.islice(csv.reader(text), nrows)), dtype=object)
+        return pd.read_csv(io.BytesIO(data), skiprows=header, header=0, nrows=nrows, dtype=object)
+    # openpyxl (used by pandas for .xlsx) stops reading after nrows
+    return pd.read_excel(io.BytesIO(data), header=header, nrows=nrows, dtype=object)
+
+def _value_kinds(values):
+    values = values.dropna()
+    values = values[values.astype(str).str.strip() != ""]
+    if not len(values):
+        return "empty"
+    if pd.to_numeric(values, errors="coerce").notna().mean() >= 0.8:
+        return "number"
+    if pd.to_datetime(values.astype(str), errors="coerce", format="mixed").notna().mean() >= 0.8:
+        return "date"
+    return "text"
+
+def _header_score(row):
+    # Header rows are mostly text (not numbers or dates) and contain names we recognise
+    cells = [c for c in row if pd.notna(c) and str(c).strip()]
+    text = [c for c in cells if not isinstance(c, (int, float, datetime, pd.Timestamp)) and pd.isna(pd.to_numeric(str(c), errors="coerce"))]
+    known = sum(max(_name_score(field, c) for field in column_synonyms) >= 0.9 for c in text)
+    return len(text) + 3 * known
+
+def sniff_report_schema(data, name):
+    raw = _read_head(data, name, None, sniff_rows)
+    scores = [_header_score(raw.iloc[i].tolist()) for i in range(min(sniff_header_candidates, len(raw)))]
+    header_row = int(np.argmax(scores)) if scores else 0
+    preview = _read_head(data, name, header_row, sniff_rows)
+    preview.columns = clean_columns(preview.columns)
+    kinds = {col: _value_kinds(preview[col]) for col in preview.columns}
+    signature = hashlib.sha256("\x1f".join(sorted(_normalize_name(c) for c in preview.columns)).encode("utf-8")).hexdigest()[:16]
+    return {"header_row": header_row, "columns": list(preview.columns), "kinds": kinds, "preview": preview.head(5), "signature": signature}
+
+def suggest_column_mapping(columns, kinds=None):
+    # Greedy best-first assignment of fields to columns by name similarity; type-incompatible pairs skipped
+    pairs = []
+    for field in column_synonyms:
+        for col in columns:
+            if kinds and field in field_kinds and kinds.get(col) not in field_kinds[field] | {"empty"}:
+                continue
+            score = _name_score(field, col)
+            if score >= column_match_threshold:
+                pairs.append((score, field, col))
+    mapping, used = {}, set()
+    for score, field, col in sorted(pairs, key=lambda p: -p[0]):
+        if field not in mapping and col not in used:
+            mapping[field] = col
+            used.add(col)
+    return mapping
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def sniff_upload(content_hash, _data, name):
+    return sniff_report_schema(_data, name)
+
+def load_column_mapping(store, signature):
+    if store.db is not None:
+        return store.db.load_column_mapping(signature)
+    return st.session_state.setdefault('column_mappings', {}).get(signature)
+
+def save_column_mapping(store, signature, mapping):
+    mapping = {field: col for field, col in mapping.items() if col}
+    if store.db is not None:
+        store.db.save_column_mapping(signature, mapping)
+    else:
+        st.session_state.setdefault('column_mappings', {})[signature] = mapping
+
+# --- INVENTORY STORE ---
+inventory_columns = [f[0] for f in manual_entry_fields]
+inventory_category_columns = ["Department", "Location", "Vendor"]
+inventory_dtypes = {
+    "Department": "category",
+    "Vendor": "category",
+    "Item": object,
+    "Location": "category",
+    "Unit": object,
+    "Qty": "Int64",
+    "Par Level": "Int64",
+    "Value": "float64",
+    "Frequency": object,
+    "Date Ordered": "datetime64[ns]",
+    "Total Cost": "float64"
+}
+
+def coerce_inventory_frame(rows):
+    # Cast a list of row dicts (or a DataFrame) to the store's column types. Total Cost is coerced
+    # to a number and falls back to Qty x Value when it is missing or zero.
+    df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(list(rows))
+    # Rows are taken by position: filtered frames (a batch with its flagged rows removed) arrive
+    # with gaps in their index, which must not be realigned onto the new RangeIndex
+    df = df.reindex(columns=inventory_columns).reset_index(drop=True)
+    out = {}
+    for col in inventory_columns:
+        s = df[col]
+        if col == "Qty" or col == "Par Level":
+            out[col] = np.trunc(pd.to_numeric(s, errors='coerce').astype(float)).astype("Int64")
+        elif col == "Value" or col == "Total Cost":
+            out[col] = pd.to_numeric(s, errors='coerce').astype(float)
+        elif col == "Date Ordered":
+            out[col] = pd.to_datetime(s, errors='coerce', format='mixed').astype("datetime64[ns]")
+        else:
+            out[col] = s.astype(inventory_dtypes[col])
+    out["Total Cost"] = out["Total Cost"].fillna(0.0)
+    mask = (out["Total Cost"] == 0) & out["Qty"].notna() & out["Value"].notna()
+    out["Total Cost"] = out["Total Cost"].mask(mask, out["Qty"].astype(float) * out["Value"])
+    return pd.DataFrame(out, index=pd.RangeIndex(len(df)))
+
+def _concat_inventory_frames(frames):
+    # Concatenate while keeping the categorical columns categorical (categories are unioned)
+    frames = [f for f in frames if len(f)] or frames[:1]
+    for col in inventory_category_columns:
+        cats = frames[0][col].cat.categories
+        for f in frames[1:]:
+            cats = cats.union(f[col].cat.categories)
+        for f in frames:
+            f[col] = f[col].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True)
+
+# --- SQLITE PERSISTENCE ---
+inventory_db_path = os.environ.get("INVENTORY_DB_PATH", "inventory.db")
+# An existing Excel export found here is imported the first time the database is created
+inventory_export_path = os.environ.get("INVENTORY_EXPORT_PATH", "inventory_report.xlsx")
+inventory_db_columns = {
+    "Department": "department",
+    "Vendor": "vendor",
+    "Item": "item",
+    "Location": "location",
+    "Unit": "unit",
+    "Qty": "qty",
+    "Par Level": "par_level",
+    "Value": "value",
+    "Frequency": "frequency",
+    "Date Ordered": "date_ordered",
+    "Total Cost": "total_cost"
+}
+
+# Every change is also appended to the journal table (ids plus the new row values) in the same
+# transaction. A parquet snapshot of the table is written every journal_snapshot_every records (or
+# sooner once journal_snapshot_rows rows have changed), and a restart loads the latest snapshot and
+# folds in the journal written since. Older entries are then compacted: the journal_undo_depth
+# records before the snapshot stay, everything earlier collapses into one "compact" record that
+# keeps the highest id ever handed out (ids are never reused).
+journal_undo_depth = 50
+journal_snapshot_every = 500
+journal_snapshot_rows = 20000
+
+class InventoryConflict(ValueError):
+    # An edit, delete or undo based on rows another session has changed or removed since
+    pass
+
+def replay_journal(frame, ids, versions, records):
+    # Fold (op, ids, rows) journal records into a frame/ids/versions triple; the last image of each
+    # id wins, so replaying records that are already applied changes nothing
+    latest = {}
+    for op, rec_ids, rows in records:
+        rec_ids = json.loads(rec_ids)
+        if op == "compact":
+            continue
+        if op == "delete":
+            latest.update(dict.fromkeys(rec_ids))
+        else:
+            latest.update(zip(rec_ids, json.loads(rows)))
+    if not latest:
+        return frame, ids, versions
+    keep = ~np.isin(ids, np.fromiter(latest, dtype="int64"))
+    live = {row_id: row for row_id, row in latest.items() if row is not None}
+    # Each journaled row ends with the row's version
+    new = coerce_inventory_frame(pd.DataFrame([row[:len(inventory_columns)] for row in live.values()], columns=inventory_columns))
+    new_versions = np.array([row[len(inventory_columns)] if len(row) > len(inventory_columns) else 1 for row in live.values()], dtype="int64")
+    ids = np.concatenate([ids[keep], np.fromiter(live, dtype="int64", count=len(live))])
+    versions = np.concatenate([versions[keep], new_versions])
+    frame = _concat_inventory_frames([frame[keep].reset_index(drop=True), new])
+    order = np.argsort(ids, kind="stable")
+    return frame.iloc[order].reset_index(drop=True), ids[order], versions[order]
+
+class InventoryDB:
+    # SQLite store shared by every session in the process. WAL mode lets readers proceed while a
+    # write transaction is open; the lock serialises use of the single connection.
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_dir = os.path.dirname(os.path.abspath(path))
+        self.snapshot_prefix = os.path.basename(path) + ".snapshot-"
+        self.snapshot_seq = None
+        self.journal_rows = 0
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS inventory (id INTEGER PRIMARY KEY, department TEXT, vendor TEXT, "
+                "item TEXT, location TEXT, unit TEXT, qty INTEGER, par_level INTEGER, value REAL, "
+                "frequency TEXT, date_ordered TEXT, total_cost REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_department_item ON inventory (department, item)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_vendor ON inventory (vendor)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_date_ordered ON inventory (date_ordered)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS allocation_templates (vendor TEXT, department TEXT, share REAL, "
+                "item TEXT, location TEXT, PRIMARY KEY (vendor, department))"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS import_keys (key TEXT PRIMARY KEY, imported_at TEXT)")
+            # Orders merged into rows (see order_log_changes); kept when the row is deleted so an
+            # undone delete gets its history back
+            self.conn.execute("CREATE TABLE IF NOT EXISTS order_log (id INTEGER, date_ordered TEXT, qty REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_order_log_id ON order_log (id)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY, applied_at TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS column_mappings (signature TEXT PRIMARY KEY, mapping TEXT, saved_at TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY, op TEXT, label TEXT, ids TEXT, "
+                "rows TEXT, n INTEGER, max_id INTEGER, at TEXT)"
+            )
+            # Row versions for optimistic concurrency; databases from before they existed start at 1
+            if "version" not in {row[1] for row in self.conn.execute("PRAGMA table_info(inventory)")}:
+                self.conn.execute("ALTER TABLE inventory ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        self.seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM journal").fetchone()[0]
+
+    @staticmethod
+    def _records(frame, ids):
+        out = frame[inventory_columns].copy()
+        out["Date Ordered"] = out["Date Ordered"].dt.strftime("%Y-%m-%d")
+        values = out.astype(object).where(out.notna(), None)
+        return [(*row, int(row_id)) for row_id, row in zip(ids, values.itertuples(index=False, name=None))]
+
+    def _journal(self, op, ids, records, label, versions=None):
+        # Called inside the change's transaction; label None (migrations) skips the journal
+        if label is None:
+            return
+        rows = None if records is None else json.dumps([[*rec[:-1], int(v)] for rec, v in zip(records, versions)])
+        self.seq = self.conn.execute(
+            "INSERT INTO journal (op, label, ids, rows, n, max_id, at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (op, label, json.dumps([int(i) for i in ids]), rows, len(ids), int(max(ids)), datetime.now().isoformat(timespec="seconds"))
+        ).lastrowid
+        self.journal_rows += len(ids)
+
+    def insert_frame(self, frame, ids=None, label=None, versions=None):
+        # One transaction per batch; ids are allocated here unless the caller is restoring rows.
+        # Ids are never reused, including ones whose rows were deleted (redo brings them back).
+        # versions: what restored rows come back at (new rows start at 1).
+        if versions is None:
+            versions = np.ones(len(frame), dtype="int64")
+        with self._lock:
+            with self.conn:
+                if ids is None:
+                    start = self.conn.execute(
+                        "SELECT COALESCE(MAX(m), 0) + 1 FROM (SELECT MAX(id) AS m FROM inventory UNION ALL SELECT MAX(max_id) FROM journal)"
+                    ).fetchone()[0]
+                    ids = np.arange(start, start + len(frame), dtype="int64")
+                records = self._records(frame, ids)
+                cols = ", ".join(inventory_db_columns.values())
+                self.conn.executemany(
+                    f"INSERT INTO inventory ({cols}, id, version) VALUES ({', '.join('?' * (len(inventory_db_columns) + 2))})",
+                    [(*rec, int(v)) for rec, v in zip(records, versions)]
+                )
+                self._journal("insert", ids, records, label, versions)
+            self._maybe_snapshot()
+        return np.asarray(ids, dtype="int64")
+
+    def _log_order_changes(self, ids, before, after):
+        added, rolled_back, corrected = order_log_changes(before, after)
+        dates = after["Date Ordered"].dt.strftime("%Y-%m-%d").to_numpy(dtype=object, na_value=None)
+        ids = [int(i) for i in ids]
+        # A row's first merge records the order it held until then
+        first = zip(ids, before["Date Ordered"].dt.strftime("%Y-%m-%d").to_numpy(dtype=object, na_value=None),
+                    before["Qty"].astype("float64").fillna(0.0).tolist(), added)
+        self.conn.executemany(
+            "INSERT INTO order_log (id, date_ordered, qty) SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM order_log WHERE id = ?)",
+            [(i, d, q, i) for i, d, q, new in first if new > 0]
+        )
+        self.conn.executemany(
+            "INSERT INTO order_log (id, date_ordered, qty) VALUES (?, ?, ?)",
+            [(i, d, float(q)) for i, d, q in zip(ids, dates, added) if q > 0]
+        )
+        self.conn.executemany(
+            "DELETE FROM order_log WHERE id = ? AND date_ordered > ?",
+            [(i, d) for i, d, back in zip(ids, dates, rolled_back) if back]
+        )
+        self.conn.executemany(
+            "UPDATE order_log SET qty = MAX(qty + ?, 0) WHERE rowid = "
+            "(SELECT MAX(rowid) FROM order_log WHERE id = ? AND date_ordered IS ?)",
+            [(float(q), i, d) for i, d, q in zip(ids, dates, corrected) if q]
+        )
+
+    def update_frame(self, frame, ids, versions, label=None, before=None):
+        # versions: what the caller believes each row's version is. The write is refused (and
+        # rolled back) if another process has changed or deleted any of the rows since; each
+        # row's version goes up by one. before (the rows as they were) updates the order log.
+        assignments = ", ".join(f"{col} = ?" for col in inventory_db_columns.values())
+        with self._lock:
+            with self.conn:
+                records = self._records(frame, ids)
+                cur = self.conn.executemany(
+                    f"UPDATE inventory SET {assignments}, version = ? WHERE id = ? AND version = ?",
+                    [(*rec[:-1], int(v) + 1, rec[-1], int(v)) for rec, v in zip(records, versions)]
+                )
+                if cur.rowcount != len(records):
+                    raise InventoryConflict("Some of these rows were changed or deleted by another user")
+                self._journal("update", ids, records, label, np.asarray(versions, dtype="int64") + 1)
+                if before is not None:
+                    self._log_order_changes(ids, before, frame)
+            self._maybe_snapshot()
+
+    def delete_ids(self, ids, versions, label=None):
+        with self._lock:
+            with self.conn:
+                cur = self.conn.executemany(
+                    "DELETE FROM inventory WHERE id = ? AND version = ?", [(int(i), int(v)) for i, v in zip(ids, versions)]
+                )
+                if cur.rowcount != len(ids):
+                    raise InventoryConflict("Some of these rows were changed or deleted by another user")
+                self._journal("delete", ids, None, label)
+            self._maybe_snapshot()
+
+    def journal_since(self, seq):
+        # Change feed: (seq, op, ids, rows, n, label) written after seq, oldest first
+        with self._lock:
+            return self.conn.execute(
+                "SELECT seq, op, ids, rows, n, label FROM journal WHERE seq > ? ORDER BY seq", (seq,)
+            ).fetchall()
+
+    def _snapshots(self):
+        # (seq, path) of the snapshot files for this database, oldest first
+        if not os.path.isdir(self.snapshot_dir):
+            return []
+        return sorted(
+            (int(name[len(self.snapshot_prefix):-len(".parquet")]), os.path.join(self.snapshot_dir, name))
+            for name in os.listdir(self.snapshot_dir)
+            if name.startswith(self.snapshot_prefix) and name.endswith(".parquet")
+        )
+
+    def load_snapshot(self):
+        # Latest snapshot plus the journal tail as (frame, ids, versions, rows in the tail), or None when there is
+        # no snapshot or it does not add up to the table (e.g. the database was replaced)
+        with self._lock:
+            # Another process (the ingest command) may have written to the same file
+            self.seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM journal").fetchone()[0]
+            snapshots = [(seq, path) for seq, path in self._snapshots() if seq <= self.seq]
+            if not snapshots:
+                return None
+            seq, path = snapshots[-1]
+            try:
+                snap = pd.read_parquet(path)
+            except (OSError, ValueError):
+                return None
+            # Copies: column arrays are read-only under copy-on-write, and versions are bumped in place
+            ids = snap.pop("_id").to_numpy(dtype="int64", copy=True)
+            versions = snap.pop("_version").to_numpy(dtype="int64", copy=True) if "_version" in snap else np.ones(len(ids), dtype="int64")
+            tail = self.conn.execute("SELECT op, ids, rows, n FROM journal WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+            frame, ids, versions = replay_journal(coerce_inventory_frame(snap), ids, versions, [rec[:3] for rec in tail])
+            count, total = self.totals()
+        if len(frame) != count or abs(float(frame["Total Cost"].sum()) - total) > 0.01:
+            return None
+        return frame, ids, versions, sum(rec[3] for rec in tail)
+
+    def write_snapshot(self, frame, ids, versions):
+        with self._lock:
+            path = os.path.join(self.snapshot_dir, f"{self.snapshot_prefix}{self.seq:012d}.parquet")
+            frame.assign(_id=ids, _version=versions).to_parquet(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+            self.snapshot_seq = self.seq
+            self.journal_rows = 0
+            for seq, old in self._snapshots():
+                if old != path:
+                    os.remove(old)
+            self._compact_journal(self.snapshot_seq)
+
+    def _compact_journal(self, snapshot_seq):
+        # Everything before the journal_undo_depth records preceding the snapshot becomes a single
+        # record at the same seq holding the highest id seen, so id allocation stays safe
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT seq FROM journal WHERE seq <= ? ORDER BY seq DESC LIMIT 1 OFFSET ?", (snapshot_seq, journal_undo_depth)
+            ).fetchone()
+            if row is None:
+                return
+            cutoff = row[0]
+            with self.conn:
+                count, max_id = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(MAX(max_id), 0) FROM journal WHERE seq <= ?", (cutoff,)
+                ).fetchone()
+                if count == 1 and self.conn.execute("SELECT op FROM journal WHERE seq = ?", (cutoff,)).fetchone()[0] == "compact":
+                    return
+                self.conn.execute("DELETE FROM journal WHERE seq <= ?", (cutoff,))
+                self.conn.execute(
+                    "INSERT INTO journal (seq, op, label, ids, rows, n, max_id, at) VALUES (?, 'compact', NULL, '[]', NULL, 0, ?, ?)",
+                    (cutoff, int(max_id), datetime.now().isoformat(timespec="seconds"))
+                )
+
+    def _maybe_snapshot(self):
+        if self.snapshot_seq is None:
+            snapshots = self._snapshots()
+            self.snapshot_seq = snapshots[-1][0] if snapshots else 0
+            self.journal_rows = self.conn.execute(
+                "SELECT COALESCE(SUM(n), 0) FROM journal WHERE seq > ?", (self.snapshot_seq,)
+            ).fetchone()[0]
+        if self.seq - self.snapshot_seq >= journal_snapshot_every or self.journal_rows >= journal_snapshot_rows:
+            restored = self.load_snapshot()
+            self.write_snapshot(*(restored[:3] if restored is not None else self.load()))
+
+    def load_current(self):
+        # The whole table: snapshot + journal tail when possible, otherwise a full read (which then
+        # becomes the new snapshot)
+        with self._lock:
+            restored = self.load_snapshot()
+            if restored is not None and restored[3] < journal_snapshot_rows:
+                return restored[:3]
+            current = restored[:3] if restored is not None else self.load()
+            self.write_snapshot(*current)
+        return current
+
+    def totals(self):
+        with self._lock:
+            count, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(total_cost), 0) FROM inventory").fetchone()
+        return count, float(total)
+
+    def load(self, where="", params=(), limit=None, offset=0):
+        # Rows in insertion order as (typed frame, ids, versions); where/limit/offset let callers load a slice
+        sql = f"SELECT id, version, {', '.join(inventory_db_columns.values())} FROM inventory"
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)} OFFSET {int(offset)}"
+        with self._lock:
+            raw = pd.read_sql_query(sql, self.conn, params=params)
+        ids = raw.pop("id").to_numpy(dtype="int64", copy=True)
+        versions = raw.pop("version").to_numpy(dtype="int64", copy=True)
+        raw.columns = list(inventory_db_columns)
+        return coerce_inventory_frame(raw), ids, versions
+
+    def load_keys(self, limit, offset=0):
+        # (id, version) of a slice of the rows in insertion order, the keys of load(limit=, offset=)
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, version FROM inventory ORDER BY id LIMIT ? OFFSET ?", (int(limit), int(offset))
+            ).fetchall()
+
+    def load_order_log(self):
+        # (id, date, qty) per recorded order, oldest first
+        with self._lock:
+            log = pd.read_sql_query("SELECT id, date_ordered, qty FROM order_log ORDER BY rowid", self.conn)
+        return order_log_frame(log["id"], pd.to_datetime(log["date_ordered"]), log["qty"])
+
+    def load_allocation_template(self, vendor):
+        with self._lock:
+            template = pd.read_sql_query(
+                "SELECT department, share, item, location FROM allocation_templates WHERE vendor = ?",
+                self.conn, params=(vendor,)
+            )
+        if not len(template):
+            return None
+        template.columns = ["Department", "Share", "Item", "Location"]
+        return template
+
+    def save_allocation_template(self, vendor, template):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM allocation_templates WHERE vendor = ?", (vendor,))
+            self.conn.executemany(
+                "INSERT INTO allocation_templates (vendor, department, share, item, location) VALUES (?, ?, ?, ?, ?)",
+                [(vendor, r.Department, float(r.Share), r.Item if pd.notna(r.Item) else None, r.Location if pd.notna(r.Location) else None)
+                 for r in template.itertuples(index=False)]
+            )
+
+    def load_column_mapping(self, signature):
+        with self._lock:
+            row = self.conn.execute("SELECT mapping FROM column_mappings WHERE signature = ?", (signature,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def column_mappings(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT signature, mapping FROM column_mappings").fetchall()
+        return {signature: json.loads(mapping) for signature, mapping in rows}
+
+    def save_column_mapping(self, signature, mapping):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO column_mappings (signature, mapping, saved_at) VALUES (?, ?, ?)",
+                (signature, json.dumps(mapping), datetime.now().isoformat(timespec="seconds"))
+            )
+
+    def load_import_keys(self):
+        with self._lock:
+            return {row[0] for row in self.conn.execute("SELECT key FROM import_keys")}
+
+    def add_import_keys(self, keys):
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO import_keys (key, imported_at) VALUES (?, ?)", [(k, now) for k in keys])
+
+    def remove_import_keys(self, keys):
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM import_keys WHERE key = ?", [(k,) for k in keys])
+
+    def import_export(self, path):
+        # One-time migration from a downloaded inventory_report.xlsx, recorded in the migrations table
+        # so an inventory that is emptied later is not filled from the stale file again. Databases
+        # that already hold rows (they were migrated before the table existed) only record it.
+        with self._lock:
+            if self.conn.execute("SELECT 1 FROM migrations WHERE name = 'import_export'").fetchone():
+                return 0
+            count = 0
+            if self.totals()[0] == 0 and os.path.exists(path):
+                count = len(self.insert_frame(coerce_inventory_frame(pd.read_excel(path, sheet_name=0))))
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO migrations (name, applied_at) VALUES ('import_export', ?)",
+                    (datetime.now().isoformat(timespec="seconds"),)
+                )
+        return count
+
+@st.cache_resource
+def get_inventory_db():
+    db = InventoryDB(inventory_db_path)
+    db.import_export(inventory_export_path)
+    return db
+
+# --- INVENTORY SEARCH INDEX ---
+# Kept by InventoryTable and updated with every insert, edit and delete, so the filter bar does not
+# scan the table. Everything is keyed by row id (which never shifts) and mapped to positions per query.
+search_index_columns = ("Department", "Location")
+
+def _grouped_ids(values, ids):
+    # (value, ids carrying it) for each distinct non-missing value
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    return [(value, ids[order[bounds[k]:bounds[k + 1]]]) for k, value in enumerate(uniques)]
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class InventorySearchIndex:
+    # - text: trigram -> numbers of the distinct lower-cased Item/Vendor strings containing it, and
+    #   string number -> ids of the rows carrying that string (repeated names are indexed once)
+    # - bitmaps: per Department and per Location value, a boolean array over the id space
+    # - dates: Date Ordered values sorted, with their row ids, for range lookups
+    def __init__(self):
+        self.string_ids = {}
+        self.strings = []
+        self.string_rows = []
+        self.grams = {}
+        self.bitmaps = {col: {} for col in search_index_columns}
+        self.capacity = 0
+        self.dates = np.empty(0, dtype="datetime64[ns]")
+        self.date_ids = np.empty(0, dtype="int64")
+
+    def _grow(self, max_id):
+        if max_id < self.capacity:
+            return
+        self.capacity = max(max_id + 1, 2 * self.capacity, 1024)
+        for bitmaps in self.bitmaps.values():
+            for value, bits in bitmaps.items():
+                bitmaps[value] = np.concatenate([bits, np.zeros(self.capacity - len(bits), dtype=bool)])
+
+    def _string_id(self, text):
+        sid = self.string_ids.get(text)
+        if sid is None:
+            sid = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+            self.string_rows.append(set())
+            for gram in _trigrams(text):
+                self.grams.setdefault(gram, set()).add(sid)
+        return sid
+
+    def add(self, ids, frame):
+        ids = np.asarray(ids, dtype="int64")
+        if not len(ids):
+            return
+        self._grow(int(ids.max()))
+        for col in ("Item", "Vendor"):
+            for text, group in _grouped_ids(frame[col].astype("string").str.lower().to_numpy(dtype=object, na_value=None), ids):
+                self.string_rows[self._string_id(text)].update(group.tolist())
+        for col in search_index_columns:
+            bitmaps = self.bitmaps[col]
+            for value, group in _grouped_ids(frame[col].to_numpy(dtype=object), ids):
+                bits = bitmaps.get(value)
+                if bits is None:
+                    bits = bitmaps[value] = np.zeros(self.capacity, dtype=bool)
+                bits[group] = True
+        dates = frame["Date Ordered"].to_numpy(dtype="datetime64[ns]")
+        known = ~np.isnat(dates)
+        order = np.argsort(dates[known], kind="stable")
+        new_dates, new_ids = dates[known][order], ids[known][order]
+        at = np.searchsorted(self.dates, new_dates, side="right")
+        self.dates = np.insert(self.dates, at, new_dates)
+        self.date_ids = np.insert(self.date_ids, at, new_ids)
+
+    def remove(self, ids, frame):
+        # frame holds the rows as they were indexed
+        ids = np.asarray(ids, dtype="int64")
+        for col in ("Item", "Vendor"):
+            for text, group in _grouped_ids(frame[col].astype("string").str.lower().to_numpy(dtype=object, na_value=None), ids):
+                sid = self.string_ids.get(text)
+                if sid is not None:
+                    self.string_rows[sid].difference_update(group.tolist())
+        for col in search_index_columns:
+            for value, group in _grouped_ids(frame[col].to_numpy(dtype=object), ids):
+                bits = self.bitmaps[col].get(value)
+                if bits is not None:
+                    bits[group] = False
+        keep = ~np.isin(self.date_ids, ids)
+        self.dates, self.date_ids = self.dates[keep], self.date_ids[keep]
+
+    def update(self, ids, before, after):
+        self.remove(ids, before)
+        self.add(ids, after)
+
+    def _text_hits(self, term):
+        # Strings containing term: trigram posting lists intersected (smallest first), then checked
+        if len(term) < 3:
+            candidates = range(len(self.strings))
+        else:
+            postings = sorted((self.grams.get(gram, set()) for gram in _trigrams(term)), key=len)
+            candidates = set.intersection(*postings) if postings[0] else ()
+        return [sid for sid in candidates if term in self.strings[sid] and self.string_rows[sid]]
+
+    def _ids_mask(self, ids):
+        hit = np.zeros(self.capacity, dtype=bool)
+        hit[ids] = True
+        return hit
+
+    def query(self, row_ids, text="", filters=None, date_range=None):
+        # Positions (into row_ids, the table's ids in order) of rows matching every condition: each
+        # word of text in Item or Vendor, one of the chosen values per filtered column, and
+        # Date Ordered within date_range (inclusive; either end may be None)
+        mask = np.ones(len(row_ids), dtype=bool)
+        for col, values in (filters or {}).items():
+            if values:
+                hit = np.zeros(self.capacity, dtype=bool)
+                for value in values:
+                    bits = self.bitmaps[col].get(value)
+                    if bits is not None:
+                        hit |= bits
+                mask &= hit[row_ids]
+        if date_range is not None:
+            start, end = date_range
+            lo = np.searchsorted(self.dates, np.datetime64(start, "ns"), side="left") if start is not None else 0
+            hi = np.searchsorted(self.dates, np.datetime64(end, "ns"), side="right") if end is not None else len(self.dates)
+            mask &= self._ids_mask(self.date_ids[lo:hi])[row_ids]
+        for term in text.lower().split():
+            ids = [row_id for sid in self._text_hits(term) for row_id in self.string_rows[sid]]
+            mask &= self._ids_mask(np.array(ids, dtype="int64"))[row_ids]
+        return np.flatnonzero(mask)
+
+# --- REORDER FORECASTING ---
+# Rows are grouped by (Department, Item). Usage comes from the order log: a row that has never had
+# an upload merged into it is one order of what it holds, and the first merge logs that order plus
+# the merged one (so a row that has absorbed six monthly orders has six entries). A group's usage
+# rate is what it ordered before its latest order spread over the days that lasted or, with only one
+# order on record, comes from the Frequency text. Stock is projected as the latest order's quantity
+# less the use since and compared with Par Level; a Par Level of 0 (uploads that don't carry one) is
+# replaced by the expected use over the lead time. InventoryTable keeps a ReorderEngine current with
+# every write and only the groups touched since the last read are recomputed.
+reorder_lead_days = 7
+reorder_cover_days = 30
+# Orders closer together than this say little about usage; the Frequency text is used instead
+reorder_min_history_days = 14
+frequency_unit_days = {"day": 1.0, "week": 7.0, "month": 30.44, "quarter": 91.31, "year": 365.25}
+frequency_words = {
+    "daily": 1.0, "weekly": 7.0, "biweekly": 14.0, "fortnightly": 14.0, "semimonthly": 15.22,
+    "monthly": 30.44, "bimonthly": 60.88, "quarterly": 91.31, "semiannual": 182.62,
+    "semiannually": 182.62, "biannually": 182.62, "annual": 365.25, "annually": 365.25, "yearly": 365.25,
+}
+_frequency_pattern = re.compile(r"(?:every\s*(\d+)?\s*|(\d+|once|twice)\s*(?:x|times)?\s*(?:a|per|/)\s*)(day|week|month|quarter|year)")
+
+def _frequency_period(text):
+    text = text.lower().strip()
+    days = frequency_words.get(re.sub(r"[^a-z]", "", text))
+    if days is not None:
+        return days
+    match = _frequency_pattern.search(text)
+    if match is None:
+        return np.nan
+    unit = frequency_unit_days[match.group(3)]
+    if match.group(2):
+        count = {"once": 1, "twice": 2}.get(match.group(2)) or int(match.group(2))
+        return unit / count if count else np.nan
+    return unit * int(match.group(1) or 1)
+
+def frequency_days(values):
+    # Days between orders for each Frequency text ("Monthly", "Bi-weekly", "every 3 weeks",
+    # "twice a month"), NaN when unreadable. Each distinct text is parsed once.
+    codes, uniques = pd.factorize(values.astype("string"), use_na_sentinel=True)
+    periods = np.array([_frequency_period(text) for text in uniques] + [np.nan], dtype="float64")
+    return periods[codes]
+
+def reorder_group_keys(frame):
+    return (_merge_text(frame["Department"]) + "\x1f" + _merge_text(frame["Item"])).to_numpy(dtype=object)
+
+def order_log_frame(ids, dates, qty):
+    return pd.DataFrame({
+        "id": np.asarray(ids, dtype="int64"),
+        "date": pd.to_datetime(pd.Series(dates)).to_numpy(dtype="datetime64[ns]"),
+        "qty": np.asarray(qty, dtype="float64"),
+    })
+
+def order_log_changes(before, after):
+    # How an update changes the order log, per row: the quantity of a new order on the new date
+    # (Date Ordered moved later and Qty went up, which is what merging an upload does), whether the
+    # orders after the new date are dropped (the date moved back: a merge was undone), and the
+    # change to the latest order when the date stayed (same-day merges and corrections)
+    qty_before = before["Qty"].astype("float64").fillna(0.0).to_numpy()
+    qty_after = after["Qty"].astype("float64").fillna(0.0).to_numpy()
+    date_before = before["Date Ordered"].reset_index(drop=True)
+    date_after = after["Date Ordered"].reset_index(drop=True)
+    later = ((date_after > date_before) | (date_before.isna() & date_after.notna())).to_numpy()
+    earlier = (date_after < date_before).to_numpy()
+    added = np.where(later & (qty_after > qty_before), qty_after - qty_before, 0.0)
+    corrected = np.where(~later & ~earlier, qty_after - qty_before, 0.0)
+    return added, earlier, corrected
+
+def reorder_group_stats(frame, ids, log):
+    # One row per (Department, Item) group, indexed by group key; none of it depends on today's date.
+    # frame holds the groups' rows, ids their ids (ascending) and log their order log.
+    keys = reorder_group_keys(frame)
+    qty = frame["Qty"].astype("float64")
+    value = frame["Value"].astype("float64")
+    rows = pd.DataFrame({
+        "key": keys,
+        **{col: frame[col].astype(object) for col in ("Department", "Item", "Vendor", "Unit")},
+        "par": frame["Par Level"].astype("float64"),
+        "cost": value.where(value > 0, frame["Total Cost"].astype("float64") / qty.where(qty > 0)),
+        "period": frequency_days(frame["Frequency"]),
+        "date": frame["Date Ordered"],
+    })
+    # Oldest first, so "last" is the latest order's value
+    rows = rows.sort_values("date", kind="stable", na_position="first")
+    stats = rows.groupby("key", sort=False).agg(
+        Department=("Department", "last"), Item=("Item", "last"), Vendor=("Vendor", "last"), Unit=("Unit", "last"),
+        par=("par", "max"), unit_cost=("cost", "last"), period=("period", "last"),
+    )
+    # Rows with nothing logged are one order of what they hold
+    unlogged = ~np.isin(ids, log["id"].to_numpy())
+    log = pd.concat([log, order_log_frame(ids[unlogged], frame["Date Ordered"].to_numpy()[unlogged], qty.fillna(0.0).to_numpy()[unlogged])])
+    # Lines ordered on the same day, in one row or several, are one order
+    orders = pd.DataFrame({"key": keys[np.searchsorted(ids, log["id"].to_numpy())], "date": log["date"].to_numpy(), "qty": log["qty"].to_numpy()})
+    orders = orders.groupby(["key", "date"], sort=False, dropna=False)["qty"].sum().reset_index()
+    by_key = orders.groupby("key", sort=False)
+    last = by_key["date"].transform("max")
+    at_last = orders["date"].eq(last) | last.isna()
+    stats["first"] = by_key["date"].min()
+    stats["last"] = by_key["date"].max()
+    stats["orders"] = by_key["date"].count()
+    stats["order_qty"] = by_key["qty"].mean()
+    stats["last_qty"] = orders["qty"].where(at_last).groupby(orders["key"], sort=False).sum()
+    stats["before_last"] = orders["qty"].where(~at_last).groupby(orders["key"], sort=False).sum()
+    return stats
+
+def reorder_plan(stats, today=None, lead_days=reorder_lead_days, cover_days=reorder_cover_days,
+                 min_history_days=reorder_min_history_days):
+    # The reorder list: groups whose projected stock, less what is used while an order arrives, is at
+    # or below par. Suggested Qty brings stock back to par plus one ordering cycle of use.
+    today = pd.Timestamp(today or datetime.today().date())
+    span = (stats["last"] - stats["first"]).dt.days.astype("float64")
+    history_rate = (stats["before_last"] / span).where(span >= max(min_history_days, 1))
+    rate = history_rate.fillna(stats["order_qty"] / stats["period"])
+    cycle = stats["period"].fillna((span / (stats["orders"] - 1)).where(span > 0)).fillna(cover_days)
+    elapsed = (today - stats["last"]).dt.days.astype("float64").clip(lower=0)
+    projected = (stats["last_qty"].fillna(0) - (rate * elapsed).fillna(0)).clip(lower=0)
+    lead_use = (rate * lead_days).fillna(0)
+    par = stats["par"].where(stats["par"] > 0, np.ceil(rate * lead_days))
+    due = (par > 0) & (projected - lead_use <= par)
+    suggested = np.ceil(par + (rate * cycle).fillna(0) + lead_use - projected).clip(lower=1)
+    plan = pd.DataFrame({
+        "Department": stats["Department"], "Item": stats["Item"], "Vendor": stats["Vendor"], "Unit": stats["Unit"],
+        "Last Order Qty": stats["last_qty"], "Projected": projected.round(1), "Par Level": par,
+        "Daily Use": rate.round(3), "Days Left": ((projected - par) / rate).where(rate > 0).clip(lower=0).round(1),
+        "Last Ordered": stats["last"], "Suggested Qty": suggested, "Unit Cost": stats["unit_cost"].round(2),
+        "Est. Cost": (suggested * stats["unit_cost"]).round(2),
+    })[due.to_numpy()]
+    plan = plan.astype({"Last Order Qty": "Int64", "Par Level": "Int64", "Suggested Qty": "Int64"})
+    return plan.sort_values(["Days Left", "Est. Cost"], ascending=[True, False], na_position="last").reset_index(drop=True)
+
+class ReorderEngine:
+    # Group key -> ids of its rows, the order log (the database's, when there is one), the per-group
+    # stats, the groups changed since they were computed, and the last plan with the arguments it
+    # was made for
+    def __init__(self, log=None):
+        self.group_ids = {}
+        self.log = log if log is not None else order_log_frame([], [], [])
+        self._pending = []
+        self.dirty = set()
+        self.stats = None
+        self.last_plan = None
+
+    def _track(self, ids, frame, present):
+        for key, group in _grouped_ids(reorder_group_keys(frame), np.asarray(ids, dtype="int64")):
+            members = self.group_ids.setdefault(key, set())
+            if present:
+                members.update(group.tolist())
+            else:
+                members.difference_update(group.tolist())
+            self.dirty.add(key)
+
+    def order_log(self):
+        if self._pending:
+            self.log = pd.concat([self.log, *self._pending], ignore_index=True)
+            self._pending = []
+        return self.log
+
+    def add(self, ids, frame):
+        self._track(ids, frame, True)
+
+    def remove(self, ids, frame):
+        # frame holds the rows as they were before; their order log stays for an undo to bring back
+        self._track(ids, frame, False)
+
+    def update(self, ids, before, after):
+        self.remove(ids, before)
+        self.add(ids, after)
+        # The same rules InventoryDB applies to its copy of the log
+        ids = np.asarray(ids, dtype="int64")
+        added, rolled_back, corrected = order_log_changes(before, after)
+        dates = after["Date Ordered"].to_numpy()
+        if (added > 0).any():
+            first = (added > 0) & ~np.isin(ids, self.order_log()["id"].to_numpy())
+            self._pending.append(order_log_frame(
+                ids[first], before["Date Ordered"].to_numpy()[first], before["Qty"].astype("float64").fillna(0.0).to_numpy()[first]
+            ))
+            self._pending.append(order_log_frame(ids[added > 0], dates[added > 0], added[added > 0]))
+        if rolled_back.any() or corrected.any():
+            log = self.order_log()
+            if rolled_back.any():
+                cutoff = pd.Series(dates[rolled_back], index=ids[rolled_back])
+                log = log[~(log["date"] > log["id"].map(cutoff)).to_numpy()].reset_index(drop=True)
+            fix = corrected != 0
+            if fix.any():
+                latest = log[["id", "date"]].reset_index().drop_duplicates(["id", "date"], keep="last")
+                target = pd.DataFrame({"id": ids[fix], "date": dates[fix], "delta": corrected[fix]}).merge(latest, on=["id", "date"])
+                qty = log["qty"].to_numpy(copy=True)
+                qty[target["index"].to_numpy()] = np.maximum(qty[target["index"].to_numpy()] + target["delta"].to_numpy(), 0.0)
+                log = log.assign(qty=qty)
+            self.log = log
+
+    def refresh(self, frame, row_ids):
+        # frame and row_ids are the table's current rows and their ids (ascending)
+        if self.stats is None:
+            self.stats = reorder_group_stats(frame.iloc[:0], row_ids[:0], self.order_log().iloc[:0])
+        if self.dirty:
+            keys = list(self.dirty)
+            ids = np.sort(np.fromiter((i for key in keys for i in self.group_ids.get(key, ())), dtype="int64"))
+            log = self.order_log()
+            fresh = reorder_group_stats(frame.iloc[np.searchsorted(row_ids, ids)], ids, log[np.isin(log["id"].to_numpy(), ids)])
+            if len(self.stats):
+                fresh = pd.concat([self.stats[~self.stats.index.isin(keys)], fresh])
+            self.stats = fresh
+            for key in keys:
+                if not self.group_ids.get(key):
+                    self.group_ids.pop(key, None)
+            self.dirty.clear()
+            self.last_plan = None
+        return self.stats
+
+    def plan(self, frame, row_ids, today=None, *args):
+        today = pd.Timestamp(today or datetime.today().date())
+        stats = self.refresh(frame, row_ids)
+        if self.last_plan is None or self.last_plan[0] != (today, *args):
+            self.last_plan = ((today, *args), reorder_plan(stats, today, *args))
+        return self.last_plan[1]
+
+# Sessions share one InventoryTable per server process (get_inventory_table), each through its own
+# InventoryStore handle that keeps that session's undo/redo history. Writes by other sessions land
+# in the shared table directly; writes by other processes (the ingest command) are folded in from
+# the journal by sync(), which costs one indexed query when nothing has changed.
+inventory_event_history = 200
+inventory_poll_seconds = 5
+
+class InventoryTable:
+    # Typed, columnar inventory with running aggregates. Appends are buffered and merged into the
+    # main frame the next time it is read, so adding single rows does not copy the whole table.
+    # With a database attached every change is written through (before memory is touched) and
+    # journaled, counts come from SQL and the frame itself is only loaded once something needs more
+    # than a page of rows. Rows stay in id order and carry a version that goes up on every update.
+    def __init__(self, db=None):
+        self.db = db
+        self.lock = threading.RLock()
+        self._df = coerce_inventory_frame([])
+        self._ids = np.empty(0, dtype="int64")
+        self._versions = np.empty(0, dtype="int64")
+        self._pending = []
+        self._next_id = 1
+        self.item_count = 0
+        self.total_cost = 0.0
+        self.version = 0
+        self.seq = 0
+        self.loaded = db is None
+        self._import_keys = None
+        self._merge_index = None
+        self._search = None
+        self._reorder = None
+        # (table version, session, label, rows) for every action, newest last
+        self.events = deque(maxlen=inventory_event_history)
+        if db is not None:
+            # seq first: anything written in between is replayed again, which is harmless
+            self.seq = db.seq
+            self.item_count, self.total_cost = db.totals()
+
+    def __len__(self):
+        return self.item_count
+
+    @property
+    def frame(self):
+        with self.lock:
+            if not self.loaded:
+                self._df, self._ids, self._versions = self.db.load_current()
+                self.loaded = True
+            if self._pending:
+                self._df = _concat_inventory_frames([self._df] + [new for new, ids, versions in self._pending])
+                self._ids = np.concatenate([self._ids] + [ids for new, ids, versions in self._pending])
+                self._versions = np.concatenate([self._versions] + [versions for new, ids, versions in self._pending])
+                self._pending = []
+            return self._df
+
+    def page(self, offset, limit):
+        # Rows [offset, offset + limit) in table order, indexed by position
+        if self.loaded:
+            return self.frame.iloc[offset:offset + limit]
+        page_df, ids, versions = self.db.load(limit=limit, offset=offset)
+        page_df.index = pd.RangeIndex(offset, offset + len(page_df))
+        return page_df
+
+    def page_keys(self, offset, limit):
+        # (id, version) of the rows page() returns, without loading the whole table for them
+        with self.lock:
+            if self.loaded:
+                self.frame
+                return list(zip(self._ids[offset:offset + limit].tolist(), self._versions[offset:offset + limit].tolist()))
+        return self.db.load_keys(limit, offset)
+
+    def row(self, idx):
+        # One row as plain Python values, in the same shape the entry forms produce
+        rec = self.frame.iloc[idx]
+        row = {}
+        for col in inventory_columns:
+            val = rec[col]
+            if pd.isna(val):
+                val = None
+            elif col == "Qty" or col == "Par Level":
+                val = int(val)
+            elif col == "Value" or col == "Total Cost":
+                val = float(val)
+            elif col == "Date Ordered":
+                val = val.strftime("%Y-%m-%d")
+            row[col] = val
+        return row
+
+    def row_keys(self, positions):
+        # (id, version) per position: what an edit form or a selection holds on to across reruns
+        with self.lock:
+            self.frame
+            positions = np.asarray(positions, dtype="int64")
+            return list(zip(self._ids[positions].tolist(), self._versions[positions].tolist()))
+
+    def locate(self, ids, versions=None):
+        # Current positions of these rows. InventoryConflict when one is gone or, given the versions
+        # the caller last saw, has been changed since.
+        with self.lock:
+            self.frame
+            ids = np.asarray(ids, dtype="int64")
+            positions = np.searchsorted(self._ids, ids)
+            found = positions < len(self._ids)
+            found[found] = self._ids[positions[found]] == ids[found]
+            if not found.all():
+                raise InventoryConflict(f"{int((~found).sum())} of these rows were deleted by another user")
+            if versions is not None and (self._versions[positions] != np.asarray(versions, dtype="int64")).any():
+                raise InventoryConflict("Some of these rows were changed by another user in the meantime")
+            return positions
+
+    def merge_index(self):
+        # Built on first use, then kept current by every write
+        with self.lock:
+            if self._merge_index is None:
+                df = self.frame
+                self._merge_index = MergeIndex()
+                self._merge_index.add(self._ids, df)
+            return self._merge_index
+
+    def search_index(self):
+        # Built on first use, then kept current by every write
+        with self.lock:
+            if self._search is None:
+                df = self.frame
+                self._search = InventorySearchIndex()
+                self._search.add(self._ids, df)
+            return self._search
+
+    def reorder_list(self, today=None, lead_days=reorder_lead_days, cover_days=reorder_cover_days):
+        # The engine is built on first use (one pass over the table), then only touched groups are redone
+        with self.lock:
+            df = self.frame
+            if self._reorder is None:
+                self._reorder = ReorderEngine(self.db.load_order_log() if self.db is not None else None)
+                self._reorder.add(self._ids, df)
+            return self._reorder.plan(df, self._ids, today, lead_days, cover_days)
+
+    def _indexes(self):
+        # Derived structures that every write keeps current
+        return [index for index in (self._merge_index, self._search, self._reorder) if index is not None]
+
+    def search(self, text="", departments=None, locations=None, date_range=None):
+        # Matching rows in table order, indexed by position
+        with self.lock:
+            # Flush pending appends first so self._ids and the frame cover rows added this rerun
+            df = self.frame
+            index = self.search_index()
+            positions = index.query(self._ids, text, {"Department": departments, "Location": locations}, date_range)
+            return df.iloc[positions]
+
+    @property
+    def import_keys(self):
+        if self._import_keys is None:
+            self._import_keys = self.db.load_import_keys() if self.db is not None else set()
+        return self._import_keys
+
+    def _written(self):
+        # Our own journal record: skip it in sync() unless another process wrote in between
+        if self.db.seq == self.seq + 1:
+            self.seq = self.db.seq
+
+    # Each write returns the step it made, (op, ids, before rows, after rows, versions), for the
+    # caller's undo history; versions are the rows' versions after the write, or for a delete the
+    # versions the rows had
+    def insert_rows(self, new, ids=None, label="add", versions=None):
+        # ids are allocated unless rows are being restored by undo/redo, which keeps their old ids.
+        # Restored rows come back one version past the one they were deleted at (versions), so an
+        # edit based on the row from before the delete is refused.
+        with self.lock:
+            df = self.frame
+            versions = np.ones(len(new), dtype="int64") if versions is None else np.asarray(versions, dtype="int64") + 1
+            if self.db is not None:
+                ids = self.db.insert_frame(new, ids, label, versions)
+                self._written()
+            elif ids is None:
+                ids = np.arange(self._next_id, self._next_id + len(new), dtype="int64")
+            ids = np.asarray(ids, dtype="int64")
+            self._next_id = max(self._next_id, int(ids.max()) + 1)
+            if not len(self._ids) or ids.min() > self._ids[-1]:
+                self._pending.append((new, ids, versions))
+            else:
+                # Restored rows slot back into their place in id order
+                all_ids = np.concatenate([self._ids, ids])
+                order = np.argsort(all_ids, kind="stable")
+                self._df = _concat_inventory_frames([df, new.copy()]).iloc[order].reset_index(drop=True)
+                self._ids = all_ids[order]
+                self._versions = np.concatenate([self._versions, versions])[order]
+            for index in self._indexes():
+                index.add(ids, new)
+            self.item_count += len(new)
+            self.total_cost += float(new["Total Cost"].sum())
+            self.version += 1
+            return "insert", ids, None, new, versions
+
+    def update_rows(self, positions, after, label="edit"):
+        # after holds the complete new rows, aligned with positions
+        with self.lock:
+            df = self.frame
+            positions = np.asarray(positions, dtype="int64")
+            ids = self._ids[positions]
+            versions = self._versions[positions]
+            before = df.iloc[positions].reset_index(drop=True)
+            after = after.reset_index(drop=True)
+            if self.db is not None:
+                self.db.update_frame(after, ids, versions, label, before)
+                self._written()
+            for col in inventory_columns:
+                values = after[col]
+                if col in inventory_category_columns:
+                    missing = pd.Index(values.dropna().unique()).difference(df[col].cat.categories)
+                    if len(missing):
+                        df[col] = df[col].cat.add_categories(missing)
+                df.iloc[positions, df.columns.get_loc(col)] = values.to_numpy()
+            self._versions[positions] = versions + 1
+            for index in self._indexes():
+                index.update(ids, before, after)
+            self.total_cost += float(after["Total Cost"].sum()) - float(before["Total Cost"].sum())
+            self.version += 1
+            return "update", ids, before, after, versions + 1
+
+    def delete_rows(self, positions, label="delete"):
+        with self.lock:
+            df = self.frame
+            positions = np.unique(np.asarray(positions, dtype="int64"))
+            ids = self._ids[positions]
+            versions = self._versions[positions]
+            before = df.iloc[positions].reset_index(drop=True)
+            if self.db is not None:
+                self.db.delete_ids(ids, versions, label)
+                self._written()
+            self.total_cost -= float(before["Total Cost"].sum())
+            self._df = df.drop(index=positions).reset_index(drop=True)
+            self._ids = np.delete(self._ids, positions)
+            self._versions = np.delete(self._versions, positions)
+            for index in self._indexes():
+                index.remove(ids, before)
+            self.item_count -= len(positions)
+            self.version += 1
+            return "delete", ids, before, None, versions
+
+    def record_import_keys(self, keys):
+        with self.lock:
+            keys = [k for k in keys if k not in self.import_keys]
+            if not keys:
+                return None
+            if self.db is not None:
+                self.db.add_import_keys(keys)
+            self.import_keys.update(keys)
+            return "keys", keys, None, None, None
+
+    def forget_import_keys(self, keys):
+        with self.lock:
+            if self.db is not None:
+                self.db.remove_import_keys(keys)
+            self.import_keys.difference_update(keys)
+            return "unkeys", keys, None, None, None
+
+    def apply(self, step, label):
+        # Replays an undo/redo step by row id, refusing rows that changed since the step was made
+        op, ids, before, after, versions = step
+        with self.lock:
+            if op == "insert":
+                return self.insert_rows(after, ids, label, versions)
+            if op == "delete":
+                return self.delete_rows(self.locate(ids, versions), label)
+            if op == "update":
+                return self.update_rows(self.locate(ids, versions), after, label)
+            if op == "keys":
+                return self.record_import_keys(ids)
+            return self.forget_import_keys(ids)
+
+    def publish(self, session, label, rows):
+        with self.lock:
+            self.events.append((self.version, session, label, rows))
+
+    def sync(self):
+        # Fold in what other processes wrote since we last looked; only the changed rows are touched
+        if self.db is None:
+            return
+        with self.lock:
+            records = self.db.journal_since(self.seq)
+            if not records:
+                return
+            if any(rec[1] == "compact" for rec in records):
+                # We fell behind a journal compaction, so some changes are no longer there to replay
+                self.loaded = False
+                self._pending = []
+                self._merge_index = None
+                self._search = None
+                self._reorder = None
+            elif self.loaded:
+                self.frame
+                self._df, self._ids, self._versions = replay_journal(
+                    self._df, self._ids, self._versions, [rec[1:4] for rec in records]
+                )
+                self._next_id = max(self._next_id, int(self._ids.max()) + 1) if len(self._ids) else self._next_id
+                # Rare (another process wrote): rebuilt on next use
+                self._merge_index = None
+                self._search = None
+                self._reorder = None
+            self.item_count, self.total_cost = self.db.totals()
+            self.seq = records[-1][0]
+            self._import_keys = None
+            self.version += 1
+            labels = ", ".join(dict.fromkeys(rec[5] for rec in records if rec[5] is not None))
+            self.events.append((self.version, None, labels, sum(rec[4] for rec in records)))
+
+@st.cache_resource
+def get_inventory_table():
+    return InventoryTable(get_inventory_db())
+
+class InventoryStore:
+    # One session's handle on an InventoryTable (a private one unless a shared table is passed):
+    # the table API plus this session's undo/redo history and change notifications. Undo and redo
+    # replay just the rows an action touched, and refuse rows someone else has changed since.
+    def __init__(self, rows=None, db=None, table=None, session=None):
+        self.table = table if table is not None else InventoryTable(db)
+        self.session = session or uuid.uuid4().hex[:8]
+        self.seen_version = self.table.version
+        self._undo = deque(maxlen=journal_undo_depth)
+        self._redo = deque(maxlen=journal_undo_depth)
+        self._group = None
+        if rows is not None and len(rows):
+            self.bulk_insert(rows)
+            self._undo.clear()
+
+    def __getattr__(self, name):
+        # Reads (frame, page, row, item_count, total_cost, version, db, ...) go to the table
+        if name == "table":
+            raise AttributeError(name)
+        return getattr(self.table, name)
+
+    def __len__(self):
+        return self.table.item_count
+
+    def sync(self):
+        self.table.sync()
+
+    def notifications(self):
+        # (label, rows) for what other sessions and processes did since this session last asked
+        with self.table.lock:
+            events = [(label, rows) for version, session, label, rows in self.table.events
+                      if version > self.seen_version and session != self.session]
+            self.seen_version = self.table.version
+        return events
+
+    def append(self, row):
+        self._record("add", self.table.insert_rows(coerce_inventory_frame([row]), label="add"))
+
+    def bulk_insert(self, rows, label="import"):
+        new = coerce_inventory_frame(rows)
+        if len(new):
+            self._record(label, self.table.insert_rows(new, label=label))
+
+    def update(self, idx, row):
+        self._record("edit", self.table.update_rows([idx], coerce_inventory_frame([row]), label="edit"))
+
+    def delete(self, idx):
+        with self.table.lock:
+            row = self.table.row(idx)
+            self._record("delete", self.table.delete_rows([idx], label="delete"))
+        return row
+
+    def update_many(self, indices, values):
+        # Set the same field values on several rows; Total Cost follows Qty x Value like the edit form
+        indices = list(indices)
+        with self.table.lock:
+            after = coerce_inventory_frame(self.table.frame.iloc[indices].assign(**values))
+            if "Qty" in values or "Value" in values:
+                after["Total Cost"] = (after["Qty"].astype(float) * after["Value"]).fillna(0.0)
+            self._record("bulk edit", self.table.update_rows(indices, after, label="bulk edit"))
+
+    def delete_many(self, indices):
+        self._record("delete", self.table.delete_rows(list(indices), label="delete"))
+
+    # Key-based versions for the UI, where rows were picked on an earlier rerun: (id, version) keys
+    # from row_keys() raise InventoryConflict if another session got there first
+    def edit_row(self, key, row):
+        with self.table.lock:
+            self.update(self.table.locate([key[0]], [key[1]])[0], row)
+
+    def edit_rows(self, keys, values):
+        with self.table.lock:
+            self.update_many(self.table.locate(*zip(*keys)), values)
+
+    def remove_rows(self, keys):
+        with self.table.lock:
+            self.delete_many(self.table.locate(*zip(*keys)))
+
+    def accumulate(self, positions, updates):
+        # Fold uploaded lines into existing rows (one update row per position): Qty and Total Cost
+        # add up, the newer price and the later order date win
+        positions = np.asarray(positions, dtype="int64")
+        with self.table.lock:
+            current = self.table.frame.iloc[positions].reset_index(drop=True)
+            updates = updates.reset_index(drop=True)
+            qty = current["Qty"].fillna(0) + updates["Qty"].fillna(0)
+            merged = {
+                "Qty": qty.where(current["Qty"].notna() | updates["Qty"].notna()),
+                "Total Cost": current["Total Cost"].fillna(0.0) + updates["Total Cost"].fillna(0.0),
+                "Value": updates["Value"].where(updates["Value"].notna(), current["Value"]),
+                "Date Ordered": current["Date Ordered"].where(current["Date Ordered"] >= updates["Date Ordered"], updates["Date Ordered"])
+                                                       .fillna(current["Date Ordered"]),
+            }
+            self._record("merge", self.table.update_rows(positions, current.assign(**merged), label="merge"))
+
+    def record_import_keys(self, keys):
+        self._record("import", self.table.record_import_keys(keys))
+
+    # --- undo / redo ---
+    def _record(self, label, step):
+        if step is None:
+            return
+        if self._group is not None:
+            self._group[1].append(step)
+        else:
+            self._push(label, [step])
+
+    def _push(self, label, steps):
+        self._undo.append((label, steps))
+        self._redo.clear()
+        self.table.publish(self.session, label, sum(len(step[1]) for step in steps if step[0] not in ("keys", "unkeys")))
+
+    @contextmanager
+    def operation(self, label):
+        # Steps made inside (an upload merge, an allocation) undo and redo as one action, and no
+        # other session writes in between
+        if self._group is not None:
+            yield
+            return
+        with self.table.lock:
+            self._group = (label, [])
+            try:
+                yield
+            finally:
+                label, steps = self._group
+                self._group = None
+                if steps:
+                    self._push(label, steps)
+
+    @staticmethod
+    def _inverse(step):
+        op, ids, before, after, versions = step
+        inverse_op = {"insert": "delete", "delete": "insert", "update": "update", "keys": "unkeys", "unkeys": "keys"}[op]
+        return inverse_op, ids, after, before, versions
+
+    def _replay(self, steps, label):
+        # All or nothing: if a row turns out to have changed, the steps already made are reverted
+        done = []
+        with self.table.lock:
+            try:
+                for step in steps:
+                    done.append(self.table.apply(step, label))
+            except InventoryConflict:
+                for step in reversed(done):
+                    self.table.apply(self._inverse(step), label)
+                raise
+        self.table.publish(self.session, label, sum(len(step[1]) for step in done if step[0] not in ("keys", "unkeys")))
+        return done
+
+    @property
+    def undo_label(self):
+        return self._undo[-1][0] if self._undo else None
+
+    @property
+    def redo_label(self):
+        return self._redo[-1][0] if self._redo else None
+
+    def undo(self):
+        # Reverts the last action; costs only the rows it touched
+        if not self._undo:
+            return None
+        label, steps = self._undo[-1]
+        done = self._replay([self._inverse(step) for step in reversed(steps)], f"undo {label}")
+        self._undo.pop()
+        self._redo.append((label, done))
+        return label
+
+    def redo(self):
+        if not self._redo:
+            return None
+        label, steps = self._redo[-1]
+        done = self._replay([self._inverse(step) for step in reversed(steps)], f"redo {label}")
+        self._redo.pop()
+        self._undo.append((label, done))
+        return label
+
+# --- UPLOAD MERGE ---
+# Uploaded lines fold into the existing row with the same (Department, Vendor, Item, Unit) instead of
+# adding a duplicate. Lookups go through a hash index; Amazon titles that differ only slightly are
+# matched fuzzily within the (Department, Vendor, Unit) block, and only among titles with the same
+# numbers and sizes. Fuzzy matches are proposals: they merge only when confirmed (confirmed=None
+# accepts them all). Every source line carries an idempotency key, so re-importing a file (or an
+# overlapping export) is a no-op.
+merge_key_columns = ["Department", "Vendor", "Item", "Unit"]
+merge_fuzzy_threshold = 0.9
+merge_size_words = {
+    "xxs", "xs", "s", "sm", "m", "med", "l", "lg", "xl", "xxl", "xxxl", "small", "medium", "large",
+    "xsmall", "xxsmall", "xlarge", "xxlarge", "xxxlarge", "mini", "petite", "regular", "jumbo",
+    "adult", "pediatric", "child", "infant", "junior",
+}
+merge_unit_words = {
+    "ml", "l", "cc", "mg", "mcg", "g", "kg", "oz", "fl", "lb", "lbs", "mm", "cm", "in", "inch", "ft",
+    "ct", "count", "pk", "pack", "ga", "gauge",
+}
+upload_order_columns = ["Order ID", "Order Number", "PO Number"]
+
+def _sum_or_na(values):
+    return values.sum(min_count=1)
+
+# How several lines for one row combine (same rules as InventoryStore.accumulate)
+merge_fold_aggregations = {"Qty": _sum_or_na, "Total Cost": "sum", "Value": "last", "Date Ordered": "max"}
+
+def _merge_text(values):
+    text = values.astype("string").fillna("").str.lower()
+    return text.str.replace(r"[^0-9a-z]+", " ", regex=True).str.strip()
+
+def merge_keys(frame):
+    # Normalized (Department, Vendor, Item, Unit) tuples, one per row
+    return list(zip(*(_merge_text(frame[col]).tolist() for col in merge_key_columns)))
+
+def variant_tokens(title):
+    # Numbers (with the unit that follows) and size words of a normalized title, in order. Titles that
+    # differ in any of them ("3 ml"/"5 ml", "large"/"x large", "size m"/"size s") are different
+    # products however similar the rest of the text is.
+    words = re.sub(r"\b(x+|extra) (small|large)\b", r"\1\2", title).split()
+    tokens = []
+    for i, word in enumerate(words):
+        if word.isdigit():
+            unit = words[i + 1] if i + 1 < len(words) and words[i + 1] in merge_unit_words else ""
+            tokens.append(str(int(word)) + unit)
+        elif any(c.isdigit() for c in word) or word in merge_size_words:
+            tokens.append(word)
+    return tuple(tokens)
+
+def merge_block(key):
+    # Fuzzy candidates share department, vendor, unit and the title's numbers and sizes
+    return key[0], key[1], key[3], variant_tokens(key[2])
+
+class MergeIndex:
+    # - exact: merge key -> ids of the rows with that key (the lowest id is the one merged into)
+    # - blocks: merge_block(key) -> {key: title} of the keys present, the fuzzy candidates
+    # Kept current by InventoryTable's writes, like the search index
+    def __init__(self):
+        self.exact = {}
+        self.blocks = {}
+
+    def add(self, ids, frame):
+        for row_id, key in zip(np.asarray(ids, dtype="int64").tolist(), merge_keys(frame)):
+            members = self.exact.get(key)
+            if members is None:
+                members = self.exact[key] = set()
+                self.blocks.setdefault(merge_block(key), {})[key] = key[2]
+            members.add(row_id)
+
+    def remove(self, ids, frame):
+        # frame holds the rows as they were indexed
+        for row_id, key in zip(np.asarray(ids, dtype="int64").tolist(), merge_keys(frame)):
+            members = self.exact.get(key)
+            if members is None:
+                continue
+            members.discard(row_id)
+            if not members:
+                del self.exact[key]
+                block = merge_block(key)
+                self.blocks[block].pop(key, None)
+                if not self.blocks[block]:
+                    del self.blocks[block]
+
+    def update(self, ids, before, after):
+        self.remove(ids, before)
+        self.add(ids, after)
+
+    def lookup(self, key):
+        # Id of the row this key merges into, or None
+        members = self.exact.get(key)
+        return min(members) if members else None
+
+    def candidates(self, key):
+        # (key, title) of the rows a title may match fuzzily
+        return self.blocks.get(merge_block(key), {}).items()
+
+def fuzzy_match(title, candidates, threshold=merge_fuzzy_threshold):
+    # Best of the (candidate, title) pairs for a title, or None. The length and character-count
+    # upper bounds rule out most of the block before the full ratio is computed.
+    best, best_score = None, threshold
+    for candidate, other in candidates:
+        matcher = difflib.SequenceMatcher(None, title, other, autojunk=False)
+        if matcher.real_quick_ratio() < best_score or matcher.quick_ratio() < best_score:
+            continue
+        score = matcher.ratio()
+        if score >= best_score:
+            best, best_score = candidate, score
+    return best
+
+def upload_line_keys(df_upload, col_map, source):
+    # One idempotency key per source line: the order id column (when the export has one) plus the
+    # mapped source values, hashed; repeated identical lines in one file get an occurrence number
+    columns = [c for c in upload_order_columns if c in df_upload.columns]
+    columns += [c for c in dict.fromkeys(col_map.values()) if c and c in df_upload.columns and c not in columns]
+    if not columns:
+        return None
+    parts = df_upload[columns].astype("string").fillna("").reset_index(drop=True)
+    hashes = pd.util.hash_pandas_object(parts, index=False)
+    occurrence = hashes.groupby(hashes).cumcount()
+    return pd.Series([f"{source}:{h:016x}:{n}" for h, n in zip(hashes.to_numpy(), occurrence.to_numpy())], index=parts.index)
+
+def plan_upload_merge(store, rows, keys=None, fuzzy=True, threshold=merge_fuzzy_threshold, confirmed=None):
+    # Per row: action ("skip" already imported, "update" exact match, "fuzzy" near-duplicate title,
+    # "insert" new), the existing position it merges into (target) or, for lines matching an earlier
+    # new line of the same upload, that line's row number (batch_target). With confirmed (row
+    # positions), only those rows may match fuzzily; the others are planned as new lines.
+    n = len(rows)
+    action = np.full(n, "insert", dtype=object)
+    target = np.full(n, -1, dtype="int64")
+    batch_target = np.full(n, -1, dtype="int64")
+    if keys is not None and len(keys):
+        seen = store.import_keys
+        action[np.array([k in seen for k in keys], dtype=bool)] = "skip"
+    index = store.merge_index()
+    batch_exact, batch_blocks = {}, {}
+    for i, key in enumerate(merge_keys(rows)):
+        if action[i] == "skip":
+            continue
+        block = merge_block(key)
+        row_id = index.lookup(key)
+        if row_id is not None:
+            action[i], target[i] = "update", row_id
+            continue
+        may_fuzzy = fuzzy and bool(key[2]) and (confirmed is None or i in confirmed)
+        if may_fuzzy:
+            similar = fuzzy_match(key[2], index.candidates(key), threshold)
+            if similar is not None:
+                action[i], target[i] = "fuzzy", index.lookup(similar)
+                continue
+        first = batch_exact.get(key)
+        if first is None and may_fuzzy:
+            first = fuzzy_match(key[2], batch_blocks.get(block, ()), threshold)
+        if first is not None:
+            action[i], batch_target[i] = ("update" if key in batch_exact else "fuzzy"), first
+            continue
+        batch_exact[key] = i
+        batch_blocks.setdefault(block, []).append((i, key[2]))
+    # The index works in row ids; callers get positions
+    matched = target >= 0
+    target[matched] = store.locate(target[matched])
+    return pd.DataFrame({"action": action, "target": target, "batch_target": batch_target}, index=rows.index)
+
+def merge_upload_rows(store, rows, keys=None, fuzzy=True, threshold=merge_fuzzy_threshold, confirmed=None):
+    # Applies plan_upload_merge(): matched lines accumulate into their rows, the rest are inserted
+    # with later matching lines of the same upload folded in. Returns the number of lines per action.
+    rows = coerce_inventory_frame(rows)
+    keys = list(keys) if keys is not None else None
+    # Planned and applied under the table lock, so the target positions cannot shift in between
+    with store.operation(f"import of {len(rows)} row(s)"):
+        plan = plan_upload_merge(store, rows, keys, fuzzy, threshold, confirmed)
+        _apply_upload_merge(store, rows, keys, plan)
+    return plan["action"].value_counts().reindex(["insert", "update", "fuzzy", "skip"], fill_value=0).to_dict()
+
+def _apply_upload_merge(store, rows, keys, plan):
+    matched = (plan["target"] >= 0).to_numpy()
+    if matched.any():
+        updates = rows[matched].assign(target=plan["target"].to_numpy()[matched])
+        folded = updates.groupby("target", sort=True).agg(merge_fold_aggregations)
+        store.accumulate(folded.index.to_numpy(), folded)
+    new = (plan["action"] != "skip").to_numpy() & ~matched
+    if new.any():
+        # Each new line heads its own group; batch matches join the group of the line they matched
+        group = np.where(plan["batch_target"].to_numpy() >= 0, plan["batch_target"].to_numpy(), np.arange(len(rows)))
+        heads = rows[new & (plan["batch_target"].to_numpy() < 0)]
+        folded = rows[new].groupby(group[new], sort=True).agg(merge_fold_aggregations)
+        heads = heads.copy()
+        for col in folded.columns:
+            heads[col] = folded[col].to_numpy()
+        store.bulk_insert(heads)
+    if keys is not None and len(keys):
+        store.record_import_keys([k for k, a in zip(keys, plan["action"]) if a != "skip"])
+
+# --- MCKESSON STREAMING INGESTION ---
+# McKesson exports are read in fixed-size chunks and only the date and cost columns are kept,
+# so peak memory depends on the chunk size rather than the file size.
+mckesson_chunk_rows = 50000
+
+class McKessonLines:
+    # Compact array-backed (date, cost, remaining) invoice lines
+    def __init__(self, dates=None, costs=None):
+        self.dates = np.asarray(dates if dates is not None else [], dtype="datetime64[D]")
+        self.costs = np.asarray(costs if costs is not None else [], dtype="float64")
+        self.remaining = self.costs.copy()
+
+    def __len__(self):
+        return len(self.costs)
+
+    def entry(self, idx):
+        return {
+            'Date Ordered': pd.Timestamp(self.dates[idx]).date(),
+            'Total Cost': float(self.costs[idx]),
+            'Remaining': float(self.remaining[idx])
+        }
+
+def parse_column_spec(spec):
+    # "F" -> positional index 5; anything else is treated as a header name
+    spec = str(spec).strip()
+    if spec.isalpha() and spec.isupper() and len(spec) <= 2:
+        pos = 0
+        for ch in spec:
+            pos = pos * 26 + (ord(ch) - ord('A') + 1)
+        return pos - 1
+    return spec
+
+def _resolve_positions(header_row, columns):
+    header_row = [str(h).strip() if h is not None else None for h in header_row]
+    positions = []
+    for col in columns:
+        if isinstance(col, int):
+            positions.append(col)
+        elif col in header_row:
+            positions.append(header_row.index(col))
+        else:
+            raise ValueError(f"Column '{col}' not found in file header")
+    return positions
+
+def iter_report_columns(data, name, columns, header=0, chunksize=mckesson_chunk_rows):
+    # Yield DataFrames holding only the requested columns (positions or header names), chunk by chunk.
+    # Positions past the last column come back as empty values.
+    if name.endswith('.csv'):
+        header_row = list(pd.read_csv(io.BytesIO(data), header=header, nrows=0).columns)
+        positions = _resolve_positions(header_row, columns)
+        usecols = sorted({p for p in positions if p < len(header_row)})
+        # Column 0 is still read when nothing else exists, so the row count is preserved
+        for chunk in pd.read_csv(io.BytesIO(data), header=header, usecols=usecols or [0], chunksize=chunksize):
+            by_pos = dict(zip(usecols, (chunk.iloc[:, i] for i in range(len(usecols)))))
+            yield pd.DataFrame({i: by_pos.get(p, pd.Series(None, index=chunk.index, dtype=object)) for i, p in enumerate(positions)})
+    elif name.endswith('.xls'):
+        # xlrd has no row streaming; read only the needed columns and hand them out in slices
+        df = pd.read_excel(io.BytesIO(data), engine='xlrd', header=header)
+        positions = _resolve_positions(list(df.columns), columns)
+        df = pd.DataFrame({i: df.iloc[:, p] if p < df.shape[1] else pd.Series(None, index=df.index, dtype=object) for i, p in enumerate(positions)})
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+    else:
+        wb = lazy_import("openpyxl").load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            for _ in range(header):
+                next(rows, None)
+            positions = _resolve_positions(next(rows, ()), columns)
+            batch = []
+            for row in rows:
+                if all(v is None for v in row):
+                    continue
+                batch.append([row[p] if p < len(row) else None for p in positions])
+                if len(batch) >= chunksize:
+                    yield pd.DataFrame(batch, dtype=object)
+                    batch = []
+            if batch:
+                yield pd.DataFrame(batch, dtype=object)
+        finally:
+            wb.close()
+
+def read_mckesson_report(data, name, date_column=5, cost_column=7, chunksize=mckesson_chunk_rows, header=None):
+    # Defaults are columns F (date) and H (cost). Unparseable dates become today, costs 0.0.
+    today = pd.Timestamp(datetime.today().date())
+    if header is None:
+        header = 1 if not (name.endswith('.csv') or name.endswith('.xls')) else 0
+    dates, costs = [], []
+    for chunk in iter_report_columns(data, name, [date_column, cost_column], header=header, chunksize=chunksize):
+        chunk_dates, _ = _coerce_date_column(chunk.iloc[:, 0].reset_index(drop=True), today)
+        chunk_costs, _ = _coerce_float_column(chunk.iloc[:, 1].reset_index(drop=True))
+        dates.append(chunk_dates.to_numpy(dtype="datetime64[D]"))
+        costs.append(chunk_costs.fillna(0.0).to_numpy(dtype="float64"))
+    if not dates:
+        return McKessonLines()
+    return McKessonLines(np.concatenate(dates), np.concatenate(costs))
+
+# --- MCKESSON COST ALLOCATION ---
+allocation_plan_columns = ["Line", "Date Ordered", "Department", "Vendor", "Item", "Location", "Unit", "Qty", "Value", "Total Cost"]
+
+def department_spend_shares(history, vendor=None):
+    # Share of past Total Cost per department, for this vendor when it has history. Equal split otherwise.
+    departments = manual_entry_fields[0][2]
+    spend = history.loc[history["Total Cost"] > 0, ["Department", "Vendor", "Total Cost"]]
+    if vendor and (spend["Vendor"] == vendor).any():
+        spend = spend[spend["Vendor"] == vendor]
+    totals = spend.groupby("Department", observed=True)["Total Cost"].sum().reindex(departments, fill_value=0.0)
+    if totals.sum() <= 0:
+        totals = pd.Series(1.0, index=departments)
+    return totals / totals.sum()
+
+def propose_mckesson_allocation(lines, template, vendor="McKesson"):
+    # Split the unallocated cost of every open line across the template's departments in one pass.
+    # template: DataFrame with Department, Share and optional Item/Location defaults.
+    template = template[template["Share"] > 0].reset_index(drop=True)
+    open_idx = np.flatnonzero(lines.remaining > 0.005)
+    if not len(open_idx) or not len(template):
+        return pd.DataFrame(columns=allocation_plan_columns)
+    weights = template["Share"].to_numpy(dtype="float64")
+    weights = weights / weights.sum()
+    remaining = lines.remaining[open_idx]
+    amounts = np.round(remaining[:, None] * weights[None, :], 2)
+    # Rounding leftovers go to the last department so each line still sums to its cost
+    amounts[:, -1] += np.round(remaining - amounts.sum(axis=1), 2)
+    n_dept = len(template)
+    plan = pd.DataFrame({
+        "Line": np.repeat(open_idx + 1, n_dept),
+        "Date Ordered": np.repeat(lines.dates[open_idx], n_dept).astype("datetime64[ns]"),
+        "Department": np.tile(template["Department"].to_numpy(dtype=object), len(open_idx)),
+        "Vendor": vendor,
+        "Item": np.tile(template.get("Item", pd.Series("", index=template.index)).fillna("").to_numpy(dtype=object), len(open_idx)),
+        "Location": np.tile(template.get("Location", pd.Series(None, index=template.index)).to_numpy(dtype=object), len(open_idx)),
+        "Unit": "",
+        "Qty": 0,
+        "Value": 0.0,
+        "Total Cost": amounts.ravel(),
+    })
+    return plan[plan["Total Cost"] > 0].reset_index(drop=True)
+
+def apply_mckesson_allocation(store, lines, plan):
+    # Validate and commit a (possibly edited) plan: one bulk insert, remaining costs reduced per line
+    plan = plan.dropna(subset=["Line"])
+    plan = plan[plan["Total Cost"].fillna(0) > 0]
+    line_idx = plan["Line"].astype(int).to_numpy() - 1
+    if ((line_idx < 0) | (line_idx >= len(lines))).any():
+        raise ValueError("Plan refers to a line that is not in this report")
+    allocated = np.bincount(line_idx, weights=plan["Total Cost"].to_numpy(dtype="float64"), minlength=len(lines))
+    over = np.flatnonzero(allocated > lines.remaining + 0.005)
+    if len(over):
+        raise ValueError(f"Allocation exceeds the remaining cost on line(s) {', '.join(str(i + 1) for i in over[:10])}")
+    store.bulk_insert(plan.drop(columns=["Line"]), label="McKesson allocation")
+    lines.remaining = np.round(lines.remaining - allocated, 2)
+    return len(plan)
+
+def load_allocation_template(store, vendor):
+    if store.db is not None:
+        return store.db.load_allocation_template(vendor)
+    return st.session_state.setdefault('allocation_templates', {}).get(vendor)
+
+def save_allocation_template(store, vendor, template):
+    if store.db is not None:
+        store.db.save_allocation_template(vendor, template)
+    else:
+        st.session_state.setdefault('allocation_templates', {})[vendor] = template.copy()
+
 # --- LOGIN PAGE ---
 def login():
     st.title("MAP Inventory Portal Login")
@@ -33,6 +2069,138 @@ def login():
         else:
             st.error("Invalid credentials")
 
+# --- UPLOAD REVIEW ---
+def _finish_upload_review(uploaded_report):
+    st.session_state.upload_review_rows = []
+    st.session_state.upload_merge_plan = None
+    st.session_state.upload_review_keys = None
+    st.session_state.upload_review_idx = 0
+    st.session_state.upload_committed = upload_key(uploaded_report)
+
+def review_upload_rows(uploaded_report):
+    # Shared review step for Amazon and Inventory Report uploads. Returns True once every row is added.
+    rows = st.session_state.upload_review_rows
+    if not len(rows):
+        return False
+    store = st.session_state.inventory_store
+    keys = st.session_state.get("upload_review_keys")
+    mode = st.radio("Review mode", ["Batch", "One at a time"], horizontal=True, key="upload_review_mode")
+    fuzzy = st.checkbox("Suggest merging near-duplicate titles into existing items", value=True, key="upload_merge_fuzzy")
+    if mode == "Batch" and st.session_state.upload_review_idx == 0:
+        with st.expander("Auto-accept rules"):
+            rules = {name: st.checkbox(label, value=True, key=f"upload_rule_{name}") for name, label in upload_validation_rules.items()}
+            price_band = st.number_input("Allowed price deviation (x historical median)", min_value=1.0, value=3.0, step=0.5, key="upload_rule_price_band_factor")
+        with timed_phase("upload_validate", rows=len(rows)):
+            flags = validate_upload_rows(rows, st.session_state.upload_review_errors, rules, store.frame, price_band)
+        flagged = flags.any(axis=1)
+        st.info(f"{int((~flagged).sum())} row(s) pass all rules and will be accepted. {int(flagged.sum())} row(s) need review.")
+        # The plan (fuzzy matching included) is reused across reruns until the upload, its mapped rows
+        # or the inventory change
+        plan_key = (upload_key(uploaded_report), store.version, fuzzy, int(pd.util.hash_pandas_object(rows, index=False).sum()))
+        cached = st.session_state.get("upload_merge_plan")
+        if cached is None or cached[0] != plan_key:
+            with timed_phase("upload_merge_plan", rows=len(rows)):
+                cached = (plan_key, plan_upload_merge(store, rows, keys, fuzzy))
+            st.session_state.upload_merge_plan = cached
+        plan = cached[1]
+        actions = plan["action"].value_counts()
+        st.caption(f"Of the uploaded rows: {actions.get('insert', 0)} new, {actions.get('update', 0)} merged into matching items, "
+                   f"{actions.get('fuzzy', 0)} with a similar title (merged only if ticked below), {actions.get('skip', 0)} already imported and skipped.")
+        similar = None
+        proposals = plan[plan["action"] == "fuzzy"]
+        if len(proposals):
+            existing = store.frame["Item"]
+            similar = st.data_editor(
+                pd.DataFrame({
+                    "Merge": False,
+                    "Uploaded Item": rows.loc[proposals.index, "Item"],
+                    "Similar Item": [existing.iloc[t] if t >= 0 else rows["Item"].iloc[b]
+                                     for t, b in zip(proposals["target"], proposals["batch_target"])],
+                    "Found In": np.where(proposals["target"] >= 0, "inventory", "this upload"),
+                }, index=proposals.index),
+                key="upload_fuzzy_editor",
+                hide_index=True,
+                disabled=["Uploaded Item", "Similar Item", "Found In"],
+            )
+        edited = None
+        if flagged.any():
+            review = rows[flagged].copy()
+            review.insert(0, "Include", True)
+            review.insert(1, "Issues", describe_rule_failures(flags[flagged]))
+            edited = st.data_editor(
+                review,
+                key="upload_batch_editor",
+                disabled=["Issues"],
+                column_config={
+                    "Department": st.column_config.SelectboxColumn("Department", options=manual_entry_fields[0][2]),
+                    "Location": st.column_config.SelectboxColumn("Location", options=manual_entry_fields[3][2]),
+                    "Date Ordered": st.column_config.DateColumn("Date Ordered", format="YYYY-MM-DD"),
+                },
+            )
+        if st.button("Commit Batch", key="commit_upload_batch"):
+            accepted = rows[~flagged]
+            if edited is not None:
+                corrected = edited[edited["Include"]].drop(columns=["Include", "Issues"])
+                accepted = pd.concat([accepted, corrected]).sort_index()
+            # The whole batch is merged into the store as one operation
+            accepted_keys = keys.loc[accepted.index] if keys is not None else None
+            # Ticked similar-title rows, as positions in the accepted frame
+            ticked = similar.index[similar["Merge"]] if similar is not None else []
+            confirmed = set(np.flatnonzero(accepted.index.isin(ticked)).tolist())
+            with timed_phase("upload_commit", rows=len(accepted)):
+                counts = merge_upload_rows(store, accepted.reset_index(drop=True), accepted_keys, fuzzy, confirmed=confirmed)
+            message = f"Added {counts['insert']} new entries and merged {counts['update'] + counts['fuzzy']} into existing items."
+            if counts['skip']:
+                message += f" Skipped {counts['skip']} line(s) already imported."
+            st.success(message)
+            _finish_upload_review(uploaded_report)
+            st.session_state.need_rerun = True
+            return True
+        return False
+    # Step-by-step review UI
+    if st.session_state.upload_review_idx < len(rows):
+        idx = st.session_state.upload_review_idx
+        entry = normalized_row_to_entry(rows, idx)
+        similar = None
+        if fuzzy:
+            proposal = plan_upload_merge(store, rows.iloc[[idx]], keys.iloc[[idx]] if keys is not None else None, fuzzy).iloc[0]
+            if proposal["action"] == "fuzzy":
+                similar = store.frame["Item"].iloc[proposal["target"]]
+        with st.form(f"review_row_form_{idx}"):
+            for field, label, options in manual_entry_fields:
+                val = entry[field]
+                if isinstance(val, str) and len(val) > 60:
+                    val = val[:60] + '...'
+                if options:
+                    val = st.selectbox(label, options, index=options.index(val) if val in options else 0, key=f"review_{field}_{idx}")
+                elif field == "Date Ordered":
+                    val = st.date_input(label, value=val, key=f"review_{field}_{idx}")
+                elif field == "Qty":
+                    val = st.number_input(label, min_value=0, step=1, value=val if val is not None else 0, key=f"review_{field}_{idx}")
+                elif field == "Par Level":
+                    val = st.number_input(label, min_value=0, step=1, value=val if val is not None else 0, key=f"review_{field}_{idx}")
+                elif field == "Value" or field == "Total Cost":
+                    val = st.number_input(label, min_value=0.0, step=0.01, value=val if val is not None else 0.0, key=f"review_{field}_{idx}")
+                else:
+                    val = st.text_input(label, value=val if val is not None else "", key=f"review_{field}_{idx}")
+                entry[field] = val
+            merge_similar = similar is not None and st.checkbox(f"Merge into the similar existing item “{similar}”", value=False, key=f"review_fuzzy_{idx}")
+            submitted = st.form_submit_button("Submit Entry")
+            if submitted:
+                if isinstance(entry["Date Ordered"], (datetime, pd.Timestamp)):
+                    entry["Date Ordered"] = entry["Date Ordered"].strftime("%Y-%m-%d")
+                elif isinstance(entry["Date Ordered"], str):
+                    entry["Date Ordered"] = pd.to_datetime(entry["Date Ordered"]).strftime("%Y-%m-%d")
+                    entry["Date Ordered"] = str(entry["Date Ordered"])
+                merge_upload_rows(store, [entry], [keys.iloc[idx]] if keys is not None else None, fuzzy,
+                                  confirmed={0} if merge_similar else set())
+                st.session_state.upload_review_idx += 1
+                st.session_state.need_rerun = True
+        return False
+    st.success("All uploaded entries have been reviewed and added.")
+    _finish_upload_review(uploaded_report)
+    return True
+
 # --- INVENTORY ENTRY FORM ---
 def inventory_form():
     st.header("📋 Add Inventory Item")
@@ -45,241 +2213,151 @@ def inventory_form():
             st.session_state.upload_review_idx = 0
         if 'upload_review_rows' not in st.session_state:
             st.session_state.upload_review_rows = []
-        if st.session_state.upload_review_idx == 0:
+        if st.session_state.get('upload_committed') == upload_key(uploaded_report):
+            st.info("✅ This file has already been reviewed and added.")
+        elif st.session_state.upload_review_idx == 0:
             try:
-                if uploaded_report.name.endswith('.csv'):
-                    df_upload = pd.read_csv(uploaded_report)
-                else:
-                    df_upload = pd.read_excel(uploaded_report, header=1)
+                with timed_phase("upload_parse", bytes=uploaded_report.size) as perf:
+                    if uploaded_report.name.endswith('.csv'):
+                        df_upload = read_report(uploaded_report, reader="csv")
+                    else:
+                        df_upload = read_report(uploaded_report, header=1)
+                    perf["rows"] = len(df_upload)
                 df_upload.columns = df_upload.columns.str.strip()
-                csv_to_manual = {
-                    "Department": "Department Name",
-                    "Vendor": "Brand",
-                    "Item": "Title",
-                    "Location": None,
-                    "Unit": "Brand",
-                    "Qty": "Item Quantity",
-                    "Par Level": None,
-                    "Value": "Item Price",
-                    "Frequency": None,
-                    "Date Ordered": "Order Date",
-                    "Total Cost": "Order Subtotal"
-                }
-                st.session_state.upload_review_rows = []
-                for _, row in df_upload.iterrows():
-                    entry = {}
-                    for field, label, options in manual_entry_fields:
-                        csv_col = csv_to_manual.get(field)
-                        val = None
-                        if csv_col and csv_col in df_upload.columns:
-                            val = row.get(csv_col, "")
-                        if field == "Qty":
-                            try:
-                                val = int(val)
-                            except:
-                                val = None
-                        if field == "Value" or field == "Total Cost":
-                            try:
-                                val = float(val)
-                            except:
-                                val = 0.0
-                        if field == "Par Level":
-                            val = 0
-                        if field == "Date Ordered":
-                            if val:
-                                try:
-                                    val = pd.to_datetime(val).date()
-                                except:
-                                    val = datetime.today().date()
-                            else:
-                                val = datetime.today().date()
-                        entry[field] = val
-                    if (entry["Total Cost"] is None or entry["Total Cost"] == 0.0):
-                        qty = entry.get("Qty", None)
-                        value = entry.get("Value", 0.0)
-                        if qty is not None:
-                            entry["Total Cost"] = qty * value
-                        else:
-                            entry["Total Cost"] = value
-                    st.session_state.upload_review_rows.append(entry)
+                with timed_phase("upload_normalize", rows=len(df_upload)):
+                    st.session_state.upload_review_rows, st.session_state.upload_review_errors = normalize_upload(df_upload, amazon_csv_to_manual)
+                    st.session_state.upload_review_keys = upload_line_keys(df_upload, amazon_csv_to_manual, "amazon")
+                upload_errors = st.session_state.upload_review_errors.any(axis=1)
+                if upload_errors.any():
+                    st.warning(f"⚠️ {int(upload_errors.sum())} row(s) had values that could not be parsed and were defaulted.")
             except Exception as e:
                 st.error(f"❌ Error reading uploaded file: {e}")
-        # Step-by-step review UI
-        if st.session_state.upload_review_rows and st.session_state.upload_review_idx < len(st.session_state.upload_review_rows):
-            idx = st.session_state.upload_review_idx
-            entry = st.session_state.upload_review_rows[idx]
-            with st.form(f"review_row_form_{idx}"):
-                for field, label, options in manual_entry_fields:
-                    val = entry[field]
-                    if isinstance(val, str) and len(val) > 60:
-                        val = val[:60] + '...'
-                    if options:
-                        val = st.selectbox(label, options, index=options.index(val) if val in options else 0, key=f"review_{field}_{idx}")
-                    elif field == "Date Ordered":
-                        val = st.date_input(label, value=val, key=f"review_{field}_{idx}")
-                    elif field == "Qty":
-                        val = st.number_input(label, min_value=0, step=1, value=val if val is not None else 0, key=f"review_{field}_{idx}")
-                    elif field == "Par Level":
-                        val = st.number_input(label, min_value=0, step=1, value=val if val is not None else 0, key=f"review_{field}_{idx}")
-                    elif field == "Value" or field == "Total Cost":
-                        val = st.number_input(label, min_value=0.0, step=0.01, value=val if val is not None else 0.0, key=f"review_{field}_{idx}")
-                    else:
-                        val = st.text_input(label, value=val if val is not None else "", key=f"review_{field}_{idx}")
-                    entry[field] = val
-                submitted = st.form_submit_button("Submit Entry")
-                if submitted:
-                    if isinstance(entry["Date Ordered"], (datetime, pd.Timestamp)):
-                        entry["Date Ordered"] = entry["Date Ordered"].strftime("%Y-%m-%d")
-                    elif isinstance(entry["Date Ordered"], str):
-                        entry["Date Ordered"] = pd.to_datetime(entry["Date Ordered"]).strftime("%Y-%m-%d")
-                        entry["Date Ordered"] = str(entry["Date Ordered"])
-                    st.session_state.inventory_data.append(entry)
-                    st.session_state.upload_review_idx += 1
-                    st.session_state.need_rerun = True
-        elif st.session_state.upload_review_rows:
-            st.success("All uploaded entries have been reviewed and added.")
-            st.session_state.upload_review_rows = []
-            st.session_state.upload_review_idx = 0
+        review_upload_rows(uploaded_report)
     # --- Inventory Report robust upload/merge logic ---
     elif uploaded_report is not None and file_type == "Inventory Report":
         if 'upload_review_idx' not in st.session_state:
             st.session_state.upload_review_idx = 0
         if 'upload_review_rows' not in st.session_state:
             st.session_state.upload_review_rows = []
-        if st.session_state.upload_review_idx == 0:
+        if st.session_state.get('upload_committed') == upload_key(uploaded_report):
+            st.info("✅ This file has already been reviewed and added.")
+        elif st.session_state.upload_review_idx == 0:
             try:
-                if uploaded_report.name.endswith('.csv'):
-                    df_upload = pd.read_excel(uploaded_report, header=1)
+                content_hash = upload_key(uploaded_report)
+                with timed_phase("upload_sniff", bytes=uploaded_report.size):
+                    schema = sniff_upload(content_hash, uploaded_report.getvalue(), uploaded_report.name.lower())
+                store = st.session_state.inventory_store
+                saved = load_column_mapping(store, schema["signature"])
+                if saved is not None and all(col in schema["columns"] for col in saved.values()):
+                    suggested = saved
+                    st.caption("Using the column mapping saved for files with these headers.")
                 else:
-                    df_upload = pd.read_excel(uploaded_report, header=1)
-                df_upload.columns = df_upload.columns.str.strip()
+                    suggested = suggest_column_mapping(schema["columns"], schema["kinds"])
+                st.caption(f"Header found on row {schema['header_row'] + 1}. Column types: "
+                           + ", ".join(f"{col} ({kind})" for col, kind in schema["kinds"].items()))
                 # --- Column mapping UI ---
                 manual_fields = [f[0] for f in manual_entry_fields]
                 st.write('### Map columns from your file to inventory fields:')
                 col_map = {}
                 for field in manual_fields:
-                    options = [None] + list(df_upload.columns)
-                    default_idx = options.index(field) if field in options else 0
-                    col_map[field] = st.selectbox(f"Map for '{field}'", options, index=default_idx, key=f"inv_map_{field}")
+                    options = [None] + schema["columns"]
+                    default_idx = options.index(suggested[field]) if suggested.get(field) in options else 0
+                    col_map[field] = st.selectbox(f"Map for '{field}'", options, index=default_idx, key=f"inv_map_{field}_{schema['signature']}")
                 if st.button("Confirm Column Mapping", key="inv_confirm_mapping"):
                     st.session_state.inv_col_map = col_map
-                    st.session_state.inv_mapping_confirmed = True
-                if st.session_state.get('inv_mapping_confirmed', False):
-                    st.session_state.upload_review_rows = []
-                    for _, row in df_upload.iterrows():
-                        entry = {}
-                        for field, label, options in manual_entry_fields:
-                            file_col = st.session_state.inv_col_map.get(field)
-                            val = row.get(file_col, "") if file_col else ""
-                            if field == "Qty":
-                                try:
-                                    val = int(val)
-                                except:
-                                    val = None
-                            if field == "Value" or field == "Total Cost":
-                                try:
-                                    val = float(val)
-                                except:
-                                    val = 0.0
-                            if field == "Par Level":
-                                val = 0
-                            if field == "Date Ordered":
-                                if val:
-                                    try:
-                                        val = pd.to_datetime(val).date()
-                                    except:
-                                        val = datetime.today().date()
-                                else:
-                                    val = datetime.today().date()
-                            entry[field] = val
-                        if (entry["Total Cost"] is None or entry["Total Cost"] == 0.0):
-                            qty = entry.get("Qty", None)
-                            value = entry.get("Value", 0.0)
-                            if qty is not None:
-                                entry["Total Cost"] = qty * value
-                            else:
-                                entry["Total Cost"] = value
-                        st.session_state.upload_review_rows.append(entry)
+                    st.session_state.inv_mapping_confirmed = content_hash
+                    save_column_mapping(store, schema["signature"], col_map)
+                # The full file is only parsed once the mapping is confirmed
+                if st.session_state.get('inv_mapping_confirmed') == content_hash:
+                    with timed_phase("upload_parse", bytes=uploaded_report.size) as perf:
+                        reader = "csv" if uploaded_report.name.lower().endswith('.csv') else "excel"
+                        df_upload = read_report(uploaded_report, reader=reader, header=schema["header_row"])
+                        perf["rows"] = len(df_upload)
+                    df_upload.columns = clean_columns(df_upload.columns)
+                    with timed_phase("upload_normalize", rows=len(df_upload)):
+                        st.session_state.upload_review_rows, st.session_state.upload_review_errors = normalize_upload(df_upload, st.session_state.inv_col_map, missing="")
+                        st.session_state.upload_review_keys = upload_line_keys(df_upload, st.session_state.inv_col_map, "inventory_report")
+                    upload_errors = st.session_state.upload_review_errors.any(axis=1)
+                    if upload_errors.any():
+                        st.warning(f"⚠️ {int(upload_errors.sum())} row(s) had values that could not be parsed and were defaulted.")
             except Exception as e:
                 st.error(f"❌ Error reading uploaded file: {e}")
-        # Step-by-step review UI (same as Amazon Report)
-        if st.session_state.upload_review_rows and st.session_state.upload_review_idx < len(st.session_state.upload_review_rows):
-            idx = st.session_state.upload_review_idx
-            entry = st.session_state.upload_review_rows[idx]
-            with st.form(f"review_row_form_{idx}"):
-                for field, label, options in manual_entry_fields:
-                    val = entry[field]
-                    if isinstance(val, str) and len(val) > 60:
-                        val = val[:60] + '...'
-                    if options:
-                        val = st.selectbox(label, options, index=options.index(val) if val in options else 0, key=f"review_{field}_{idx}")
-                    elif field == "Date Ordered":
-                        val = st.date_input(label, value=val, key=f"review_{field}_{idx}")
-                    elif field == "Qty":
-                        val = st.number_input(label, min_value=0, step=1, value=val if val is not None else 0, key=f"review_{field}_{idx}")
-                    elif field == "Par Level":
-                        val = st.number_input(label, min_value=0, step=1, value=val if val is not None else 0, key=f"review_{field}_{idx}")
-                    elif field == "Value" or field == "Total Cost":
-                        val = st.number_input(label, min_value=0.0, step=0.01, value=val if val is not None else 0.0, key=f"review_{field}_{idx}")
-                    else:
-                        val = st.text_input(label, value=val if val is not None else "", key=f"review_{field}_{idx}")
-                    entry[field] = val
-                submitted = st.form_submit_button("Submit Entry")
-                if submitted:
-                    if isinstance(entry["Date Ordered"], (datetime, pd.Timestamp)):
-                        entry["Date Ordered"] = entry["Date Ordered"].strftime("%Y-%m-%d")
-                    elif isinstance(entry["Date Ordered"], str):
-                        entry["Date Ordered"] = pd.to_datetime(entry["Date Ordered"]).strftime("%Y-%m-%d")
-                        entry["Date Ordered"] = str(entry["Date Ordered"])
-                    st.session_state.inventory_data.append(entry)
-                    st.session_state.upload_review_idx += 1
-                    st.session_state.need_rerun = True
-        elif st.session_state.upload_review_rows:
-            st.success("All uploaded entries have been reviewed and added.")
-            st.session_state.upload_review_rows = []
-            st.session_state.upload_review_idx = 0
-            st.session_state.inv_mapping_confirmed = False
+        if review_upload_rows(uploaded_report):
+            st.session_state.inv_mapping_confirmed = None
             st.session_state.inv_col_map = {}
     # --- Mckesson Report logic ---
     elif uploaded_report is not None and file_type == "Mckesson Report":
         if 'mckesson_review_idx' not in st.session_state:
             st.session_state.mckesson_review_idx = 0
-        if 'mckesson_review_rows' not in st.session_state:
-            st.session_state.mckesson_review_rows = []
-        if 'mckesson_cost_left' not in st.session_state:
-            st.session_state.mckesson_cost_left = []
-        if st.session_state.mckesson_review_idx == 0 and not st.session_state.mckesson_review_rows:
+        if 'mckesson_lines' not in st.session_state:
+            st.session_state.mckesson_lines = McKessonLines()
+        with st.expander("McKesson column selection"):
+            date_spec = st.text_input("Date column (letter or header name)", "F", key="mckesson_date_column")
+            cost_spec = st.text_input("Cost column (letter or header name)", "H", key="mckesson_cost_column")
+        if st.session_state.get('mckesson_committed') == upload_key(uploaded_report):
+            st.info("✅ This file has already been reviewed and added.")
+        elif st.session_state.mckesson_review_idx == 0 and not len(st.session_state.mckesson_lines):
             try:
-                if uploaded_report.name.endswith('.csv'):
-                    df_upload = pd.read_csv(uploaded_report)
-                elif uploaded_report.name.endswith('.xls'):
-                    df_upload = pd.read_excel(uploaded_report, engine='xlrd')
-                else:
-                    df_upload = pd.read_excel(uploaded_report, header=1)
-                # Assume column F is index 5, column H is index 7
-                for _, row in df_upload.iterrows():
-                    date_val = row.iloc[5] if len(row) > 5 else ''
-                    total_cost = row.iloc[7] if len(row) > 7 else 0.0
-                    try:
-                        date_val = pd.to_datetime(date_val).date()
-                    except:
-                        date_val = datetime.today().date()
-                    try:
-                        total_cost = float(total_cost)
-                    except:
-                        total_cost = 0.0
-                    st.session_state.mckesson_review_rows.append({
-                        'Date Ordered': date_val,
-                        'Total Cost': total_cost
-                    })
-                    st.session_state.mckesson_cost_left.append(total_cost)
+                with timed_phase("mckesson_ingest", bytes=uploaded_report.size) as perf:
+                    st.session_state.mckesson_lines = read_mckesson_report(
+                        uploaded_report.getvalue(), uploaded_report.name,
+                        parse_column_spec(date_spec), parse_column_spec(cost_spec)
+                    )
+                    perf["rows"] = len(st.session_state.mckesson_lines)
             except Exception as e:
                 st.error(f"❌ Error reading uploaded file: {e}")
         # Step-by-step manual entry and cost allocation
-        if st.session_state.mckesson_review_rows and st.session_state.mckesson_review_idx < len(st.session_state.mckesson_review_rows):
+        lines = st.session_state.mckesson_lines
+        if len(lines):
+            # Jump to the first line that still has cost left to allocate
+            open_lines = np.flatnonzero(lines.remaining > 0.005)
+            st.session_state.mckesson_review_idx = int(open_lines[0]) if len(open_lines) else len(lines)
+        allocation_mode = st.radio("Allocation mode", ["Bulk plan", "One line at a time"], horizontal=True, key="mckesson_allocation_mode")
+        if len(lines) and allocation_mode == "Bulk plan" and (lines.remaining > 0.005).any():
+            store = st.session_state.inventory_store
+            vendor = st.text_input("Vendor", "McKesson", key="mckesson_plan_vendor")
+            strategy = st.radio("Split costs by", ["Past department spend", "Saved vendor template"], horizontal=True, key="mckesson_plan_strategy")
+            if strategy == "Saved vendor template":
+                template = load_allocation_template(store, vendor)
+                if template is None:
+                    template = department_spend_shares(store.frame, vendor).rename("Share").rename_axis("Department").reset_index()
+                    template["Item"] = ""
+                    template["Location"] = None
+                template = st.data_editor(template, key=f"mckesson_template_{vendor}", num_rows="dynamic", column_config={
+                    "Department": st.column_config.SelectboxColumn("Department", options=manual_entry_fields[0][2]),
+                    "Location": st.column_config.SelectboxColumn("Location", options=manual_entry_fields[3][2]),
+                })
+                if st.button("Save Template", key="mckesson_save_template"):
+                    save_allocation_template(store, vendor, template)
+                    st.success(f"Saved allocation template for {vendor}.")
+            else:
+                template = department_spend_shares(store.frame, vendor).rename("Share").rename_axis("Department").reset_index()
+            with timed_phase("mckesson_plan", rows=len(lines)):
+                plan = propose_mckesson_allocation(lines, template, vendor)
+            st.caption(f"{int((lines.remaining > 0.005).sum())} open line(s), ${lines.remaining.sum():,.2f} to allocate.")
+            edited_plan = st.data_editor(
+                plan,
+                key=f"mckesson_plan_{strategy}_{vendor}",
+                num_rows="dynamic",
+                disabled=["Date Ordered"],
+                column_config={
+                    "Department": st.column_config.SelectboxColumn("Department", options=manual_entry_fields[0][2]),
+                    "Location": st.column_config.SelectboxColumn("Location", options=manual_entry_fields[3][2]),
+                    "Date Ordered": st.column_config.DateColumn("Date Ordered", format="YYYY-MM-DD"),
+                },
+            )
+            if st.button("Commit Allocation Plan", key="mckesson_commit_plan"):
+                try:
+                    with timed_phase("mckesson_commit", rows=len(edited_plan)):
+                        added = apply_mckesson_allocation(store, lines, edited_plan)
+                    st.success(f"Added {added} allocated entries to the inventory.")
+                    st.session_state.need_rerun = True
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+        elif len(lines) and st.session_state.mckesson_review_idx < len(lines):
             idx = st.session_state.mckesson_review_idx
-            entry = st.session_state.mckesson_review_rows[idx]
-            cost_left = st.session_state.mckesson_cost_left[idx]
+            entry = lines.entry(idx)
+            cost_left = entry['Remaining']
             st.info(f"Row {idx+1}: Total Cost to allocate: ${cost_left:,.2f}")
             with st.form(f"mckesson_row_form_{idx}"):
                 st.write(f"Date Ordered: {entry['Date Ordered']}")
@@ -302,15 +2380,19 @@ def inventory_form():
                         new_row = {**manual_entry,
                                    "Date Ordered": entry['Date Ordered'],
                                    "Total Cost": alloc_cost}
-                        st.session_state.inventory_data.append(new_row)
-                        st.session_state.mckesson_cost_left[idx] -= alloc_cost
+                        st.session_state.inventory_store.append(new_row)
+                        lines.remaining[idx] -= alloc_cost
                         st.success(f"Allocated ${alloc_cost} of cost.")
+                        if lines.remaining[idx] <= 0.005:
+                            st.session_state.mckesson_review_idx += 1
+                        st.session_state.need_rerun = True
                     else:
                         st.warning("Allocated cost must be greater than 0.")
-        elif st.session_state.mckesson_review_rows:
+        elif len(lines):
             st.success("All Mckesson report entries have been reviewed and added.")
-            st.session_state.mckesson_review_rows = []
+            st.session_state.mckesson_lines = McKessonLines()
             st.session_state.mckesson_review_idx = 0
+            st.session_state.mckesson_committed = upload_key(uploaded_report)
 
     # --- MANUAL ENTRY FORM ---
     with st.form("manual_entry_form"):
@@ -344,83 +2426,239 @@ def inventory_form():
                 "Date Ordered": date_ordered.strftime("%Y-%m-%d"),
                 "Total Cost": total_cost
             }
-            st.session_state.inventory_data.append(new_row)
+            st.session_state.inventory_store.append(new_row)
             st.success("✅ Inventory item submitted successfully.")
 
+# --- INVENTORY EXCEL EXPORT ---
+# Above this many rows the workbook is streamed with xlsxwriter's constant_memory mode
+export_constant_memory_rows = 50000
+
+def build_inventory_export(df):
+    output = io.BytesIO()
+    workbook = lazy_import("xlsxwriter").Workbook(output, {
+        'constant_memory': len(df) > export_constant_memory_rows,
+        'default_date_format': 'yyyy-mm-dd',
+        'nan_inf_to_errors': True,
+    })
+    worksheet = workbook.add_worksheet('Inventory')
+    worksheet.write_row(0, 0, list(df.columns), workbook.add_format({'bold': True, 'border': 1}))
+    # Rows are written in order so constant_memory mode can flush each one as it goes
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, row)
+    # One conditional-format rule highlights every row at or below par level 2
+    if 'Par Level' in df.columns and len(df):
+        par_col = lazy_import("xlsxwriter.utility").xl_col_to_name(df.columns.get_loc('Par Level'))
+        worksheet.conditional_format(1, 0, len(df), len(df.columns) - 1, {
+            'type': 'formula',
+            'criteria': f'=AND(ISNUMBER(${par_col}2), ${par_col}2<=2)',
+            'format': workbook.add_format({'bg_color': '#FFCCCC'}),
+        })
+    workbook.close()
+    return output.getvalue()
+
 # --- DISPLAY INVENTORY TABLE + METRICS ---
-def display_inventory_table():
-    df = pd.DataFrame(st.session_state.inventory_data)
+inventory_date_presets = ["Any time", "This month", "This quarter", "This year", "Last 90 days", "Custom range"]
 
-    # Ensure 'Total Cost' column exists and is numeric
-    if 'Total Cost' not in df.columns:
-        df['Total Cost'] = 0.0
+def date_preset_range(preset, today=None):
+    # (start, end) for the "Ordered" filter, or None for any time
+    today = pd.Timestamp(today or datetime.today().date())
+    if preset == "This month":
+        return today.to_period("M").start_time, today
+    if preset == "This quarter":
+        return today.to_period("Q").start_time, today
+    if preset == "This year":
+        return today.to_period("Y").start_time, today
+    if preset == "Last 90 days":
+        return today - pd.Timedelta(days=90), today
+    return None
+
+def inventory_view(store, search="", departments=None, sort_by=None, ascending=True, locations=None, date_range=None):
+    # Server-side filter (through the table's search index) and sort. The result keeps the store's
+    # row positions as its index.
+    if search.strip() or departments or locations or date_range is not None:
+        view = store.search(search, departments, locations, date_range)
     else:
-        df['Total Cost'] = pd.to_numeric(df['Total Cost'], errors='coerce').fillna(0.0)
-    # Optionally recalculate if Qty and Value are present but Total Cost is missing/zero
-    if 'Qty' in df.columns and 'Value' in df.columns:
-        mask = (df['Total Cost'] == 0) & (df['Qty'].notnull()) & (df['Value'].notnull())
-        df.loc[mask, 'Total Cost'] = df.loc[mask, 'Qty'].astype(float) * df.loc[mask, 'Value'].astype(float)
+        view = store.frame
+    if sort_by:
+        view = view.sort_values(sort_by, ascending=ascending, kind="stable", na_position="last")
+    return view
+
+def grid_selected_keys(state, grid_key, rows, shown_keys):
+    # (id, version) of the selected grid rows. A new selection was made on the rows as last shown
+    # (kept in state), which may have moved since; a selection that has not changed keeps its keys.
+    shown = state.get("inventory_grid_shown")
+    picked = state.get("inventory_grid_picked")
+    if picked is None or picked[:2] != (grid_key, rows):
+        basis = shown[1] if shown is not None and shown[0] == grid_key else shown_keys
+        picked = state["inventory_grid_picked"] = (grid_key, rows, [basis[i] for i in rows if i < len(basis)])
+    state["inventory_grid_shown"] = (grid_key, shown_keys)
+    return picked[2]
+
+def clear_grid_selection():
+    # After this user's own change the picked (id, version) keys are out of date: start a fresh grid
+    st.session_state.inventory_grid_epoch = st.session_state.get("inventory_grid_epoch", 0) + 1
+    st.session_state.inventory_grid_picked = None
+    st.session_state.need_rerun = True
+
+def display_inventory_table():
+    store = st.session_state.inventory_store
 
     st.subheader("📊 Inventory Metrics")
-    st.metric("Total Inventory Items", len(df))
-    st.metric("Total Estimated Cost", f"${df['Total Cost'].sum():,.2f}")
+    st.metric("Total Inventory Items", store.item_count)
+    st.metric("Total Estimated Cost", f"${store.total_cost:,.2f}")
 
     st.subheader("📦 Inventory Table")
 
-    # Undo delete button (always show if a row was deleted, even if table is empty)
-    if 'last_deleted_row' in st.session_state and st.session_state.last_deleted_row is not None:
-        st.warning("Last row deleted. You can undo this action.")
-        if st.button("Undo Delete", key="undo_delete"):
-            idx = st.session_state.get('last_deleted_idx', len(st.session_state.inventory_data))
-            st.session_state.inventory_data.insert(idx, st.session_state.last_deleted_row)
-            st.session_state.last_deleted_row = None
-            st.session_state.last_deleted_idx = None
-            st.session_state.need_rerun = True
+    # What other sessions changed since this one last rendered (the table itself is shared)
+    for label, n_rows in store.notifications():
+        st.toast(f"Inventory updated by another user: {label}" + (f" ({n_rows} row(s))" if n_rows else ""))
+    st.session_state.inventory_rendered_version = store.version
+    if hasattr(st, "fragment"):
+        @st.fragment(run_every=inventory_poll_seconds)
+        def watch_changes():
+            # Reruns the page once another session or process has changed the table
+            store.sync()
+            if store.version != st.session_state.get("inventory_rendered_version"):
+                st.rerun()
+        watch_changes()
 
-    # --- Streamlit columns for single-line, inline buttons ---
-    if not df.empty:
-        col_names = list(df.columns) + ["Edit", "Delete"]
-        header_cols = st.columns(len(col_names))
-        for i, col in enumerate(col_names):
-            header_cols[i].markdown(f"**{col}**")
-        for idx, row in df.iterrows():
-            row_cols = st.columns(len(col_names))
-            for i, col in enumerate(df.columns):
-                val = row[col]
-                val_disp = str(val)
-                if isinstance(val, str) and len(val) > 15:
-                    val_disp = val[:15] + '...'
-                row_cols[i].markdown(f'<span title="{str(val)}">{val_disp}</span>', unsafe_allow_html=True)
-            if row_cols[-2].button("✏️", key=f"edit_{idx}", help="Edit this row"):
-                st.session_state.edit_row_idx = idx
-            if row_cols[-1].button("🗑️", key=f"delete_{idx}", help="Delete this row"):
-                # Save deleted row and index for undo
-                st.session_state.last_deleted_row = row.to_dict()
-                st.session_state.last_deleted_idx = idx
-                st.session_state.inventory_data.pop(idx)
-                st.session_state.need_rerun = True
+    # Undo / redo (always shown when there is something to undo, even if the table is empty)
+    if store.undo_label or store.redo_label:
+        hist = st.columns(2)
+        try:
+            if store.undo_label and hist[0].button(f"↩️ Undo {store.undo_label}", key="undo_action"):
+                store.undo()
+                clear_grid_selection()
+            if store.redo_label and hist[1].button(f"↪️ Redo {store.redo_label}", key="redo_action"):
+                store.redo()
+                clear_grid_selection()
+        except InventoryConflict as e:
+            st.error(f"Could not undo/redo: {e}.")
+
+    # --- Paginated grid: only the visible page is sent to the browser ---
+    if store.item_count:
+        ctl = st.columns([3, 2, 2, 2])
+        search = ctl[0].text_input("Search Item or Vendor", key="inv_search", help="Every word must appear in the item name or vendor")
+        departments = ctl[1].multiselect("Department", manual_entry_fields[0][2], key="inv_filter_department")
+        locations = ctl[2].multiselect("Location", manual_entry_fields[3][2], key="inv_filter_location")
+        preset = ctl[3].selectbox("Ordered", inventory_date_presets, key="inv_filter_ordered")
+        date_range = date_preset_range(preset)
+        if preset == "Custom range":
+            picked = st.date_input("Ordered between", value=(), key="inv_filter_dates")
+            if len(picked) == 2:
+                date_range = (pd.Timestamp(picked[0]), pd.Timestamp(picked[1]))
+        srt = st.columns([3, 1])
+        sort_by = srt[0].selectbox("Sort by", [None] + inventory_columns, key="inv_sort_by")
+        descending = srt[1].checkbox("Desc", key="inv_sort_desc")
+        # Without a filter or sort only the visible page is read from the database
+        view = None
+        n_matching = store.item_count
+        if search.strip() or departments or locations or date_range is not None or sort_by:
+            with timed_phase("table_view", rows=store.item_count) as perf:
+                view = inventory_view(store, search, departments, sort_by, ascending=not descending,
+                                      locations=locations, date_range=date_range)
+                n_matching = perf["matching"] = len(view)
+
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 250], key="inv_page_size")
+        n_pages = max(1, -(-n_matching // page_size))
+        if st.session_state.get("inv_page", 1) > n_pages:
+            st.session_state.inv_page = n_pages
+        page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, step=1, key="inv_page")
+        offset = (page - 1) * page_size
+        with timed_phase("table_page", rows=page_size):
+            page_df = view.iloc[offset:offset + page_size] if view is not None else store.page(offset, page_size)
+            shown_keys = store.row_keys(page_df.index) if view is not None else store.page_keys(offset, page_size)
+        # Keyed on what the user asked to see, not the table version: another user's write must not
+        # clear this user's selection. Rows are picked by (id, version), so acting on a row that was
+        # changed since is refused by the version check.
+        view_args = (page, page_size, search, departments, locations, date_range, sort_by, descending)
+        grid_key = "inventory_grid_{}_{}".format(
+            st.session_state.get("inventory_grid_epoch", 0), hashlib.sha1(repr(view_args).encode()).hexdigest()[:16])
+        with timed_phase("table_render", rows=len(page_df)):
+            event = st.dataframe(
+                page_df,
+                hide_index=True,
+                on_select="rerun",
+                selection_mode="multi-row",
+                key=grid_key,
+                column_config={
+                    "Item": st.column_config.TextColumn("Item", width="large"),
+                    "Date Ordered": st.column_config.DateColumn("Date Ordered", format="YYYY-MM-DD"),
+                    "Value": st.column_config.NumberColumn("Value", format="$%.2f"),
+                    "Total Cost": st.column_config.NumberColumn("Total Cost", format="$%.2f"),
+                },
+            )
+        st.caption(f"Showing {len(page_df)} of {n_matching} matching rows ({store.item_count} total)")
+        rows = list(event.selection.rows)
+        selected_keys = grid_selected_keys(st.session_state, grid_key, rows, shown_keys)
+        if selected_keys and [shown_keys[i] if i < len(shown_keys) else None for i in rows] != selected_keys:
+            st.caption("The table changed after you selected rows; the actions below apply to the rows you selected.")
+        if selected_keys:
+            act = st.columns(2)
+            if len(selected_keys) == 1 and act[0].button("✏️ Edit selected row", key="edit_selected"):
+                st.session_state.edit_row_key = selected_keys[0]
+            if act[1].button(f"🗑️ Delete {len(selected_keys)} selected", key="delete_selected"):
+                try:
+                    store.remove_rows(selected_keys)
+                    st.session_state.pop('edit_row_key', None)
+                    clear_grid_selection()
+                except InventoryConflict as e:
+                    st.error(f"Nothing deleted: {e}.")
+            with st.expander(f"Bulk edit {len(selected_keys)} selected row(s)"):
+                editable = [f for f in manual_entry_fields if f[0] != "Total Cost"]
+                field = st.selectbox("Field", [f[0] for f in editable], key="bulk_edit_field")
+                label, options = next((f[1], f[2]) for f in editable if f[0] == field)
+                if options:
+                    val = st.selectbox(label, options, key="bulk_edit_value_option")
+                elif field == "Date Ordered":
+                    val = pd.Timestamp(st.date_input(label, datetime.today(), key="bulk_edit_value_date"))
+                elif field == "Qty" or field == "Par Level":
+                    val = st.number_input(label, min_value=0, step=1, key="bulk_edit_value_int")
+                elif field == "Value":
+                    val = st.number_input(label, min_value=0.0, step=0.01, key="bulk_edit_value_float")
+                else:
+                    val = st.text_input(label, key="bulk_edit_value_text")
+                if st.button("Apply to selected", key="bulk_edit_apply"):
+                    try:
+                        store.edit_rows(selected_keys, {field: val})
+                        st.success(f"Updated {len(selected_keys)} row(s).")
+                        clear_grid_selection()
+                    except InventoryConflict as e:
+                        st.error(f"Nothing updated: {e}.")
     else:
         st.info("No inventory data to display.")
 
-    # Edit form
-    if 'edit_row_idx' in st.session_state:
-        edit_idx = st.session_state.edit_row_idx
-        edit_row = st.session_state.inventory_data[edit_idx]
-        with st.form(f"edit_row_form_{edit_idx}"):
+    # Edit form: holds the row's (id, version) so a save never lands on a row someone else has
+    # changed or deleted since the form was opened
+    edit_key = st.session_state.get('edit_row_key')
+    edit_idx = None
+    if edit_key is not None:
+        try:
+            edit_idx = store.locate([edit_key[0]])[0]
+        except InventoryConflict:
+            st.warning("The row you were editing was deleted by another user.")
+            del st.session_state.edit_row_key
+    if edit_idx is not None:
+        edit_id = edit_key[0]
+        if store.row_keys([edit_idx])[0] != tuple(edit_key):
+            st.warning("Another user changed this row after you opened it. Select it again to edit their version.")
+        edit_row = store.row(edit_idx)
+        with st.form(f"edit_row_form_{edit_id}"):
             for field, label, options in manual_entry_fields:
                 val = edit_row.get(field, "")
                 if isinstance(val, str) and len(val) > 60:
                     val = val[:60] + '...'
                 if options:
-                    val = st.selectbox(label, options, index=options.index(val) if val in options else 0, key=f"edit_{field}_{edit_idx}")
+                    val = st.selectbox(label, options, index=options.index(val) if val in options else 0, key=f"edit_{field}_{edit_id}")
                 elif field == "Date Ordered":
-                    val = st.date_input(label, value=pd.to_datetime(val).date() if val else datetime.today().date(), key=f"edit_{field}_{edit_idx}")
+                    val = st.date_input(label, value=pd.to_datetime(val).date() if val else datetime.today().date(), key=f"edit_{field}_{edit_id}")
                 elif field == "Qty" or field == "Par Level":
-                    val = st.number_input(label, min_value=0, step=1, value=val if val != '' else 0, key=f"edit_{field}_{edit_idx}")
+                    val = st.number_input(label, min_value=0, step=1, value=val if val not in ('', None) else 0, key=f"edit_{field}_{edit_id}")
                 elif field == "Value" or field == "Total Cost":
-                    val = st.number_input(label, min_value=0.0, step=0.01, value=val if val != '' else 0.0, key=f"edit_{field}_{edit_idx}")
+                    val = st.number_input(label, min_value=0.0, step=0.01, value=val if val not in ('', None) else 0.0, key=f"edit_{field}_{edit_id}")
                 else:
-                    val = st.text_input(label, value=val if val is not None else "", key=f"edit_{field}_{edit_idx}")
+                    val = st.text_input(label, value=val if val is not None else "", key=f"edit_{field}_{edit_id}")
                 edit_row[field] = val
             total_cost = edit_row["Qty"] * edit_row["Value"]
             submitted = st.form_submit_button("Save Changes")
@@ -431,117 +2669,789 @@ def display_inventory_table():
                 elif isinstance(edit_row["Date Ordered"], str):
                     edit_row["Date Ordered"] = pd.to_datetime(edit_row["Date Ordered"]).strftime("%Y-%m-%d")
                     edit_row["Date Ordered"] = str(edit_row["Date Ordered"])
-                st.session_state.inventory_data[edit_idx] = edit_row
-                del st.session_state.edit_row_idx
-                st.success("Entry updated.")
-                st.experimental_rerun()
-                st.session_state.need_rerun = True
+                try:
+                    store.edit_row(edit_key, edit_row)
+                    del st.session_state.edit_row_key
+                    st.success("Entry updated.")
+                    st.session_state.need_rerun = True
+                except InventoryConflict as e:
+                    st.error(f"Not saved: {e}.")
     # Add rerun trigger at the end of the function
     if st.session_state.get("need_rerun", False):
         st.session_state.need_rerun = False
-        if hasattr(st, "experimental_rerun"):
+        if hasattr(st, "rerun"):
+            st.rerun()
+        elif hasattr(st, "experimental_rerun"):
             try:
                 st.experimental_rerun()
             except Exception:
                 pass
-    # Download button for inventory report with highlight
-    import io
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Inventory')
-        workbook = writer.book
-        worksheet = writer.sheets['Inventory']
-        # Find the column index for 'Par Level' if it exists
-        if 'Par Level' in df.columns:
-            par_col_idx = df.columns.get_loc('Par Level')
-            highlight_format = workbook.add_format({'bg_color': '#FFCCCC'})
-            for row_idx, par_value in enumerate(df['Par Level'], start=1):  # start=1 to skip header
-                if par_value <= 2:
-                    worksheet.set_row(row_idx, None, highlight_format)
-    output.seek(0)
+    # Excel report is only built on request and reused until the inventory changes
+    export = st.session_state.get('inventory_export')
+    if export is None or export[0] != store.version:
+        if st.button("📄 Prepare Inventory Report (Excel)", key="prepare_inventory_export"):
+            with timed_phase("excel_export", rows=store.item_count) as perf:
+                export = (store.version, build_inventory_export(store.frame))
+                perf["bytes"] = len(export[1])
+            st.session_state.inventory_export = export
+    if export is not None and export[0] == store.version:
+        st.download_button(
+            label="📥 Download Inventory Report (Excel)",
+            data=export[1],
+            file_name="inventory_report.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+# --- REORDER LIST ---
+def reorder_list_section():
+    store = st.session_state.inventory_store
+    st.subheader("🛒 Reorder List")
+    if not store.item_count:
+        st.info("No inventory data to forecast from.")
+        return
+    # Off by default: the forecast needs the whole table in memory, not just the visible page
+    if not st.checkbox("Show items due for reorder", key="reorder_show"):
+        return
+    opts = st.columns(2)
+    lead_days = opts[0].number_input("Lead time (days)", min_value=0, step=1, value=reorder_lead_days, key="reorder_lead_days")
+    cover_days = opts[1].number_input("Cover without history (days)", min_value=1, step=1, value=reorder_cover_days,
+                                      key="reorder_cover_days", help="Ordering cycle for items with no order history or Frequency")
+    with timed_phase("reorder_plan", rows=store.item_count) as perf:
+        plan = store.reorder_list(lead_days=int(lead_days), cover_days=int(cover_days))
+        perf["items"] = len(plan)
+    if not len(plan):
+        st.success("Nothing is projected to fall to par within the lead time.")
+        return
+    st.caption(f"{len(plan)} item(s) due, estimated ${plan['Est. Cost'].sum():,.2f}")
+    st.dataframe(
+        plan,
+        hide_index=True,
+        column_config={
+            "Item": st.column_config.TextColumn("Item", width="large"),
+            "Last Ordered": st.column_config.DateColumn("Last Ordered", format="YYYY-MM-DD"),
+            "Unit Cost": st.column_config.NumberColumn("Unit Cost", format="$%.2f"),
+            "Est. Cost": st.column_config.NumberColumn("Est. Cost", format="$%.2f"),
+        },
+    )
     st.download_button(
-        label="📥 Download Inventory Report (Excel)",
-        data=output,
-        file_name="inventory_report.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        label="📥 Download Reorder List (CSV)",
+        data=plan.to_csv(index=False).encode("utf-8"),
+        file_name="reorder_list.csv",
+        mime="text/csv",
+        key="reorder_download",
     )
 
 # --- METRICS TAB ---
+metrics_required_columns = ['Price', 'Client #', 'Ref. Phy.', 'Description of Service']
+metrics_key_columns = ['Client #', 'Ref. Phy.', 'Description of Service']
+
 def calculate_metrics(df):
+    # One grouped pass over the raw rows (cost sum and row count per client/provider/lab type);
+    # every reported aggregate is then rolled up from that much smaller table.
+    keys = {col: df[col].astype('category') for col in metrics_key_columns}
+    grouped = df['Price'].groupby([keys[col] for col in metrics_key_columns], observed=True, dropna=False).agg(['sum', 'size'])
+    grouped = grouped.reset_index()
     metrics = {}
-    metrics['total_cost'] = df['Price'].sum()
-    cost_per_location = df.groupby('Client #')['Price'].sum().reset_index()
+    metrics['total_cost'] = grouped['sum'].sum()
+    cost_per_location = grouped.groupby('Client #', observed=True)['sum'].sum().rename('Price').reset_index()
     metrics['total_cost_per_location'] = cost_per_location.to_dict(orient='records')
-    ordering_per_provider_labtype = df.groupby(['Ref. Phy.', 'Description of Service']).size().reset_index(name='Order_Count')
+    ordering_per_provider_labtype = grouped.groupby(['Ref. Phy.', 'Description of Service'], observed=True)['size'].sum().rename('Order_Count').reset_index()
     metrics['ordering_per_provider_labtype'] = ordering_per_provider_labtype.to_dict(orient='records')
-    cost_per_provider = df.groupby('Ref. Phy.')['Price'].sum().reset_index()
+    cost_per_provider = grouped.groupby('Ref. Phy.', observed=True)['sum'].sum().rename('Price').reset_index()
     metrics['total_cost_per_provider'] = cost_per_provider.to_dict(orient='records')
-    lab_type_count = df['Description of Service'].value_counts().reset_index()
+    lab_type_count = grouped.groupby('Description of Service', observed=True)['size'].sum().sort_values(ascending=False, kind='stable').reset_index()
     lab_type_count.columns = ['Description of Service', 'count']
     metrics['lab_type_count'] = lab_type_count.to_dict(orient='records')
     return metrics
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_quest_metrics(content_hash, _data):
+    # Memoized by the file's content hash; _data is not hashed by Streamlit
+    df = get_parse_cache().get_or_parse(_data, "excel")
+    df.columns = df.columns.str.strip()
+    missing = [col for col in metrics_required_columns if col not in df.columns]
+    metrics = calculate_metrics(df) if not missing else None
+    return df.head(), missing, metrics
+
+def build_metrics_workbook(metrics):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        pd.DataFrame([{'total_cost': metrics['total_cost']}]).to_excel(writer, sheet_name='Total Cost', index=False)
+        pd.DataFrame(metrics['total_cost_per_location']).to_excel(writer, sheet_name='Cost per Client', index=False)
+        pd.DataFrame(metrics['ordering_per_provider_labtype']).to_excel(writer, sheet_name='Ordering per Provider', index=False)
+        pd.DataFrame(metrics['total_cost_per_provider']).to_excel(writer, sheet_name='Cost per Provider', index=False)
+        pd.DataFrame(metrics['lab_type_count']).to_excel(writer, sheet_name='Lab Type Count', index=False)
+    return output.getvalue()
+
 def metrics_tab():
     st.header("📊 Upload Metrics Excel (De-identified)")
-    metrics_file = st.file_uploader("Upload Excel file for Metrics (de-identified only)", type=["xlsx"], key="metrics_excel")
+    metrics_files = st.file_uploader("Upload Excel file(s) for Metrics (de-identified only)", type=["xlsx"], key="metrics_excel", accept_multiple_files=True)
+    metrics_file = None
+    if metrics_files:
+        names = [f.name for f in metrics_files]
+        selected = st.selectbox("Show metrics for", names, key="metrics_selected_file") if len(names) > 1 else names[0]
+        metrics_file = metrics_files[names.index(selected)]
     if metrics_file is not None:
-        df = pd.read_excel(metrics_file)
-        df.columns = df.columns.str.strip()
-        st.write("Data Preview", df.head())
-        required_columns = ['Price', 'Client #', 'Ref. Phy.', 'Description of Service']
-        missing = [col for col in required_columns if col not in df.columns]
+        content_hash = upload_key(metrics_file)
+        with timed_phase("metrics_load", bytes=metrics_file.size):
+            preview, missing, metrics = load_quest_metrics(content_hash, metrics_file.getvalue())
+        st.write("Data Preview", preview)
         if missing:
             st.error(f"❌ Missing required column(s): {missing}")
         else:
-            metrics = calculate_metrics(df)
             st.write("💰 Total Cost", metrics['total_cost'])
             st.write("🏥 Cost per Client", metrics['total_cost_per_location'])
             st.write("📦 Orders per Provider and Lab Type", metrics['ordering_per_provider_labtype'])
             st.write("🧾 Total Cost per Provider", metrics['total_cost_per_provider'])
             st.write("🧪 Lab Type Count", metrics['lab_type_count'])
-            import io
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                pd.DataFrame([{'total_cost': metrics['total_cost']}]).to_excel(writer, sheet_name='Total Cost', index=False)
-                pd.DataFrame(metrics['total_cost_per_location']).to_excel(writer, sheet_name='Cost per Client', index=False)
-                pd.DataFrame(metrics['ordering_per_provider_labtype']).to_excel(writer, sheet_name='Ordering per Provider', index=False)
-                pd.DataFrame(metrics['total_cost_per_provider']).to_excel(writer, sheet_name='Cost per Provider', index=False)
-                pd.DataFrame(metrics['lab_type_count']).to_excel(writer, sheet_name='Lab Type Count', index=False)
-            output.seek(0)
-            st.download_button(
-                label="📥 Download Metrics Excel",
-                data=output,
-                file_name="metrics_output.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            # Workbook is only built when requested, then reused for the same file
+            export = st.session_state.get('metrics_export')
+            if export is None or export[0] != content_hash:
+                if st.button("📄 Prepare Metrics Excel", key="prepare_metrics_export"):
+                    with timed_phase("metrics_workbook") as perf:
+                        export = (content_hash, build_metrics_workbook(metrics))
+                        perf["bytes"] = len(export[1])
+                    st.session_state.metrics_export = export
+            if export is not None and export[0] == content_hash:
+                st.download_button(
+                    label="📥 Download Metrics Excel",
+                    data=export[1],
+                    file_name="metrics_output.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+    if metrics_files:
+        metrics_history_ingest(metrics_files)
+    metrics_trends_section()
+
+def metrics_history_ingest(metrics_files):
+    st.subheader("🗂️ Save to Monthly History")
+    months = {}
+    for f in metrics_files:
+        guess = guess_metrics_month(upload_key(f), f.getvalue(), f.name)
+        months[f.name] = st.text_input(f"Month (YYYY-MM) for {f.name}", value=guess or datetime.today().strftime('%Y-%m'), key=f"metrics_month_{f.name}")
+    if st.button("Save Files to History", key="metrics_save_history"):
+        added = 0
+        for f in metrics_files:
+            month = months[f.name].strip()
+            if not re.fullmatch(r"\d{4}-\d{2}", month):
+                st.error(f"❌ {f.name}: month must look like 2024-01")
+                continue
+            df = get_parse_cache().get_or_parse(f.getvalue(), "excel")
+            df.columns = df.columns.str.strip()
+            missing = [col for col in metrics_required_columns if col not in df.columns]
+            if missing:
+                st.error(f"❌ {f.name}: missing required column(s): {missing}")
+            else:
+                with timed_phase("metrics_history_ingest", rows=len(df), bytes=f.size) as perf:
+                    perf["added"] = ingest_metrics_file(df, upload_key(f), month)
+                added += perf["added"]
+        st.success(f"Saved {added} new file(s); files already in history were skipped.")
+
+def metrics_trends_section():
+    months = cached_metrics_months()
+    if not months:
+        return
+    st.subheader("📈 Trends Across Months")
+    chosen = st.multiselect("Months", months, default=months[-12:], key="metrics_trend_months")
+    if not chosen:
+        return
+    try:
+        trends = calculate_metric_trends(load_metrics_history(chosen))
+    except Exception as e:
+        # A damaged or unreadable partition must not take the rest of the tab down
+        st.error(f"❌ Could not load the metrics history: {e}")
+        return
+    st.write("💰 Total Cost by Month")
+    st.bar_chart(trends['total_cost_by_month'])
+    st.write("🧾 Cost per Provider by Month", trends['cost_per_provider'])
+    st.write("🧪 Lab Type Volume by Month", trends['lab_type_volume'])
+
+# --- METRICS HISTORY (PARQUET) ---
+# Each Quest file is converted once into metrics_cache/month=YYYY-MM/<content hash>.parquet.
+# Trend queries read only the metric columns from the month partitions, never the Excel files.
+metrics_cache_dir = os.environ.get("METRICS_CACHE_DIR", "metrics_cache")
+
+def infer_metrics_month(df, filename):
+    # Most common month of the first date-like column, else a YYYY-MM / YYYY_MM pattern in the file name
+    for col in df.columns:
+        if 'date' in str(col).lower():
+            dates = pd.to_datetime(df[col], errors='coerce', format='mixed').dropna()
+            if len(dates):
+                return dates.dt.to_period('M').mode().iloc[0].strftime('%Y-%m')
+    match = re.search(r"(20\d{2})[-_ ]?(0[1-9]|1[0-2])", filename)
+    if match:
+        return f"{match.group(1)}-{match.group(2)}"
+    return None
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def guess_metrics_month(content_hash, _data, filename):
+    return infer_metrics_month(get_parse_cache().get_or_parse(_data, "excel"), filename)
+
+def metrics_partition_path(month, content_hash):
+    return os.path.join(metrics_cache_dir, f"month={month}", f"{content_hash}.parquet")
+
+def cached_metrics_months():
+    if not os.path.isdir(metrics_cache_dir):
+        return []
+    return sorted(d.split("=", 1)[1] for d in os.listdir(metrics_cache_dir) if d.startswith("month="))
+
+def ingest_metrics_file(df, content_hash, month):
+    # Returns False when this file is already stored under any month
+    for existing in cached_metrics_months():
+        if os.path.exists(metrics_partition_path(existing, content_hash)):
+            return False
+    # Fixed column types keep the schema identical across partitions; Price is always float64, even
+    # for a month with only whole-dollar prices
+    out = pd.DataFrame({
+        col: pd.to_numeric(df[col], errors='coerce').astype('float64') if col == 'Price' else df[col].astype('string')
+        for col in df.columns
+    })
+    path = metrics_partition_path(month, content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    out.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return True
+
+def load_metrics_history(months):
+    # Column pruning + partition filter: only the metric columns of the chosen months are read. The
+    # explicit schema also casts partitions written before Price was fixed to float64.
+    pa = lazy_import("pyarrow")
+    schema = pa.schema([(col, pa.float64() if col == 'Price' else pa.string()) for col in metrics_required_columns + ['month']])
+    return pd.read_parquet(
+        metrics_cache_dir,
+        columns=metrics_required_columns + ['month'],
+        filters=[('month', 'in', list(months))],
+        schema=schema,
+    )
+
+def calculate_metric_trends(history):
+    history = history.assign(month=history['month'].astype(str))
+    keys = [history['month']] + [history[col].astype('category') for col in ['Ref. Phy.', 'Description of Service']]
+    grouped = history['Price'].groupby(keys, observed=True, dropna=False).agg(['sum', 'size']).reset_index()
+    return {
+        'total_cost_by_month': grouped.groupby('month')['sum'].sum(),
+        'cost_per_provider': grouped.pivot_table(index='month', columns='Ref. Phy.', values='sum', aggfunc='sum', fill_value=0, observed=True),
+        'lab_type_volume': grouped.pivot_table(index='month', columns='Description of Service', values='size', aggfunc='sum', fill_value=0, observed=True),
+    }
+
+# --- DRIVE UPLOAD QUEUE ---
+drive_folder_id = "1cuvahUyju2zXLnvyeOYvLMRU6cwxJLPP"  # <-- Clinic's shared folder ID
+drive_credentials_file = "inventory-project-465214-529cdd128db9.json"
+# Set to a local fake Drive server (e.g. http://localhost:8089/) to test uploads without Google
+drive_api_endpoint = os.environ.get("DRIVE_API_ENDPOINT")
+drive_chunk_size = 4 * 1024 * 1024  # must be a multiple of 256 KB
+drive_upload_workers = 4
+# Finished jobs kept for sessions to show; older ones are dropped as new jobs come in
+drive_job_history = 200
+
+@st.cache_resource
+def get_drive_credentials():
+    return lazy_import("google.oauth2.service_account").Credentials.from_service_account_file(
+        drive_credentials_file,
+        scopes=["https://www.googleapis.com/auth/drive.file"]
+    )
+
+def build_drive_service():
+    if drive_api_endpoint:
+        # The static discovery document with its root swapped, so API and upload URLs both hit the fake server
+        doc = json.loads(lazy_import("googleapiclient.discovery_cache").get_static_doc("drive", "v3"))
+        doc["rootUrl"] = drive_api_endpoint.rstrip("/") + "/"
+        return lazy_import("googleapiclient.discovery").build_from_document(
+            doc, credentials=lazy_import("google.auth.credentials").AnonymousCredentials())
+    return lazy_import("googleapiclient.discovery").build("drive", "v3", credentials=get_drive_credentials(), cache_discovery=False)
+
+class DriveUploadJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, name, digest, folder_id):
+        self.id = next(self._ids)
+        self.name = name
+        self.digest = digest
+        self.folder_id = folder_id
+        self.status = "queued"
+        self.progress = 0.0
+        self.file_id = None
+        self.error = None
+
+    @property
+    def active(self):
+        return self.status in ("queued", "checking", "uploading")
+
+class DriveUploader:
+    # Background upload queue shared by all sessions. Each worker thread builds its own Drive client
+    # once (the underlying httplib2 connection is not thread-safe) and reuses it for every job.
+    def __init__(self, service_factory=build_drive_service, max_workers=drive_upload_workers):
+        self._service_factory = service_factory
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="drive-upload")
+        self._lock = threading.Lock()
+        self.jobs = {}
+        self._inflight = {}
+
+    def _service(self):
+        if getattr(self._local, "service", None) is None:
+            self._local.service = self._service_factory()
+        return self._local.service
+
+    def submit(self, name, data, mimetype, folder_id=drive_folder_id):
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            # The same file already queued or uploading (e.g. from another session) is not sent twice
+            existing = self._inflight.get((folder_id, digest))
+            if existing is not None and existing.active:
+                return existing
+            job = DriveUploadJob(name, digest, folder_id)
+            self.jobs[job.id] = job
+            self._inflight[(folder_id, digest)] = job
+            self._prune()
+        self._pool.submit(self._run, job, data, mimetype)
+        return job
+
+    def _prune(self):
+        # Called under the lock; jobs are in submission order
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:max(len(finished) - drive_job_history, 0)]:
+            del self.jobs[job_id]
+        self._inflight = {key: job for key, job in self._inflight.items() if job.active}
+
+    def find_existing(self, service, folder_id, digest):
+        query = (f"'{folder_id}' in parents and trashed = false and "
+                 f"appProperties has {{ key='sha256' and value='{digest}' }}")
+        found = service.files().list(q=query, fields="files(id, name)", pageSize=1).execute().get("files", [])
+        return found[0]["id"] if found else None
+
+    def _run(self, job, data, mimetype):
+        # Worker thread: logged without a session or rerun
+        with timed_phase("drive_upload", bytes=len(data), digest=job.digest[:12]) as perf:
+            self._upload(job, data, mimetype)
+            perf["status"] = job.status
+
+    def _upload(self, job, data, mimetype):
+        try:
+            service = self._service()
+            job.status = "checking"
+            existing_id = self.find_existing(service, job.folder_id, job.digest)
+            if existing_id:
+                job.file_id, job.progress, job.status = existing_id, 1.0, "skipped"
+                return
+            job.status = "uploading"
+            media = lazy_import("googleapiclient.http").MediaIoBaseUpload(io.BytesIO(data), mimetype=mimetype or "application/octet-stream",
+                                      chunksize=drive_chunk_size, resumable=True)
+            request = service.files().create(
+                body={"name": job.name, "parents": [job.folder_id], "appProperties": {"sha256": job.digest}},
+                media_body=media,
+                fields="id"
             )
+            response = None
+            while response is None:
+                status, response = request.next_chunk(num_retries=3)
+                if status:
+                    job.progress = status.progress()
+            job.file_id, job.progress, job.status = response.get("id"), 1.0, "done"
+        except Exception as e:
+            job.error, job.status = str(e), "failed"
+
+@st.cache_resource
+def get_drive_uploader():
+    return DriveUploader()
 
 # --- DRIVE UPLOAD TAB ---
+def render_drive_jobs(job_ids):
+    # Returns True while any of these uploads is still running
+    uploader = get_drive_uploader()
+    jobs = [uploader.jobs[j] for j in job_ids if j in uploader.jobs]
+    for job in jobs:
+        if job.status == "done":
+            st.success(f"✅ {job.name} uploaded successfully to Google Drive! File ID: {job.file_id}")
+        elif job.status == "skipped":
+            st.info(f"⏭️ {job.name} is already in the Drive folder. File ID: {job.file_id}")
+        elif job.status == "failed":
+            st.error(f"❌ Upload of {job.name} failed: {job.error}")
+        else:
+            st.progress(job.progress, text=f"{job.name}: {job.status} ({job.progress:.0%})")
+    return any(job.active for job in jobs)
+
 def drive_upload_tab():
     st.header("Upload File to Google Drive")
     st.markdown("""
     Upload a file to the clinic's shared Google Drive folder. Only authorized staff can access uploaded files.
     """)
-    uploaded_file = st.file_uploader("Choose a file to upload to Drive")
-    folder_id = "1cuvahUyju2zXLnvyeOYvLMRU6cwxJLPP"  # <-- Clinic's shared folder ID
-    if uploaded_file is not None:
-        # Authenticate with service account
-        credentials = service_account.Credentials.from_service_account_file(
-            "inventory-project-465214-529cdd128db9.json",
-            scopes=["https://www.googleapis.com/auth/drive.file"]
+    uploaded_files = st.file_uploader("Choose file(s) to upload to Drive", accept_multiple_files=True, key="drive_files")
+    uploader = get_drive_uploader()
+    # Each file is queued once per session; later reruns only show its status, and failed uploads of
+    # files still selected are queued again on request
+    session_jobs = st.session_state.setdefault('drive_jobs', {})
+    files = {upload_key(uploaded_file): uploaded_file for uploaded_file in uploaded_files or []}
+    failed = [digest for digest in files if session_jobs.get(digest) in uploader.jobs
+              and uploader.jobs[session_jobs[digest]].status == "failed"]
+    retry = bool(failed) and st.button(f"🔁 Retry {len(failed)} failed upload(s)", key="drive_retry")
+    for digest, uploaded_file in files.items():
+        if digest not in session_jobs or (retry and digest in failed):
+            with timed_phase("drive_submit", bytes=uploaded_file.size):
+                session_jobs[digest] = uploader.submit(uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type).id
+    job_ids = list(session_jobs.values())
+    if hasattr(st, "fragment") and any(uploader.jobs[j].active for j in job_ids if j in uploader.jobs):
+        @st.fragment(run_every=1)
+        def live_status():
+            if not render_drive_jobs(job_ids):
+                st.rerun()
+        live_status()
+    else:
+        render_drive_jobs(job_ids)
+        if any(uploader.jobs[j].active for j in job_ids if j in uploader.jobs):
+            st.button("🔄 Refresh Upload Status")
+
+# --- HEALTH AI MAP-REDUCE ---
+healthai_model = "claude-opus-4-20250514"
+healthai_max_tokens = 1024
+healthai_chunk_chars = 12000  # per-request budget for the data part of the message
+healthai_workers = 4
+healthai_max_retries = 5
+# "anthropic" for the real API, "stub" for an offline client that answers every chunk locally
+healthai_llm_backend = os.environ.get("HEALTHAI_LLM", "anthropic")
+healthai_table_instruction = ("Format your output as a CSV inside a Markdown code block (```csv). "
+                              "Include column headers.")
+
+class AnthropicLLM:
+    def __init__(self, api_key, model=healthai_model, max_tokens=healthai_max_tokens):
+        self.client = lazy_import("anthropic").Anthropic(api_key=api_key, max_retries=0)
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def complete(self, message):
+        response = self.client.messages.create(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            messages=[{"role": "user", "content": message}]
         )
-        service = build("drive", "v3", credentials=credentials)
-        # Prepare file for upload
-        file_metadata = {"name": uploaded_file.name, "parents": [folder_id]}
-        media = MediaIoBaseUpload(uploaded_file, mimetype=uploaded_file.type)
+        if hasattr(response, "content") and response.content:
+            return response.content[0].text if hasattr(response.content[0], "text") else str(response.content[0])
+        return str(response)
+
+    def stream(self, message):
+        with self.client.messages.stream(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            messages=[{"role": "user", "content": message}]
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
+
+class StubLLM:
+    # Offline stand-in: reports the row count of each chunk as a CSV table
+    model = "stub"
+
+    def complete(self, message):
+        data = message.split("\n\nUser prompt:", 1)[0]
+        rows = max(data.count("\n") - 2, 0)  # minus the intro line and the CSV header
+        return f"```csv\nrows\n{rows}\n```"
+
+    def stream(self, message):
+        reply = self.complete(message)
+        for i in range(0, len(reply), 4):
+            yield reply[i:i + 4]
+
+def make_llm_client(api_key, backend=None, model=healthai_model):
+    backend = backend or healthai_llm_backend
+    if backend == "stub":
+        return StubLLM()
+    return AnthropicLLM(api_key, model=model)
+
+def is_retryable_llm_error(e):
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, (ConnectionError, TimeoutError)) or type(e).__name__ in ("APIConnectionError", "APITimeoutError")
+
+def complete_with_backoff(llm, message, retries=healthai_max_retries, base_delay=1.0):
+    for attempt in range(retries + 1):
         try:
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields="id"
-            ).execute()
-            st.success(f"✅ File uploaded successfully to Google Drive! File ID: {file.get('id')}")
+            return llm.complete(message)
         except Exception as e:
-            st.error(f"❌ Upload failed: {e}")
+            if attempt == retries or not is_retryable_llm_error(e):
+                raise
+            # Exponential backoff with jitter so parallel chunks don't retry in lockstep
+            time.sleep(min(base_delay * 2 ** attempt, 30) * (0.5 + random.random()))
+
+def stream_with_backoff(llm, message, retries=healthai_max_retries, base_delay=1.0):
+    # Retries only while nothing has been yielded, so the caller never sees duplicated text
+    for attempt in range(retries + 1):
+        started = False
+        try:
+            for text in llm.stream(message):
+                started = True
+                yield text
+            return
+        except Exception as e:
+            if started or attempt == retries or not is_retryable_llm_error(e):
+                raise
+            time.sleep(min(base_delay * 2 ** attempt, 30) * (0.5 + random.random()))
+
+def frame_csv_chunks(df, budget=healthai_chunk_chars):
+    # Splits a frame into CSV texts (each with the header) of roughly `budget` characters
+    if df.empty:
+        return [df.to_csv(index=False)]
+    header = ",".join(map(str, df.columns)) + "\n"
+    row_chars = np.ones(len(df), dtype=np.int64) * len(df.columns)
+    for col in df.columns:
+        row_chars += df[col].astype(str).str.len().to_numpy(dtype=np.int64)
+    room = max(budget - len(header), 1)
+    chunk_ids = (np.cumsum(row_chars) - row_chars) // room
+    bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(df)]))
+    return [df.iloc[a:b].to_csv(index=False) for a, b in zip(starts, ends)]
+
+def text_chunks(text, budget=healthai_chunk_chars):
+    chunks, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        if current and size + len(line) > budget:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current or not chunks:
+        chunks.append("".join(current))
+    return chunks
+
+def extract_csv_table(reply):
+    # CSV from the first code block (or the bare reply) when it looks like a table
+    csv_text = reply
+    match = re.search(r"```(?:csv|text)?[ \t]*\n([\s\S]+?)```", reply, re.IGNORECASE)
+    if not match:
+        match = re.search(r"```([\s\S]+?)```", reply, re.IGNORECASE)
+    if match:
+        csv_text = match.group(1).strip()
+    # Bare replies only count as a table when they look like CSV (several commas over 2+ lines)
+    if '\n' not in csv_text or (not match and csv_text.count(',') <= 2):
+        return None
+    try:
+        return pd.read_csv(io.StringIO(csv_text))
+    except Exception:
+        return None
+
+class CsvBlockScanner:
+    # Fed a reply as it streams in; returns each fenced code block's table as soon as its fence closes
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+
+    def feed(self, delta):
+        self.text += delta
+        tables = []
+        while True:
+            start = self.text.find("```", self.pos)
+            if start < 0:
+                break
+            body = self.text.find("\n", start)
+            if body < 0:
+                break
+            end = self.text.find("```", body)
+            if end < 0:
+                break
+            table = extract_csv_table(self.text[start:end + 3])
+            if table is not None:
+                tables.append(table)
+            self.pos = end + 3
+        return tables
+
+def extract_csv_tables(reply):
+    return CsvBlockScanner().feed(reply)
+
+def healthai_chunk_messages(chunks, prompt, intro="Health data file contents"):
+    total = len(chunks)
+    if total == 1:
+        return [f"{intro}:\n{chunks[0]}\n\nUser prompt: {prompt}"]
+    return [
+        f"{intro} (part {i + 1} of {total}):\n{chunk}\n\n"
+        f"User prompt: {prompt}\n\n"
+        f"This is only part of the file; answer for this part alone. {healthai_table_instruction}"
+        for i, chunk in enumerate(chunks)
+    ]
+
+def map_healthai_chunks(llm, chunks, prompt, workers=healthai_workers, on_progress=None, intro="Health data file contents"):
+    # Sends every chunk concurrently; returns the replies in chunk order
+    total = len(chunks)
+    messages = healthai_chunk_messages(chunks, prompt, intro)
+    replies = [None] * total
+    with ThreadPoolExecutor(max_workers=min(workers, total)) as pool:
+        futures = {pool.submit(complete_with_backoff, llm, m): i for i, m in enumerate(messages)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            replies[futures[future]] = future.result()
+            if on_progress:
+                on_progress(done, total)
+    return replies
+
+def merge_partial_tables(tables):
+    tables = [t for t in tables if t is not None and not t.empty]
+    if not tables:
+        return None
+    return pd.concat(tables, ignore_index=True, sort=False)
+
+def reduce_healthai_message(merged, prompt):
+    # Optional final pass: asks the model to combine the per-chunk tables into one answer
+    return (f"The following table concatenates partial results computed separately on consecutive parts "
+               f"of one health data file:\n{merged.to_csv(index=False)}\n\n"
+               f"Original user prompt: {prompt}\n\n"
+               f"Combine the partial results into a single answer for the whole file. {healthai_table_instruction}")
+
+def reduce_healthai_tables(llm, merged, prompt):
+    return complete_with_backoff(llm, reduce_healthai_message(merged, prompt))
+
+# --- HEALTH AI PRE-AGGREGATION ---
+# Aggregate questions rarely need raw rows: a local profile of the whole file is a few KB at any size.
+healthai_profile_max_categories = 25
+healthai_profile_top_values = 10
+healthai_aggregations = ["count", "sum", "mean", "median", "min", "max"]
+
+def profile_frame(df, group_by=None, max_categories=healthai_profile_max_categories, top_values=healthai_profile_top_values):
+    numeric = df.select_dtypes("number").columns.tolist()
+    dates = df.select_dtypes("datetime").columns.tolist()
+    unique = df.nunique(dropna=True)
+    sections = [f"Rows: {len(df)}, columns: {len(df.columns)}"]
+    columns = pd.DataFrame({"dtype": df.dtypes.astype(str), "non_null": df.notna().sum(), "distinct": unique})
+    sections.append("Columns:\n" + columns.to_csv(index_label="column"))
+    if numeric:
+        sections.append("Numeric summary:\n" + df[numeric].describe().T.round(4).to_csv(index_label="column"))
+    for col in dates:
+        sections.append(f"Date range of {col}: {df[col].min()} to {df[col].max()}")
+    for col in df.columns:
+        if col in numeric or col in dates or unique[col] == 0:
+            continue
+        if unique[col] == df[col].notna().sum() and unique[col] > max_categories:
+            sections.append(f"{col}: {unique[col]} distinct values (identifier-like, one per row)")
+            continue
+        counts = df[col].value_counts(dropna=False).head(top_values)
+        sections.append(f"Top values of {col} ({unique[col]} distinct):\n" + counts.to_csv())
+    if group_by is None:
+        # Default breakdowns: the low-cardinality text columns
+        group_by = [c for c in df.columns if c not in numeric and c not in dates and 1 < unique[c] <= max_categories][:3]
+    for col in group_by:
+        grouped = df.groupby(col, dropna=False)
+        summary = grouped[numeric].agg(["sum", "mean"]) if numeric else pd.DataFrame(index=grouped.size().index)
+        summary.columns = [f"{c}_{agg}" for c, agg in summary.columns] if numeric else summary.columns
+        summary.insert(0, "rows", grouped.size())
+        summary = summary.sort_values("rows", ascending=False).head(max_categories)
+        sections.append(f"Summary by {col}:\n" + summary.round(4).to_csv())
+    return "\n\n".join(section.rstrip() for section in sections)
+
+def aggregate_view(df, group_by, value_columns, aggregations):
+    grouped = df.groupby(list(group_by), dropna=False)
+    if not value_columns or not aggregations:
+        return grouped.size().rename("rows").reset_index()
+    view = grouped[list(value_columns)].agg(list(aggregations))
+    view.columns = [f"{c}_{agg}" for c, agg in view.columns]
+    view.insert(0, "rows", grouped.size())
+    return view.reset_index()
+
+# --- HEALTH AI RESPONSE CACHE ---
+healthai_cache_dir = os.environ.get("HEALTHAI_CACHE_DIR", "healthai_cache")
+healthai_cache_max_bytes = 50 * 1024 * 1024
+
+class HealthAIResponseCache:
+    # One JSON file per reply; file mtimes double as the LRU order for size-based eviction
+    def __init__(self, directory=healthai_cache_dir, max_bytes=healthai_cache_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(content_hash, prompt, model, variant=""):
+        return hashlib.sha256(json.dumps([content_hash, prompt, model, variant]).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    info = os.stat(os.path.join(self.directory, name))
+                    files.append((info.st_mtime, info.st_size, name))
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+
+@st.cache_resource
+def get_healthai_cache():
+    return HealthAIResponseCache()
+
+def healthai_read_file(uploaded_file):
+    # Returns (frame, text); frame is None when the file is not tabular
+    df, file_content = None, None
+    if uploaded_file.type in ["text/csv", "text/plain"]:
+        file_content = uploaded_file.getvalue().decode("utf-8")
+        if uploaded_file.name.lower().endswith(".csv"):
+            try:
+                df = read_report(uploaded_file, reader="csv")
+            except Exception:
+                df = None
+    elif uploaded_file.type in ["application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "application/vnd.ms-excel"]:
+        df = read_report(uploaded_file)
+    else:
+        raise ValueError("Unsupported file type.")
+    return df, file_content
+
+def healthai_read_upload(uploaded_file):
+    # (frame, text, error) with the parse timed; errors are returned for the caller to show
+    try:
+        with timed_phase("healthai_read", bytes=uploaded_file.size) as perf:
+            df, file_content = healthai_read_file(uploaded_file)
+            perf["rows"] = len(df) if df is not None else None
+        return df, file_content, None
+    except Exception as e:
+        return None, None, e
+
+def healthai_file_chunks(df, file_content, whole_file):
+    # Tabular files are chunked by rows so every chunk keeps the header
+    if not whole_file:
+        content = file_content if file_content is not None else df.to_csv(index=False)
+        return [content[:healthai_chunk_chars]]
+    if df is not None:
+        return frame_csv_chunks(df)
+    return text_chunks(file_content)
+
+def render_streamed_reply(deltas):
+    # Shows the reply as it arrives and previews the first table once its code block closes
+    text_slot = st.empty()
+    table_slot = st.empty()
+    scanner = CsvBlockScanner()
+    reply = ""
+    shown_table = False
+    for delta in deltas:
+        reply += delta
+        text_slot.markdown(reply)
+        tables = scanner.feed(delta)
+        if tables and not shown_table:
+            table_slot.dataframe(tables[0])
+            shown_table = True
+    return reply
 
 # --- HEALTH AI TAB ---
 def healthai_tab():
@@ -556,6 +3466,29 @@ def healthai_tab():
     """)
     uploaded_file = st.file_uploader("Upload health data file", type=["csv", "xlsx", "txt"], key="healthai_file")
     prompt = st.text_area("Enter your question or analysis prompt for the AI:")
+    df, file_content, read_error = None, None, None
+    payload = "Raw rows"
+    if uploaded_file and uploaded_file.name.lower().endswith((".csv", ".xlsx")):
+        payload = st.radio("Send", ["Raw rows", "Statistical profile", "Aggregated view"], horizontal=True, key="healthai_payload",
+                           help="A profile or aggregated view is computed locally over every row and is far smaller than the raw data.")
+    if payload != "Raw rows":
+        # These need the file's columns up front; raw rows are only read on a response-cache miss
+        df, file_content, read_error = healthai_read_upload(uploaded_file)
+        if df is None:
+            st.error(f"Error reading file: {read_error}" if read_error is not None else "This file could not be read as a table.")
+            return
+    mode, combine, group_by, value_columns, aggregations = None, False, [], [], []
+    if payload == "Raw rows":
+        mode = st.radio("Coverage", ["Whole file (map-reduce)", "First 12,000 characters"], horizontal=True, key="healthai_mode")
+        if mode.startswith("Whole"):
+            combine = st.checkbox("Combine the partial tables with a final request", value=True, key="healthai_combine")
+    elif payload == "Statistical profile":
+        group_by = st.multiselect("Break down by (leave empty for automatic)", list(df.columns), key="healthai_profile_groups")
+    else:
+        numeric_columns = df.select_dtypes("number").columns.tolist()
+        group_by = st.multiselect("Group by", list(df.columns), key="healthai_agg_groups")
+        value_columns = st.multiselect("Values", numeric_columns, default=numeric_columns[:3], key="healthai_agg_values")
+        aggregations = st.multiselect("Aggregations", healthai_aggregations, default=["count", "sum", "mean"], key="healthai_agg_funcs")
     api_key = os.environ.get("ANTHROPIC_API_KEY", "sk-ant-REDACTED")
     if st.button("Analyze with Claude"):
         if not api_key:
@@ -564,59 +3497,76 @@ def healthai_tab():
         if not uploaded_file or not prompt:
             st.warning("Please upload a file and enter a prompt.")
             return
-        # Read file content (limit size for demo)
         try:
-            if uploaded_file.type in ["text/csv", "text/plain"]:
-                file_content = uploaded_file.read().decode("utf-8")
-            elif uploaded_file.type in ["application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "application/vnd.ms-excel"]:
-                df = pd.read_excel(uploaded_file)
-                file_content = df.to_csv(index=False)
+            llm = make_llm_client(api_key)
+            cache = get_healthai_cache()
+            if payload == "Raw rows":
+                variant = mode if not mode.startswith("Whole") else f"{mode}|combine={combine}|{healthai_chunk_chars}"
             else:
-                st.error("Unsupported file type.")
-                return
-        except Exception as e:
-            st.error(f"Error reading file: {e}")
-            return
-        # Truncate file_content if too large (Claude has context limits)
-        max_chars = 12000
-        file_content = file_content[:max_chars]
-        user_message = f"Health data file contents:\n{file_content}\n\nUser prompt: {prompt}"
-        st.info("Sending request to Claude using the official SDK...")
-        try:
-            import anthropic
-            client = anthropic.Anthropic(api_key=api_key)
-            response = client.messages.create(
-                model="claude-opus-4-20250514",
-                max_tokens=1024,
-                messages=[{"role": "user", "content": user_message}]
-            )
-            ai_reply = ""
-            if hasattr(response, "content") and response.content:
-                ai_reply = response.content[0].text if hasattr(response.content[0], "text") else str(response.content[0])
+                variant = json.dumps([payload, group_by, value_columns, aggregations])
+            cache_key = cache.key(upload_key(uploaded_file), prompt, llm.model, variant)
+            with timed_phase("healthai_cache_lookup") as perf:
+                cached = cache.get(cache_key)
+                perf["hit"] = cached is not None
+            if cached is not None:
+                st.success("Claude's Analysis:")
+                st.caption("Served from the response cache.")
+                ai_reply, merged_parts = cached["reply"], cached["merged_parts"]
+                st.markdown(ai_reply)
             else:
-                ai_reply = str(response)
-            st.success("Claude's Analysis:")
-            import io
-            import re
-            import pandas as pd
-            from pandas.errors import ParserError
-            # Extract CSV from code block if present
-            csv_text = ai_reply
-            code_block_match = re.search(r"```(?:csv|text)?\\n([\s\S]+?)```", ai_reply, re.IGNORECASE)
-            if not code_block_match:
-                code_block_match = re.search(r"```([\s\S]+?)```", ai_reply, re.IGNORECASE)
-            if code_block_match:
-                csv_text = code_block_match.group(1).strip()
-            # Heuristic: if reply has multiple commas and at least 2 lines, treat as CSV
-            csv_detected = False
-            csv_data = None
-            if csv_text.count(',') > 2 and '\n' in csv_text:
-                try:
-                    csv_data = pd.read_csv(io.StringIO(csv_text))
-                    csv_detected = True
-                except (ParserError, Exception):
-                    csv_detected = False
-            if csv_detected and csv_data is not None:
+                if df is None:
+                    df, file_content, read_error = healthai_read_upload(uploaded_file)
+                if read_error is not None:
+                    st.error(f"Error reading file: {read_error}")
+                    return
+                intro = "Health data file contents"
+                if payload != "Raw rows" and payload != "Statistical profile" and not group_by:
+                    st.warning("Pick at least one column to group by.")
+                    return
+                with timed_phase("healthai_prepare", payload=payload) as perf:
+                    if payload == "Raw rows":
+                        chunks = healthai_file_chunks(df, file_content, mode.startswith("Whole"))
+                    else:
+                        if payload == "Statistical profile":
+                            intro = f"Statistical profile computed locally over all {len(df)} rows of the health data file"
+                            data_text = profile_frame(df, group_by or None)
+                        else:
+                            intro = f"Aggregated view computed locally over all {len(df)} rows of the health data file"
+                            data_text = aggregate_view(df, group_by, value_columns, aggregations).to_csv(index=False)
+                        chunks = text_chunks(data_text)
+                        st.caption(f"Sending {len(data_text):,} characters computed from the {uploaded_file.size:,}-byte file.")
+                    perf["requests"] = len(chunks)
+                    perf["bytes"] = sum(len(c) for c in chunks)
+                merged_parts = False
+                st.info(f"Sending {len(chunks)} request(s) to Claude...")
+                if len(chunks) == 1:
+                    st.success("Claude's Analysis:")
+                    with timed_phase("healthai_stream", model=llm.model) as perf:
+                        ai_reply = render_streamed_reply(stream_with_backoff(llm, healthai_chunk_messages(chunks, prompt, intro)[0]))
+                        perf["reply_chars"] = len(ai_reply)
+                else:
+                    progress = st.progress(0.0)
+                    with timed_phase("healthai_map", model=llm.model, requests=len(chunks)):
+                        replies = map_healthai_chunks(
+                            llm, chunks, prompt, intro=intro,
+                            on_progress=lambda done, total: progress.progress(done / total, text=f"{done}/{total} parts analyzed")
+                        )
+                    merged = merge_partial_tables([extract_csv_table(r) for r in replies])
+                    st.success("Claude's Analysis:")
+                    if merged is not None and combine:
+                        with timed_phase("healthai_stream", model=llm.model, rows=len(merged)) as perf:
+                            ai_reply = render_streamed_reply(stream_with_backoff(llm, reduce_healthai_message(merged, prompt)))
+                            perf["reply_chars"] = len(ai_reply)
+                    else:
+                        merged_parts = True
+                        ai_reply = "\n\n".join(f"**Part {i + 1}:**\n\n{r}" for i, r in enumerate(replies))
+                        st.markdown(ai_reply)
+                cache.put(cache_key, {"reply": ai_reply, "merged_parts": merged_parts})
+            if merged_parts:
+                csv_data = merge_partial_tables(extract_csv_tables(ai_reply))
+            else:
+                csv_data = extract_csv_table(ai_reply)
+            if csv_data is not None:
                 st.write("Detected a table result. Preview:")
                 st.dataframe(csv_data)
                 output = io.BytesIO()
@@ -629,8 +3579,6 @@ def healthai_tab():
                     file_name="claude_result.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
-            else:
-                st.write(ai_reply)
         except Exception as e:
             st.error(f"Claude API request failed: {e}")
 
@@ -639,24 +3587,414 @@ def main():
     # ✅ Safe initialization for session_state
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
-    if 'inventory_data' not in st.session_state:
-        st.session_state.inventory_data = []
+    if 'perf_session' not in st.session_state:
+        st.session_state.perf_session = uuid.uuid4().hex[:8]
+        st.session_state.perf_history = deque(maxlen=perf_history_reruns)
+        st.session_state.perf_reruns = 0
+    st.session_state.perf_reruns += 1
+    rerun = begin_rerun_timings(st.session_state.perf_session, st.session_state.perf_reruns)
+    # finally: st.rerun() leaves the script by raising, and those reruns are still recorded
+    try:
+        if not st.session_state.logged_in:
+            rerun["tab"] = "Login"
+            login()
+        else:
+            if 'inventory_store' not in st.session_state:
+                # Every session works on the one shared table; the handle keeps this session's undo
+                # history. Only created once logged in, so the login page never opens the database.
+                st.session_state.inventory_store = InventoryStore(table=get_inventory_table())
+            st.sidebar.title("MAP Inventory Portal")
+            cache_stats = get_parse_cache().stats()
+            st.sidebar.caption(f"Upload parse cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+            tab = st.sidebar.radio("Navigate", ["Add Inventory", "Quest_Metrics", "Drive_Upload", "HealthAI"])
+            rerun["tab"] = tab
+            if perf_panel_enabled:
+                perf_panel(st.session_state.perf_history)
 
-    if not st.session_state.logged_in:
-        login()
-    else:
-        st.sidebar.title("MAP Inventory Portal")
-        tab = st.sidebar.radio("Navigate", ["Add Inventory", "Quest_Metrics", "Drive_Upload", "HealthAI"])
-
-        if tab == "Add Inventory":
-            inventory_form()
-            display_inventory_table()
-        elif tab == "Quest_Metrics":
-            metrics_tab()
-        elif tab == "Drive_Upload":
-            drive_upload_tab()
-        elif tab == "HealthAI":
-            healthai_tab()
+            if tab == "Add Inventory":
+                st.session_state.inventory_store.sync()
+                inventory_form()
+                display_inventory_table()
+                reorder_list_section()
+            elif tab == "Quest_Metrics":
+                metrics_tab()
+            elif tab == "Drive_Upload":
+                drive_upload_tab()
+            elif tab == "HealthAI":
+                healthai_tab()
+    finally:
+        finished = end_rerun_timings()
+        if finished is not None:
+            st.session_state.perf_history.append(finished)
+
+# --- BATCH INGESTION CLI ---
+# Month-end folders of reports without a browser:
+#   python inventory_portal_final_2.3.py ingest reports/ --out-dir consolidated/ [--db inventory.db]
+# Files are parsed and normalized in a process pool; merging, McKesson allocation and the workbooks
+# are then built in this process, in file-name order.
+report_extensions = ('.csv', '.xlsx', '.xls')
+# McKesson invoice exports carry no department (that is what the allocation adds); they have an order
+# date, an extended cost and either a McKesson column or McKesson's item number with a unit of measure
+mckesson_date_names = {"order date", "invoice date", "ship date", "date ordered"}
+mckesson_cost_names = {"extended cost", "ext cost", "extended price", "ext price", "extended amount"}
+mckesson_item_names = {"item", "item no", "item number", "mck item", "mckesson item"}
+
+def mckesson_columns(columns):
+    # (date position, cost position) when the header looks like a McKesson export, else None
+    names = [_normalize_name(c) for c in columns]
+    date = next((i for i, n in enumerate(names) if n in mckesson_date_names), None)
+    cost = next((i for i, n in enumerate(names) if n in mckesson_cost_names), None)
+    marked = any("mckesson" in n for n in names) or ("uom" in names and any(n in mckesson_item_names for n in names))
+    if date is None or cost is None or not marked or any(_name_score("Department", c) >= 0.9 for c in columns):
+        return None
+    return date, cost
+
+def mckesson_line_keys(data, n):
+    # One import key per invoice line: the file's content hash and the line number
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    return [f"mckesson:{digest}:{i}" for i in range(n)]
+
+def detect_report_kind(name, columns):
+    if "mckesson" in name or mckesson_columns(columns) is not None:
+        return "mckesson"
+    if all(col in columns for col in metrics_required_columns):
+        return "quest"
+    amazon_columns = {c for c in amazon_csv_to_manual.values() if c}
+    if "Title" in columns and len(amazon_columns & set(columns)) >= 4:
+        return "amazon"
+    mapping = suggest_column_mapping(columns)
+    if "Item" in mapping and len(mapping) >= 4:
+        return "inventory_report"
+    return None
+
+def ingest_report_file(path, saved_mappings=None):
+    # Runs in a worker process: everything returned must pickle. Inventory Reports use the mapping
+    # confirmed for the same layout in the web app when there is one.
+    name = os.path.basename(path)
+    lower = name.lower()
+    result = {"file": name, "kind": None, "status": "error", "rows": 0, "defaulted_rows": 0, "message": ""}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        schema = sniff_report_schema(data, lower)
+        kind = detect_report_kind(lower, schema["columns"])
+        if kind is None:
+            raise ValueError("Unrecognised report layout; columns: " + ", ".join(schema["columns"]))
+        if kind == "mckesson":
+            # Columns found by name when the header is recognised, else the usual F (date) and H (cost)
+            found = mckesson_columns(schema["columns"])
+            if found is not None:
+                lines = read_mckesson_report(data, lower, *found, header=schema["header_row"])
+            else:
+                lines = read_mckesson_report(data, lower)
+            result.update(kind="mckesson", rows=len(lines), dates=lines.dates, costs=lines.costs,
+                          keys=mckesson_line_keys(data, len(lines)))
+        else:
+            df = parse_report_bytes(data, "csv" if lower.endswith('.csv') else "excel", header=schema["header_row"])
+            df.columns = clean_columns(df.columns)
+            result.update(kind=kind, rows=len(df))
+            if kind == "quest":
+                result["frame"] = df
+            else:
+                if kind == "amazon":
+                    col_map = amazon_csv_to_manual
+                else:
+                    col_map = (saved_mappings or {}).get(schema["signature"]) or suggest_column_mapping(schema["columns"], schema["kinds"])
+                normalized, errors = normalize_upload(df, col_map, missing=None if kind == "amazon" else "")
+                result.update(frame=normalized, keys=upload_line_keys(df, col_map, kind),
+                              defaulted_rows=int(errors.any(axis=1).sum()) if len(errors.columns) else 0)
+        result["status"] = "ok"
+    except Exception as e:
+        result["message"] = f"{type(e).__name__}: {e}"
+    return result
+
+def consolidate_reports(results, store, fuzzy=False, vendor="McKesson"):
+    # Folds parsed results into the store; returns the combined Quest frame (or None) and the per-file report
+    quest_frames = []
+    for r in results:
+        if r["status"] != "ok":
+            continue
+        try:
+            if r["kind"] in ("amazon", "inventory_report"):
+                counts = merge_upload_rows(store, r["frame"], r["keys"], fuzzy)
+                r.update(inserted=counts["insert"], merged=counts["update"] + counts["fuzzy"], skipped=counts["skip"])
+            elif r["kind"] == "quest":
+                quest_frames.append(r["frame"])
+        except Exception as e:
+            r.update(status="error", message=f"{type(e).__name__}: {e}")
+    # McKesson lines are split by past spend once the other reports are in. Lines whose key was
+    # recorded by an earlier run are left out, so re-ingesting a folder allocates nothing twice.
+    for r in results:
+        if r["status"] == "ok" and r["kind"] == "mckesson":
+            try:
+                lines = McKessonLines(r["dates"], r["costs"])
+                keys = r["keys"]
+                done = np.array([k in store.import_keys for k in keys], dtype=bool)
+                lines.remaining[done] = 0.0
+                template = load_allocation_template(store, vendor) if store.db is not None else None
+                if template is None:
+                    template = department_spend_shares(store.frame, vendor).rename("Share").rename_axis("Department").reset_index()
+                with store.operation(f"McKesson allocation of {int((~done).sum())} line(s)"):
+                    r["inserted"] = apply_mckesson_allocation(store, lines, propose_mckesson_allocation(lines, template, vendor))
+                    store.record_import_keys([k for k, skip in zip(keys, done) if not skip])
+                r["skipped"] = int(done.sum())
+            except Exception as e:
+                r.update(status="error", message=f"{type(e).__name__}: {e}")
+    columns = ["file", "kind", "status", "rows", "defaulted_rows", "inserted", "merged", "skipped", "message"]
+    report = pd.DataFrame([{col: r.get(col) for col in columns} for r in results], columns=columns)
+    report = report.astype({col: "Int64" for col in ["rows", "defaulted_rows", "inserted", "merged", "skipped"]})
+    quest = pd.concat(quest_frames, ignore_index=True) if quest_frames else None
+    return quest, report
+
+def ingest_cli(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="inventory_portal_final_2.3.py ingest", description="Consolidate a folder of Amazon, McKesson, Inventory and Quest reports.")
+    parser.add_argument("folder")
+    parser.add_argument("--out-dir", help="where the workbooks and the error report go (default: <folder>/consolidated)")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument("--db", help="merge into this inventory database instead of a fresh inventory")
+    parser.add_argument("--fuzzy", action="store_true",
+                        help="also merge near-duplicate titles without confirmation (default: exact (Department, Vendor, Item, Unit) matches only)")
+    args = parser.parse_args(argv)
+    out_dir = args.out_dir or os.path.join(args.folder, "consolidated")
+    paths = sorted(
+        os.path.join(args.folder, name) for name in os.listdir(args.folder)
+        if name.lower().endswith(report_extensions) and not name.startswith("~$")
+    )
+    if not paths:
+        print(f"No report files in {args.folder}")
+        return 1
+    started = time.perf_counter()
+    db = InventoryDB(args.db) if args.db else None
+    saved_mappings = db.column_mappings() if db is not None else {}
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(ingest_report_file, paths, [saved_mappings] * len(paths)))
+    store = InventoryStore(db=db)
+    quest, report = consolidate_reports(results, store, fuzzy=args.fuzzy)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "inventory_report.xlsx"), "wb") as f:
+        f.write(build_inventory_export(store.frame))
+    if quest is not None:
+        with open(os.path.join(out_dir, "metrics_output.xlsx"), "wb") as f:
+            f.write(build_metrics_workbook(calculate_metrics(quest)))
+    report.to_csv(os.path.join(out_dir, "ingest_report.csv"), index=False)
+    print(report.drop(columns=["message"]).to_string(index=False))
+    failed = report[report["status"] != "ok"]
+    for row in failed.itertuples(index=False):
+        print(f"ERROR {row.file}: {row.message}")
+    print(f"{len(paths)} file(s) in {time.perf_counter() - started:.1f} s: {store.item_count} inventory rows, "
+          f"{len(failed)} failed. Outputs in {out_dir}")
+    return 1 if len(failed) else 0
+
+# --- BENCHMARKS ---
+# Headless timings on synthetic inputs: python inventory_portal_final_2.3.py bench --sizes 1000,10000 --out bench.json
+bench_default_sizes = [1000, 10000, 100000, 1000000]
+bench_vendors = ["Amazon", "McKesson", "Henry Schein", "Medline", "Staples"]
+bench_items = ["Nitrile Gloves", "Alcohol Prep Pads", "Gauze Sponges", "Syringes 3mL", "Exam Table Paper",
+               "Sharps Container", "Copy Paper", "Hand Sanitizer", "Tongue Depressors", "Specimen Cups"]
+bench_phases = ["amazon_parse", "amazon_normalize", "inventory_report_normalize", "mckesson_ingest",
+                "store_build", "table_view", "table_search", "reorder_build", "reorder_update", "excel_export", "metrics"]
+
+def _bench_dates(rng, n):
+    days = rng.integers(0, 365, n)
+    return (pd.Timestamp("2025-01-01") + pd.to_timedelta(days, unit="D")).strftime("%m/%d/%Y")
+
+def synthetic_amazon_report(n, rng):
+    qty = rng.integers(1, 20, n)
+    price = rng.gamma(2.0, 12.0, n).round(2)
+    df = pd.DataFrame({
+        "Order Date": _bench_dates(rng, n),
+        "Department Name": rng.choice(manual_entry_fields[0][2] + ["Admin"], n, p=[0.4, 0.3, 0.28, 0.02]),
+        "Title": rng.choice(bench_items, n),
+        "Brand": rng.choice(bench_vendors, n),
+        "Item Quantity": qty.astype(str),
+        "Item Price": price.astype(str),
+        "Order Subtotal": (qty * price).round(2).astype(str),
+    })
+    # About 1% dirty cells, like real exports
+    dirty = rng.random(n) < 0.01
+    df.loc[dirty, "Item Quantity"] = "n/a"
+    return df
+
+def synthetic_inventory_report(n, rng):
+    qty = rng.integers(0, 50, n)
+    value = rng.gamma(2.0, 10.0, n).round(2)
+    return pd.DataFrame({
+        "Department": rng.choice(manual_entry_fields[0][2], n),
+        "Vendor": rng.choice(bench_vendors, n),
+        "Item": rng.choice(bench_items, n),
+        "Location": rng.choice(manual_entry_fields[3][2], n),
+        "Unit": rng.choice(["Box", "Bottle", "Case", "Each"], n),
+        "Qty": qty,
+        "Par Level": rng.integers(0, 10, n),
+        "Value": value,
+        "Frequency": rng.choice(["Monthly", "Weekly", "Quarterly"], n),
+        "Date Ordered": _bench_dates(rng, n),
+        "Total Cost": (qty * value).round(2),
+    })
+
+def synthetic_mckesson_csv(n, rng):
+    # McKesson exports: order date in column F, extended cost in column H
+    df = pd.DataFrame({
+        "Account": "MAP-001", "Invoice": rng.integers(100000, 999999, n), "Item #": rng.integers(1000, 9999, n),
+        "Description": rng.choice(bench_items, n), "UOM": "BX", "Order Date": _bench_dates(rng, n),
+        "Qty": rng.integers(1, 10, n), "Extended Cost": rng.gamma(2.0, 30.0, n).round(2),
+    })
+    return df.to_csv(index=False).encode("utf-8")
+
+def synthetic_quest_metrics(n, rng):
+    return pd.DataFrame({
+        "Client #": rng.choice([f"C{i:03d}" for i in range(30)], n),
+        "Ref. Phy.": rng.choice([f"Provider {i}" for i in range(60)], n),
+        "Description of Service": rng.choice([f"Lab Test {i}" for i in range(120)], n),
+        "Date of Service": _bench_dates(rng, n),
+        "Price": rng.gamma(2.0, 20.0, n).round(2),
+    })
+
+def _bench_phase(name, n, rng):
+    # Builds the inputs for one phase and returns the callable to time (inputs are not timed)
+    if name == "amazon_parse":
+        data = synthetic_amazon_report(n, rng).to_csv(index=False).encode("utf-8")
+        return lambda: pd.read_csv(io.BytesIO(data)), len(data)
+    if name == "amazon_normalize":
+        df = synthetic_amazon_report(n, rng)
+        return lambda: normalize_upload(df, amazon_csv_to_manual), None
+    if name == "inventory_report_normalize":
+        df = synthetic_inventory_report(n, rng)
+        return lambda: normalize_upload(df, {c: c for c in inventory_columns}, missing=""), None
+    if name == "mckesson_ingest":
+        data = synthetic_mckesson_csv(n, rng)
+        return lambda: read_mckesson_report(data, "mckesson.csv"), len(data)
+    if name == "store_build":
+        normalized, _ = normalize_upload(synthetic_inventory_report(n, rng), {c: c for c in inventory_columns}, missing="")
+        return lambda: InventoryStore(rows=normalized).frame, None
+    store = InventoryStore(rows=normalize_upload(synthetic_inventory_report(n, rng), {c: c for c in inventory_columns}, missing="")[0])
+    frame = store.frame
+    if name == "table_view":
+        # What display_inventory_table() does for a filtered, sorted first page, including the Arrow
+        # serialization st.dataframe performs
+        dataframe_util = lazy_import("streamlit.dataframe_util")
+        store.search_index()
+        def table_view():
+            view = inventory_view(store, "gloves", ["Manassas", "FCPS"], "Total Cost", ascending=False)
+            return dataframe_util.convert_pandas_df_to_arrow_bytes(view.iloc[:100])
+        return table_view, None
+    if name == "table_search":
+        # "gloves at Culmore ordered this quarter" against the maintained index
+        store.search_index()
+        return lambda: inventory_view(store, "nitrile gloves", ["Culmore"], date_range=date_preset_range("This quarter", "2025-05-15")), None
+    if name == "reorder_build":
+        # Whole-table forecast from scratch: group stats for every (Department, Item), then the plan
+        def reorder_build():
+            store.table._reorder = None
+            return store.reorder_list("2025-12-31")
+        return reorder_build, None
+    if name == "reorder_update":
+        # One new order against a built engine: only its group is recomputed
+        store.reorder_list("2025-12-31")
+        new = store.row(0)
+        def reorder_update():
+            store.append({**new, "Date Ordered": "2025-12-30"})
+            return store.reorder_list("2025-12-31")
+        return reorder_update, None
+    if name == "excel_export":
+        lazy_import("xlsxwriter.utility")
+        return lambda: build_inventory_export(frame), None
+    if name == "metrics":
+        df = synthetic_quest_metrics(n, rng)
+        return lambda: calculate_metrics(df), None
+    raise ValueError(f"Unknown benchmark phase: {name}")
+
+def run_benchmarks(sizes=None, phases=None, repeat=1, memory=True, seed=0):
+    import tracemalloc
+    results = []
+    for n in sizes or bench_default_sizes:
+        for name in phases or bench_phases:
+            fn, input_bytes = _bench_phase(name, n, np.random.default_rng(seed))
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                out = fn()
+                timings.append(time.perf_counter() - started)
+            peak = None
+            if memory:
+                # A separate traced run, so tracing overhead doesn't skew the timings
+                tracemalloc.start()
+                fn()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result = {"phase": name, "rows": n, "seconds": round(min(timings), 6), "peak_bytes": peak}
+            if input_bytes is not None:
+                result["input_bytes"] = input_bytes
+            if isinstance(out, bytes):
+                result["output_bytes"] = len(out)
+            results.append(result)
+            print(f"{name:<28}{n:>10,} rows {result['seconds']:>10.3f} s  peak {(peak or 0) / 2**20:>9.1f} MiB", flush=True)
+    return results
+
+def compare_benchmarks(results, baseline):
+    # Ratio of each phase's time to the baseline run's (>1 is slower)
+    base = {(r["phase"], r["rows"]): r["seconds"] for r in baseline["results"]}
+    for r in results:
+        before = base.get((r["phase"], r["rows"]))
+        if before:
+            print(f"{r['phase']:<28}{r['rows']:>10,} rows {r['seconds'] / before:>8.2f}x vs baseline")
+
+def bench_cli(argv):
+    import argparse
+    import platform
+    parser = argparse.ArgumentParser(prog="inventory_portal_final_2.3.py bench", description="Time the portal's hot paths on synthetic data.")
+    parser.add_argument("--sizes", default=",".join(map(str, bench_default_sizes)), help="comma-separated row counts")
+    parser.add_argument("--phases", default=",".join(bench_phases), help="comma-separated subset of: " + ", ".join(bench_phases))
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per phase; the fastest is reported")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced peak-memory run")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+    results = run_benchmarks(
+        sizes=[int(v) for v in args.sizes.split(",")],
+        phases=args.phases.split(","),
+        repeat=args.repeat,
+        memory=not args.no_memory,
+    )
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "script": os.path.basename(__file__),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_benchmarks(results, json.load(f))
+    return 0
+
+# --- STARTUP BUDGET ---
+# Cold import of this script measured at ~0.48 s, almost all of it streamlit + pandas (~0.47 s).
+# The login page renders right after import, so this is its budget; none of lazy_tab_modules may load here.
+login_import_budget_seconds = float(os.environ.get("LOGIN_IMPORT_BUDGET_SECONDS", "1.0"))
+module_import_seconds = time.perf_counter() - _module_import_started
+
+def check_import_budget():
+    loaded = [name for name in lazy_tab_modules if name in sys.modules]
+    ok = module_import_seconds <= login_import_budget_seconds and not loaded
+    print(json.dumps({
+        "import_seconds": round(module_import_seconds, 4),
+        "budget_seconds": login_import_budget_seconds,
+        "eagerly_loaded": loaded,
+        "ok": ok,
+    }))
+    return 0 if ok else 1
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["import-budget"]:
+        sys.exit(check_import_budget())
+    if sys.argv[1:2] == ["bench"]:
+        sys.exit(bench_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ["ingest"]:
+        sys.exit(ingest_cli(sys.argv[2:]))
     main()
\ No newline at end of file
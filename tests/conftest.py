@@ -0,0 +1,55 @@
+import importlib.util
+import json
+import logging
+import pathlib
+import sys
+
+import pytest
+
+app_path = pathlib.Path(__file__).resolve().parents[1] / "inventory_portal_final_2.3.py"
+
+
+@pytest.fixture(scope="session")
+def portal():
+    # The app is a single script whose file name is not importable, so load it by path
+    module = sys.modules.get("inventory_portal")
+    if module is None:
+        spec = importlib.util.spec_from_file_location("inventory_portal", app_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["inventory_portal"] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(autouse=True)
+def fresh_streamlit_caches():
+    # AppTest runs share the process-wide caches, including the shared inventory table
+    import streamlit as st
+
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    yield
+
+
+class PhaseLog(logging.Handler):
+    # Names of the timed phases the app logs, in order
+    def __init__(self):
+        super().__init__()
+        self.phases = []
+
+    def emit(self, record):
+        event = json.loads(record.getMessage())
+        if event["event"] == "phase":
+            self.phases.append(event["phase"])
+
+
+@pytest.fixture
+def perf_phases():
+    log = PhaseLog()
+    perf = logging.getLogger("inventory_portal.perf")
+    level = perf.level
+    perf.addHandler(log)
+    perf.setLevel(logging.INFO)
+    yield log.phases
+    perf.removeHandler(log)
+    perf.setLevel(level)
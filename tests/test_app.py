@@ -0,0 +1,99 @@
+from streamlit.testing.v1 import AppTest
+
+from conftest import app_path
+
+
+def test_login_page_does_not_open_the_inventory(tmp_path, monkeypatch):
+    db_path = tmp_path / "inventory.db"
+    monkeypatch.setenv("INVENTORY_DB_PATH", str(db_path))
+    at = AppTest.from_file(str(app_path), default_timeout=60).run()
+    assert not at.exception
+    assert "inventory_store" not in at.session_state
+    assert not db_path.exists()
+
+    at.text_input[0].set_value("MAP")
+    at.text_input[1].set_value("P01!12")
+    at.button[0].click().run()
+    at.run()
+    assert not at.exception
+    assert "inventory_store" in at.session_state
+    assert db_path.exists()
+
+
+def _amazon_csv(rows):
+    header = "Order Date,Department Name,Title,Brand,Item Quantity,Item Price,Order Subtotal\n"
+    return (header + "".join(f"03/01/2025,FCPS,{title},Medline,{qty},4.00,{qty * 4:.2f}\n" for title, qty in rows)).encode()
+
+
+def _logged_in_app(db_path, monkeypatch):
+    monkeypatch.setenv("INVENTORY_DB_PATH", str(db_path))
+    at = AppTest.from_file(str(app_path), default_timeout=60)
+    at.session_state.logged_in = True
+    return at.run()
+
+
+def _seed(portal, db_path, items):
+    df = portal.pd.DataFrame({"Department": "FCPS", "Vendor": "Medline", "Item": items, "Unit": "Medline",
+                              "Qty": 5, "Value": 4.0, "Date Ordered": "2025-02-01"})
+    rows, _ = portal.normalize_upload(df, {c: c for c in df.columns}, missing="")
+    db = portal.InventoryDB(str(db_path))
+    db.insert_frame(portal.coerce_inventory_frame(rows), label="seed")
+
+
+def test_batch_review_merges_similar_titles_only_when_ticked(portal, tmp_path, monkeypatch):
+    db_path = tmp_path / "inventory.db"
+    _seed(portal, db_path, ["Alcohol Prep Pads Sterile", "Syringes 3mL"])
+    at = _logged_in_app(db_path, monkeypatch)
+    at.selectbox(key="file_type_select").set_value("Amazon Report")
+    at.file_uploader(key="inv_excel_upload").set_value(
+        ("amazon.csv", _amazon_csv([("Alcohol Prep Pad Sterile", 2), ("Syringes 5mL", 3)]), "text/csv"))
+    at.run()
+    assert not at.exception
+    captions = " ".join(c.value for c in at.caption)
+    assert "1 with a similar title" in captions
+    at.button(key="commit_upload_batch").click().run()
+    assert not at.exception
+    store = at.session_state.inventory_store
+    # Neither upload line was merged: one needed confirmation, the other is a different size
+    assert sorted(store.frame["Item"].tolist()) == sorted(
+        ["Alcohol Prep Pads Sterile", "Syringes 3mL", "Alcohol Prep Pad Sterile", "Syringes 5mL"])
+
+
+def test_merge_plan_is_reused_across_reruns(portal, tmp_path, monkeypatch, perf_phases):
+    db_path = tmp_path / "inventory.db"
+    _seed(portal, db_path, ["Alcohol Prep Pads Sterile"])
+    at = _logged_in_app(db_path, monkeypatch)
+    at.selectbox(key="file_type_select").set_value("Amazon Report")
+    at.file_uploader(key="inv_excel_upload").set_value(("amazon.csv", _amazon_csv([("Alcohol Prep Pad Sterile", 2)]), "text/csv"))
+    at.run()
+    at.radio(key="upload_review_mode").set_value("Batch").run()
+    at.run()
+    assert not at.exception
+    assert perf_phases.count("upload_merge_plan") == 1
+    # A change to the inventory invalidates it
+    at.session_state.inventory_store.append({**at.session_state.inventory_store.row(0), "Item": "Gauze"})
+    at.run()
+    assert perf_phases.count("upload_merge_plan") == 2
+
+
+def test_grid_keeps_its_selection_when_another_user_writes(portal, tmp_path, monkeypatch):
+    db_path = tmp_path / "inventory.db"
+    _seed(portal, db_path, ["Gauze", "Tape", "Swabs"])
+    at = _logged_in_app(db_path, monkeypatch)
+    (grid,) = at.dataframe
+    other = at.session_state.inventory_store.table
+    other.delete_rows([0], label="delete")
+    at.run()
+    assert not at.exception
+    assert grid.proto.id in [df.proto.id for df in at.dataframe]
+
+
+def test_grid_selection_follows_the_rows_that_were_picked(portal):
+    state = {}
+    before = [(1, 1), (2, 1), (3, 1)]
+    assert portal.grid_selected_keys(state, "grid", [], before) == []
+    # Row 2 is picked on that render; then another user deletes row 1 and the rows move up
+    assert portal.grid_selected_keys(state, "grid", [1], before) == [(2, 1)]
+    assert portal.grid_selected_keys(state, "grid", [1], [(2, 1), (3, 1)]) == [(2, 1)]
+    # A new pick is taken from what was on screen at the time
+    assert portal.grid_selected_keys(state, "grid", [0, 1], [(2, 2), (3, 1)]) == [(2, 1), (3, 1)]
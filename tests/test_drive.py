@@ -0,0 +1,47 @@
+import time
+
+from streamlit.testing.v1 import AppTest
+
+from conftest import app_path
+
+
+def _wait(jobs):
+    deadline = time.monotonic() + 10
+    while any(job.active for job in jobs) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def _unreachable():
+    raise OSError("Drive is unreachable")
+
+
+def test_finished_jobs_are_pruned(portal, monkeypatch):
+    monkeypatch.setattr(portal, "drive_job_history", 2)
+    uploader = portal.DriveUploader(service_factory=_unreachable, max_workers=1)
+    jobs = [uploader.submit(f"f{i}.txt", f"data {i}".encode(), "text/plain") for i in range(5)]
+    _wait(jobs)
+    last = uploader.submit("last.txt", b"last", "text/plain")
+    _wait([last])
+    assert len(uploader.jobs) <= 3 and last.id in uploader.jobs
+    assert list(uploader._inflight.values()) == [last]
+
+
+def test_failed_upload_can_be_retried(tmp_path, monkeypatch):
+    monkeypatch.setenv("INVENTORY_DB_PATH", str(tmp_path / "inventory.db"))
+    # Nothing listens on the discard port, so the upload fails
+    monkeypatch.setenv("DRIVE_API_ENDPOINT", "http://127.0.0.1:9/")
+    at = AppTest.from_file(str(app_path), default_timeout=60)
+    at.session_state.logged_in = True
+    at.run()
+    at.sidebar.radio[0].set_value("Drive_Upload").run()
+    at.file_uploader(key="drive_files").set_value(("notes.txt", b"hello", "text/plain")).run()
+    deadline = time.monotonic() + 10
+    while not any(b.key == "drive_retry" for b in at.button) and time.monotonic() < deadline:
+        time.sleep(0.1)
+        at.run()
+    assert not at.exception
+    assert any("failed" in e.value for e in at.error)
+    (first,) = at.session_state.drive_jobs.values()
+    at.button(key="drive_retry").click().run()
+    (second,) = at.session_state.drive_jobs.values()
+    assert second != first
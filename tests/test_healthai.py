@@ -0,0 +1,36 @@
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from conftest import app_path
+
+
+@pytest.fixture
+def healthai_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("HEALTHAI_LLM", "stub")
+    monkeypatch.setenv("HEALTHAI_CACHE_DIR", str(tmp_path / "healthai_cache"))
+    monkeypatch.setenv("INVENTORY_DB_PATH", str(tmp_path / "inventory.db"))
+
+
+def _healthai_session():
+    at = AppTest.from_file(str(app_path), default_timeout=60)
+    at.session_state.logged_in = True
+    at.run()
+    at.sidebar.radio[0].set_value("HealthAI").run()
+    at.file_uploader(key="healthai_file").set_value(("labs.csv", b"test,price\nA1C,12.5\nCBC,8\n", "text/csv"))
+    at.text_area[0].set_value("Summarize the labs")
+    return at.run()
+
+
+def test_cached_reply_does_not_parse_the_file(healthai_env, perf_phases):
+    at = _healthai_session()
+    assert "healthai_read" not in perf_phases
+    at.button[0].click().run()
+    assert not at.exception
+    assert perf_phases.count("healthai_read") == 1
+
+    perf_phases.clear()
+    at = _healthai_session()
+    at.button[0].click().run()
+    assert not at.exception
+    assert "Served from the response cache." in [c.value for c in at.caption]
+    assert "healthai_read" not in perf_phases
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+
+def _folder(portal, tmp_path):
+    folder = tmp_path / "reports"
+    folder.mkdir()
+    rng = np.random.default_rng(0)
+    # No "mckesson" in the file name: the export is recognised by its header
+    (folder / "supplies_october.csv").write_bytes(portal.synthetic_mckesson_csv(20, rng))
+    portal.synthetic_amazon_report(30, rng).to_csv(folder / "amazon_october.csv", index=False)
+    return folder
+
+
+def _ingest(portal, folder, db_path):
+    out_dir = folder.parent / "out"
+    status = portal.ingest_cli([str(folder), "--out-dir", str(out_dir), "--workers", "1", "--db", str(db_path)])
+    return status, pd.read_csv(out_dir / "ingest_report.csv").set_index("file")
+
+
+def test_mckesson_detected_by_header(portal):
+    header = ["Account", "Invoice", "Item #", "Description", "UOM", "Order Date", "Qty", "Extended Cost"]
+    assert portal.detect_report_kind("supplies.csv", header) == "mckesson"
+    assert portal.mckesson_columns(header) == (5, 7)
+    # An inventory report with a department column is not a McKesson export
+    assert portal.mckesson_columns(["Department", "Item #", "UOM", "Order Date", "Extended Cost"]) is None
+
+
+def test_reingesting_a_folder_allocates_mckesson_lines_once(portal, tmp_path):
+    folder = _folder(portal, tmp_path)
+    db_path = tmp_path / "inventory.db"
+    status, report = _ingest(portal, folder, db_path)
+    assert status == 0
+    assert report.loc["supplies_october.csv", "kind"] == "mckesson"
+    assert report.loc["supplies_october.csv", "inserted"] > 0
+    rows = portal.InventoryDB(str(db_path)).totals()[0]
+
+    status, report = _ingest(portal, folder, db_path)
+    assert status == 0
+    assert report.loc["supplies_october.csv", "inserted"] == 0
+    assert report.loc["supplies_october.csv", "skipped"] == 20
+    assert report.loc["amazon_october.csv", "inserted"] == 0
+    assert portal.InventoryDB(str(db_path)).totals()[0] == rows
@@ -0,0 +1,109 @@
+import pandas as pd
+import pytest
+
+
+def _rows(portal, items):
+    df = pd.DataFrame({
+        "Department": "Manassas", "Vendor": "Medline", "Item": items, "Unit": "Box",
+        "Qty": range(1, len(items) + 1), "Value": 2.0, "Date Ordered": "2025-03-01",
+    })
+    normalized, _ = portal.normalize_upload(df, {c: c for c in df.columns}, missing="")
+    return normalized
+
+
+def test_coerce_keeps_rows_of_a_gapped_index(portal):
+    rows = _rows(portal, ["I1", "I2", "I3", "I4", "I5"])
+    accepted = rows[[True, False, True, True, True]]
+    frame = portal.coerce_inventory_frame(accepted)
+    assert frame["Item"].tolist() == ["I1", "I3", "I4", "I5"]
+    assert frame["Qty"].tolist() == [1, 3, 4, 5]
+
+
+def test_batch_commit_with_flagged_rows_keeps_accepted_rows(portal):
+    # What "Commit Batch" does when some rows were flagged and left out
+    rows = _rows(portal, ["I1", "I2", "I3", "I4", "I5"])
+    flagged = pd.Series([False, True, False, False, False])
+    store = portal.InventoryStore(rows=[])
+    counts = portal.merge_upload_rows(store, rows[~flagged], fuzzy=False)
+    assert counts["insert"] == 4
+    frame = store.frame
+    assert frame["Item"].tolist() == ["I1", "I3", "I4", "I5"]
+    assert frame["Qty"].notna().all()
+    assert store.total_cost == 2.0 * (1 + 3 + 4 + 5)
+
+
+def test_rows_loaded_from_the_database_can_be_edited(portal, tmp_path):
+    path = str(tmp_path / "inventory.db")
+    portal.InventoryStore(rows=_rows(portal, ["I1", "I2"]), db=portal.InventoryDB(path))
+    store = portal.InventoryStore(db=portal.InventoryDB(path))
+    store.update(0, {**store.row(0), "Qty": 9})
+    assert store.frame["Qty"].tolist() == [9, 2]
+    db = portal.InventoryDB(path)
+    db.write_snapshot(*db.load())
+    store = portal.InventoryStore(db=portal.InventoryDB(path))
+    store.update(1, {**store.row(1), "Qty": 7})
+    assert store.frame["Qty"].tolist() == [9, 7]
+
+
+def test_journal_is_compacted_behind_the_snapshot(portal, tmp_path, monkeypatch):
+    monkeypatch.setattr(portal, "journal_snapshot_every", 10)
+    monkeypatch.setattr(portal, "journal_undo_depth", 3)
+    path = str(tmp_path / "inventory.db")
+    store = portal.InventoryStore(db=portal.InventoryDB(path))
+    behind = portal.InventoryTable(portal.InventoryDB(path))
+    behind.frame
+    for i in range(40):
+        store.append(_rows(portal, [f"I{i}"]).iloc[0].to_dict())
+    store.delete(len(store) - 1)
+    store.undo()
+    store.delete(len(store) - 1)
+    db = portal.InventoryDB(path)
+    ops = [op for op, in db.conn.execute("SELECT op FROM journal ORDER BY seq")]
+    assert ops[0] == "compact" and len(ops) <= 10 + 3 + 1
+    # The deleted row's id (40) is not handed out again
+    assert db.insert_frame(_rows(portal, ["New"])).tolist() == [41]
+    items = [f"I{i}" for i in range(39)] + ["New"]
+    assert portal.InventoryTable(portal.InventoryDB(path)).frame["Item"].tolist() == items
+    # A table that fell behind the compaction reloads instead of replaying a partial journal
+    behind.sync()
+    assert behind.frame["Item"].tolist() == items
+
+
+def test_search_finds_rows_appended_after_the_index_was_built(portal):
+    store = portal.InventoryStore(rows=_rows(portal, ["Gauze pads"]))
+    assert len(store.search("gauze")) == 1
+    store.append(_rows(portal, ["Gauze roll"]).iloc[0].to_dict())
+    assert store.search("gauze")["Item"].tolist() == ["Gauze pads", "Gauze roll"]
+
+
+def test_stale_edit_is_refused_after_a_delete_is_undone(portal, tmp_path):
+    path = str(tmp_path / "inventory.db")
+    table = portal.InventoryTable(portal.InventoryDB(path))
+    a = portal.InventoryStore(rows=_rows(portal, ["I1"]), table=table)
+    b = portal.InventoryStore(table=table)
+    stale = b.row_keys([0])[0]
+    a.update(0, {**a.row(0), "Qty": 50})
+    a.delete(0)
+    a.undo()
+    with pytest.raises(portal.InventoryConflict):
+        b.edit_row(stale, {**b.row(0), "Qty": 2})
+    assert table.frame["Qty"].tolist() == [50]
+    # The database agrees on the restored row's version, so other processes refuse it too
+    frame, ids, versions = portal.InventoryDB(path).load()
+    assert versions.tolist() == [table.row_keys([0])[0][1]] and versions[0] > stale[1]
+    a.redo()
+    a.undo()
+    assert portal.InventoryDB(path).load()[2].tolist() == [table.row_keys([0])[0][1]]
+
+
+def test_export_migration_runs_once(portal, tmp_path):
+    path = str(tmp_path / "inventory.db")
+    export = str(tmp_path / "inventory_report.xlsx")
+    _rows(portal, ["I1", "I2"]).to_excel(export, index=False)
+    assert portal.InventoryDB(path).import_export(export) == 2
+    store = portal.InventoryStore(db=portal.InventoryDB(path))
+    store.delete_many([0, 1])
+    # A restart with the old export still on disk leaves the emptied inventory empty
+    db = portal.InventoryDB(path)
+    assert db.import_export(export) == 0
+    assert db.totals()[0] == 0
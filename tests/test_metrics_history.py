@@ -0,0 +1,36 @@
+import os
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def metrics_cache(portal, tmp_path, monkeypatch):
+    monkeypatch.setattr(portal, "metrics_cache_dir", str(tmp_path / "metrics_cache"))
+    return tmp_path / "metrics_cache"
+
+
+def _quest(prices):
+    n = len(prices)
+    return pd.DataFrame({
+        "Client #": ["C001"] * n, "Ref. Phy.": ["Provider 1"] * n,
+        "Description of Service": ["Lab Test 1"] * n, "Date of Service": ["2025-01-15"] * n, "Price": prices,
+    })
+
+
+def test_whole_dollar_and_fractional_months_load_together(portal, metrics_cache):
+    assert portal.ingest_metrics_file(_quest([10, 20]), "a" * 16, "2025-01")
+    assert portal.ingest_metrics_file(_quest([1.5, 2.25]), "b" * 16, "2025-02")
+    history = portal.load_metrics_history(["2025-01", "2025-02"])
+    assert history["Price"].dtype == "float64"
+    trends = portal.calculate_metric_trends(history)
+    assert trends["total_cost_by_month"].to_dict() == {"2025-01": 30.0, "2025-02": 3.75}
+
+
+def test_int64_partitions_from_older_writes_still_load(portal, metrics_cache):
+    old = _quest([10, 20]).astype({col: "string" for col in portal.metrics_required_columns if col != "Price"})
+    os.makedirs(metrics_cache / "month=2025-01")
+    old.drop(columns=["Date of Service"]).to_parquet(metrics_cache / "month=2025-01" / "old.parquet", index=False)
+    assert portal.ingest_metrics_file(_quest([1.5]), "c" * 16, "2025-02")
+    history = portal.load_metrics_history(["2025-01", "2025-02"])
+    assert history["Price"].sum() == 31.5
@@ -0,0 +1,42 @@
+import pandas as pd
+
+
+def _order(portal, date, qty=10):
+    df = pd.DataFrame({
+        "Department": ["Manassas"], "Vendor": ["Amazon"], "Item": ["Nitrile gloves, medium"], "Unit": ["Box"],
+        "Qty": [qty], "Value": [12.5], "Date Ordered": [date],
+    })
+    normalized, _ = portal.normalize_upload(df, {c: c for c in df.columns}, missing="")
+    return normalized
+
+
+def _monthly(count):
+    return [f"2025-{month:02d}-01" for month in range(1, count + 1)]
+
+
+def test_twelve_monthly_orders_are_not_twelve_months_of_stock(portal):
+    store = portal.InventoryStore(rows=pd.concat([_order(portal, date) for date in _monthly(12)]))
+    plan = store.reorder_list("2026-01-01")
+    assert len(plan) == 1
+    due = plan.iloc[0]
+    assert due["Last Order Qty"] == 10
+    assert 0.3 < due["Daily Use"] < 0.4
+    assert due["Projected"] == 0
+
+
+def test_merged_monthly_uploads_build_an_order_history(portal, tmp_path):
+    path = str(tmp_path / "inventory.db")
+    store = portal.InventoryStore(db=portal.InventoryDB(path))
+    for date in _monthly(6):
+        portal.merge_upload_rows(store, _order(portal, date), fuzzy=False)
+    assert len(store) == 1 and store.frame["Qty"].tolist() == [60]
+    plan = store.reorder_list("2025-06-25")
+    assert len(plan) == 1
+    assert plan.iloc[0]["Last Order Qty"] == 10
+    assert 0.3 < plan.iloc[0]["Daily Use"] < 0.4
+    # The history is kept in the database, and undoing a merge takes its order back out
+    reloaded = portal.InventoryTable(portal.InventoryDB(path)).reorder_list("2025-06-25")
+    pd.testing.assert_frame_equal(reloaded, plan)
+    store.undo()
+    assert store.reorder_list("2025-06-25").iloc[0]["Last Ordered"] == pd.Timestamp("2025-05-01")
+    assert len(portal.InventoryDB(path).load_order_log()) == 5
@@ -0,0 +1,66 @@
+import pandas as pd
+import pytest
+
+
+def _rows(portal, items, qty=1):
+    df = pd.DataFrame({
+        "Department": "FCPS", "Vendor": "Medline", "Item": items, "Unit": "Box",
+        "Qty": qty, "Value": 4.0, "Date Ordered": "2025-03-01",
+    })
+    normalized, _ = portal.normalize_upload(df, {c: c for c in df.columns}, missing="")
+    return normalized
+
+
+@pytest.mark.parametrize("existing, uploaded", [
+    ("Syringes 3mL", "Syringes 5mL"),
+    ("Nitrile Gloves Large", "Nitrile Gloves XLarge"),
+    ("Nitrile Gloves Large", "Nitrile Gloves X-Large"),
+    ("Isolation Gown Size M", "Isolation Gown Size S"),
+    ("Saline Flush 10mL", "Saline Flush 1mL"),
+])
+def test_variants_never_match_fuzzily(portal, existing, uploaded):
+    store = portal.InventoryStore(rows=_rows(portal, [existing]))
+    plan = portal.plan_upload_merge(store, _rows(portal, [uploaded]))
+    assert plan["action"].tolist() == ["insert"]
+
+
+def test_similar_title_is_a_proposal_until_confirmed(portal):
+    store = portal.InventoryStore(rows=_rows(portal, ["Alcohol Prep Pads Sterile"], qty=5))
+    upload = _rows(portal, ["Alcohol Prep Pad Sterile"], qty=2)
+    assert portal.plan_upload_merge(store, upload)["action"].tolist() == ["fuzzy"]
+
+    counts = portal.merge_upload_rows(store, upload, confirmed=set())
+    assert counts["insert"] == 1 and counts["fuzzy"] == 0
+    assert store.frame["Qty"].tolist() == [5, 2]
+
+    store = portal.InventoryStore(rows=_rows(portal, ["Alcohol Prep Pads Sterile"], qty=5))
+    counts = portal.merge_upload_rows(store, upload, confirmed={0})
+    assert counts["fuzzy"] == 1
+    assert store.frame["Qty"].tolist() == [7]
+
+
+def test_unconfirmed_lines_of_one_upload_stay_separate(portal):
+    store = portal.InventoryStore(rows=[])
+    upload = _rows(portal, ["Exam Table Paper Smooth", "Exam Table Papers Smooth", "Exam Table Paper Smooth"])
+    counts = portal.merge_upload_rows(store, upload, confirmed=set())
+    # The exact repeat folds into the first line; the similar title is left as its own item
+    assert counts == {"insert": 2, "update": 1, "fuzzy": 0, "skip": 0}
+    assert store.frame["Qty"].tolist() == [2, 1]
+
+
+def test_merge_index_follows_writes_without_a_rebuild(portal):
+    store = portal.InventoryStore(rows=_rows(portal, ["Gauze 4x4", "Tape 1in", "Gauze 4x4", "Swabs"]))
+    index = store.merge_index()
+    store.delete(0)
+    store.update(0, {**store.row(0), "Item": "Tape 2in"})
+    store.append(_rows(portal, ["Gloves Large"]).iloc[0].to_dict())
+    store.undo()
+    store.undo()
+    assert store.merge_index() is index
+    fresh = portal.MergeIndex()
+    fresh.add(store.table._ids, store.frame)
+    assert index.exact == fresh.exact and index.blocks == fresh.blocks
+    # Positions still come back after the delete shifted them
+    plan = portal.plan_upload_merge(store, _rows(portal, ["Gauze 4x4", "Swabs"]))
+    assert plan["action"].tolist() == ["update", "update"]
+    assert store.frame["Item"].iloc[plan["target"]].tolist() == ["Gauze 4x4", "Swabs"]
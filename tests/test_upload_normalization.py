@@ -0,0 +1,16 @@
+import pandas as pd
+
+
+def test_unmapped_amazon_text_fields_stay_none(portal):
+    df = pd.DataFrame({"Title": ["Gauze"], "Item Quantity": ["2"], "Item Price": ["1.50"]})
+    normalized, _ = portal.normalize_upload(df, portal.amazon_csv_to_manual)
+    entry = portal.normalized_row_to_entry(normalized, 0)
+    assert entry["Location"] is None
+    assert entry["Frequency"] is None
+
+
+def test_unmapped_report_fields_use_missing_value(portal):
+    df = pd.DataFrame({"Item": ["Gauze"], "Qty": [2]})
+    normalized, _ = portal.normalize_upload(df, {"Item": "Item", "Qty": "Qty"}, missing="")
+    assert normalized.loc[0, "Location"] == ""
+    assert normalized.loc[0, "Vendor"] == ""